@@ -47,6 +47,7 @@ class BaseHandler(object):
 
         self.event_controller.exit()    # Stop the event controller
         self._exit.set()
+        self.event_handler.close()      # Close the database connections
 
         logging.info('Shutdown base handler.')
 
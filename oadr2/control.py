@@ -1,11 +1,25 @@
 __author__ = 'Benjamin N. Summerton <bsummerton@enernoc.com>'
 
+import bisect
+import calendar
+import datetime
+import heapq
 import logging
 import time
 import threading
 from oadr2 import event, schedule
 
-CONTROL_LOOP_INTERVAL = 30   # update control state every X second
+# numpy is optional; without it events are always evaluated one at a time
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CONTROL_LOOP_INTERVAL = None    # only wake up for event transitions & updates; or
+                                # max seconds between control updates, as a
+                                # watchdog in case a change to the events was missed
+CONTROL_RETRY_INTERVAL = 30     # after an error, try again within X seconds
+VECTORIZE_MIN_EVENTS = 64       # evaluate with numpy when there are this many events
 
 
 # Used by poll.OpenADR2 to handle events
@@ -18,9 +32,21 @@ class EventController(object):
     --------
     event_handler -- The EventHandler instance
     current_signal_level -- current signal level of a realy/point
-    control_loop_interval -- How often to run the control loop
+    dispatcher -- dispatch.Dispatcher that `signal_changed_callback` is run on
+    control_loop_interval -- Longest time to sleep between control updates,
+                             or None to only wake up for event transitions
     control_thread -- threading.Thread() object w/ name of 'oadr2.control'
+    engine -- The poll.PollEngine running our control updates, if there is
+              one (instead of `control_thread`)
     _control_loop_signal -- threading.Event() object
+    _transitions -- min-heap of (timestamp, event_id); when each event's
+                    current interval changes next
+    _event_levels -- dict of event_id -> signal level, for the active events
+    _refresh -- True if all of the events need to be looked at again
+    vectorize_min_events -- Evaluate this many events or more at once with
+                            numpy (if it's installed); None to never do it
+    _forecast -- (EventHandler.cache_version, steps) of the last forecast,
+                 see `get_signal_forecast()`
     _exit -- A threading.Thread() object
     '''
 
@@ -28,17 +54,31 @@ class EventController(object):
     def __init__(self, event_handler, 
             signal_changed_callback = None,
             start_thread = True,
-            control_loop_interval = CONTROL_LOOP_INTERVAL):
+            control_loop_interval = CONTROL_LOOP_INTERVAL,
+            vectorize_min_events = VECTORIZE_MIN_EVENTS,
+            dispatcher = None,
+            engine = None):
         '''
         Initialize the Event Controller
 
         event_handler -- An instance of event.EventHandler
+        signal_changed_callback -- Called as `cb(old_level, new_level)` when
+                                   the signal level changes
         start_thread -- Start the control thread
-        control_loop_interval -- How often to run the control loop
+        control_loop_interval -- Longest time to sleep between control updates,
+                                 as a watchdog; by default None, to only wake
+                                 up for event transitions & `events_updated()`
+        vectorize_min_events -- Evaluate this many events or more at once with
+                                numpy (if it's installed); None to never do it
+        dispatcher -- dispatch.Dispatcher to run `signal_changed_callback`
+                      on; defaults to the event handler's
+        engine -- A poll.PollEngine to run the control updates on, rather
+                  than a thread of our own
         '''
 
         self.event_handler = event_handler
         self.current_signal_level = 0 
+        self.dispatcher = dispatcher if dispatcher is not None else event_handler.dispatcher
 
         self.signal_changed_callback = signal_changed_callback \
                 if signal_changed_callback is not None \
@@ -51,10 +91,24 @@ class EventController(object):
         self._control_loop_signal = threading.Event()
         self.control_loop_interval = control_loop_interval
 
+        # Only touched by the control thread
+        self._transitions = []
+        self._event_levels = {}
+        self._refresh = True
+
+        self.vectorize_min_events = vectorize_min_events
+        self._vector_evaluator = VectorEvaluator() if numpy is not None else None
+        self._vector_plan = None    # see `_get_vector_plan()`
+        self._forecast = None
+
         # The control thread
         self.control_thread = None
+        self.engine = engine
 
-        if start_thread:
+        if start_thread and self.engine is not None:
+            # give a couple seconds before performing first control
+            self.engine.add(self, delay=5, func=self.control_once)
+        elif start_thread:
             self.control_thread = threading.Thread(
                     name='oadr2.control',
                     target=self._control_event_loop)
@@ -68,6 +122,8 @@ class EventController(object):
         loop to refresh
         '''
         self._control_loop_signal.set()
+        if self.engine is not None:
+            self.engine.wake(self)
 
 
     def get_current_signal_level(self):
@@ -77,141 +133,512 @@ class EventController(object):
         '''
 
         signal_level, event_id, expired_events = self._calculate_current_event_status(
-                self.event_handler.get_active_events() )
+                self.event_handler.get_active_records(within=0) )
 
         return signal_level, event_id
 
 
+    def get_signal_forecast(self, horizon=None, now=None):
+        '''
+        Get the upcoming signal levels, merged from all of the stored events
+        the same way `get_current_signal_level()` does it.  The merged
+        timeline is only worked out again when the events change, so this
+        can be called as often as you like.
+
+        horizon -- How many seconds ahead to look, or None for every known
+                   change
+        now -- datetime (UTC) to start from, defaults to utcnow()
+
+        Returns: A list of (change_time, signal_level, event_id) tuples.  The
+            first one is the level at `now`; each one after that is when the
+            level (or the event setting it) changes.  event_id is None when
+            no event is active, with a level of 0.
+        '''
+        if now is None: now = datetime.datetime.utcnow()
+
+        forecast = self._forecast
+        version = self.event_handler.cache_version
+        if forecast is None or forecast[0] != version:
+            forecast = (version, self._build_forecast(self.event_handler.get_active_records()))
+            self._forecast = forecast
+        times, steps = forecast[1]
+
+        # The step in effect at `now`, then the changes up to the horizon
+        i = bisect.bisect_right(times, now)
+        level, e_id = steps[i-1][1:] if i > 0 else (0, None)
+        end = bisect.bisect_right(times, now + datetime.timedelta(seconds=horizon)) \
+                if horizon is not None else len(times)
+
+        return [(now, level, e_id)] + steps[i:end]
+
+
+    def _build_forecast(self, records):
+        '''
+        Merge the intervals of all the events into one timeline of the
+        highest signal level.  Ties go to the event that comes first in
+        `records`, like `_calculate_current_event_status()`.
+
+        records -- List of event.EventRecord
+
+        Returns: A 2-tuple of (times, steps), where steps is a list of
+            (change_time, signal_level, event_id) sorted by time & times is
+            just the change_times, for bisecting.
+        '''
+        # (start, end or None, -level, order, event_id) of every interval
+        # that would be the signal level while it's current
+        segments = []
+        for order, record in enumerate(records):
+            try:
+                if record.signals is None or not self.event_handler.check_target_info(record):
+                    continue
+                segments.extend(self._get_segments(record, order))
+            except Exception as ex:
+                logging.warn("Unable to forecast event %s: %s", record.event_id, ex)
+
+        segments.sort()
+        change_times = sorted(set([s[0] for s in segments] +
+                [s[1] for s in segments if s[1] is not None]))
+
+        steps = []
+        current = (0, None)
+        active = []     # heap of segments that have started
+        next_segment = 0
+        for t in change_times:
+            while next_segment < len(segments) and segments[next_segment][0] <= t:
+                heapq.heappush(active, segments[next_segment][2:] + (segments[next_segment][1],))
+                next_segment += 1
+
+            # Drop the ones that have ended; only the top one matters
+            while active and active[0][3] is not None and active[0][3] <= t:
+                heapq.heappop(active)
+
+            level, e_id = (-active[0][0], active[0][2]) if active else (0, None)
+            if (level, e_id) != current:
+                steps.append((t, level, e_id))
+                current = (level, e_id)
+
+        return [s[0] for s in steps], steps
+
+
+    def _get_segments(self, record, order):
+        '''
+        Break an event up into the spans of time each of its intervals is the
+        current one; leaving out intervals with a level that wouldn't count.
+
+        Returns: A list of (start, end, -level, order, event_id) tuples; end is
+            None if the interval never ends
+        '''
+        timeline = record.get_timeline()
+        boundaries = timeline.boundaries
+
+        # For intervals out of order, ask the timeline at each boundary
+        if not timeline.is_ordered():
+            times = sorted(set(boundaries))
+            spans = [(t, times[k+1] if k + 1 < len(times) else None, timeline.choose_interval(t))
+                    for k, t in enumerate(times)]
+        else:
+            spans = []
+            for i in xrange(len(boundaries) - 1):
+                if i + 1 == timeline.unending:
+                    spans.append((boundaries[i], None, i))
+                    break
+                spans.append((boundaries[i], boundaries[i+1], i))
+
+        segments = []
+        for start, end, i in spans:
+            if i is None or i < 0:
+                continue
+            value = record.signals[i][2]
+            try:
+                level = float(value) if value is not None else 0
+            except ValueError:
+                continue
+            if level > 0:
+                segments.append((start, end, -level, order, record.event_id))
+
+        return segments
+
+
     def _control_event_loop(self):
         '''
         This is the threading loop to perform control based on current oadr events
-        Note the current implementation simply loops based on CONTROL_LOOP_INTERVAL
-        except when an updated event is received by a VTN.
+        It sleeps until the next interval of any event begins, or until an
+        updated event is received by a VTN (see `events_updated()`).
         '''
 
         self._exit.wait(5)  # give a couple seconds before performing first control
 
         while not self._exit.is_set():
-            try:
+            sleep_time = self.control_once()
+            logging.debug("Next control update in %s seconds", sleep_time)
+            self._control_loop_signal.wait(sleep_time)
+
+        logging.info("Control loop exiting.")
+
+
+    def control_once(self):
+        '''
+        Update the signal level once, logging (rather than raising) any
+        errors.  Only the events that have reached their next interval are
+        looked at again, unless the events have been updated since the last
+        time.
+
+        Returns: Seconds until the next update is due, or None if there's
+            nothing to wake up for (besides `events_updated()`)
+        '''
+
+        if self._control_loop_signal.is_set():
+            # Cleared before the events are read, so an update that comes
+            # in during this pass wakes us right back up
+            self._control_loop_signal.clear()
+            self._refresh = True
+
+        try:
+            now = datetime.datetime.utcnow()
+            if self._refresh or not self._transitions_due(now):
                 logging.debug("Updating control states...")
-                events = self.event_handler.get_active_events()
+                new_signal_level = self._update_control(
+                        self.event_handler.get_active_records(), now)
+            else:
+                logging.debug("Updating control states for event transitions...")
+                new_signal_level = self._update_transitions(now)
 
-                new_signal_level = self._update_control(events)
-                logging.debug("Highest signal level is: %f", new_signal_level)
+            logging.debug("Highest signal level is: %f", new_signal_level)
 
-                changed = self._update_signal_level(new_signal_level)
-                if changed:
-                    logging.debug("Updated current signal level!")
+            changed = self._update_signal_level(new_signal_level)
+            if changed:
+                logging.debug("Updated current signal level!")
 
-            except Exception as ex:
-                logging.exception("Control loop error: %s", ex)
+            self._refresh = False
+            sleep_time = self._get_sleep_time()
 
-            self._control_loop_signal.wait(CONTROL_LOOP_INTERVAL)
-            self._control_loop_signal.clear() # in case it was triggered by a poll update
+            # The change couldn't be queued up; try it again soon
+            if new_signal_level != self.current_signal_level and \
+                    (sleep_time is None or sleep_time > CONTROL_RETRY_INTERVAL):
+                sleep_time = CONTROL_RETRY_INTERVAL
 
-        logging.info("Control loop exiting.")
+        except Exception as ex:
+            logging.exception("Control loop error: %s", ex)
+            sleep_time = self._get_sleep_time()
+            if sleep_time is None or sleep_time > CONTROL_RETRY_INTERVAL:
+                sleep_time = CONTROL_RETRY_INTERVAL
+
+        finally:
+            if self.engine is not None:
+                # An engine worker runs many controllers; don't keep a
+                # connection to each one's database open on every worker
+                self.event_handler.db.release()
+
+        return sleep_time
+
+
+    def _get_sleep_time(self):
+        '''
+        Returns: Seconds until the next event transition, no longer than
+            `control_loop_interval`; or None if there's nothing to wake up for.
+        '''
+        sleep_time = None
+        if self._transitions:
+            sleep_time = max(0, self._transitions[0][0] - time.time())
+
+        if self.control_loop_interval is not None:
+            sleep_time = self.control_loop_interval if sleep_time is None \
+                    else min(sleep_time, self.control_loop_interval)
+
+        return sleep_time
+
+
+    def _transitions_due(self, now):
+        '''
+        Returns: True if some event's interval has changed by `now`
+        '''
+        return bool(self._transitions) and \
+                self._transitions[0][0] <= schedule.dttm_to_timestamp(now)
 
     
-    def _update_control(self, events):
+    def _update_control(self, events, now=None):
         '''
         Called by `control_event_loop()` to determine the current signal level.
-        This also deletes any events from the database that have expired.
+        This rebuilds the transition schedule from all of `events`, and
+        deletes any events from the database that have expired.
+
+        events -- List of event.EventRecord objects (or lxml.etree.ElementTree
+                  objects with OpenADR 2.0 tags)
+        now -- datetime (UTC) to evaluate the events at, defaults to utcnow()
+        '''
+        if now is None: now = datetime.datetime.utcnow()
+
+        self._transitions = []
+        self._event_levels = {}
+        remove_events = []
+
+        for result in self._evaluate_events(events, now):
+            self._schedule_result(result, remove_events)
+
+        # Events that have ended don't come back from get_active_events()
+        remove_events.extend(e_id for e_id in self.event_handler.get_expired_events(now)
+                if e_id not in remove_events)
+
+        self._remove_events(remove_events)
+        return self._highest_signal_level()
+
+
+    def _update_transitions(self, now=None):
+        '''
+        Called by `control_event_loop()` when some events have reached their
+        next interval.  Only those events are looked at again.
+
+        now -- datetime (UTC) to evaluate the events at, defaults to utcnow()
+        '''
+        if now is None: now = datetime.datetime.utcnow()
+        timestamp = schedule.dttm_to_timestamp(now)
+
+        due = set()
+        while self._transitions and self._transitions[0][0] <= timestamp:
+            due.add(heapq.heappop(self._transitions)[1])
+
+        remove_events = []
+        for e_id in due:
+            self._event_levels.pop(e_id, None)
+            e = self.event_handler.get_event_record(e_id)
+            if e is not None:
+                self._schedule_event(e, now, remove_events)
+
+        self._remove_events(remove_events)
+        return self._highest_signal_level()
+
+
+    def _schedule_event(self, e, now, remove_events):
+        '''
+        Record an event's signal level (if it is active) and push its next
+        transition onto the heap.  Events that have ended are added to
+        `remove_events`.
+        '''
+        try:
+            self._schedule_result(self._evaluate_event(e, now), remove_events)
+        except Exception as ex:
+            logging.exception("Error parsing event: %s", ex)
+
 
-        events -- List of lxml.etree.ElementTree objects (with OpenADR 2.0 tags)
+    def _schedule_result(self, result, remove_events):
         '''
-        signal_level, evt_id, remove_events = self._calculate_current_event_status(events)
+        Same as `_schedule_event()`, for a result of `_evaluate_event()`
+        '''
+        e_id, signal_level, next_transition = result
+
+        if next_transition is False:
+            remove_events.append(e_id)
+            return
+
+        if signal_level is not None:
+            self._event_levels[e_id] = signal_level
 
+        if next_transition is not None:
+            heapq.heappush(self._transitions,
+                    (schedule.dttm_to_timestamp(next_transition), e_id))
+
+
+    def _remove_events(self, remove_events):
         if remove_events:
             # remove any events that we've detected have ended.
             # TODO callback for expired events??
             logging.debug("Removing completed events: %s", remove_events)
             self.event_handler.remove_events(remove_events)
-        
-        return signal_level
 
 
-    def _calculate_current_event_status(self, events):
+    def _highest_signal_level(self):
+        return max([0] + self._event_levels.values())
+
+
+    def _calculate_current_event_status(self, events, now=None):
         '''
         returns a 3-tuple of (current_signal_level, current_event_id, remove_events=[])
         '''
+        if now is None: now = datetime.datetime.utcnow()
 
         highest_signal_val = 0
         current_event_id = None
         remove_events = []  # to collect expired events
 
+        for e_id, signal_level, next_transition in self._evaluate_events(events, now):
+            if next_transition is False:
+                remove_events.append(e_id)
+                continue
+
+            if signal_level is not None and signal_level > highest_signal_val:
+                highest_signal_val = signal_level
+                current_event_id = e_id
+
+        return highest_signal_val, current_event_id, remove_events
+
+
+    def _evaluate_events(self, events, now):
+        '''
+        Find where each of `events` is in its schedule at `now`, with numpy
+        when there are at least `vectorize_min_events` of them.  Events that
+        can't be evaluated are logged and left out.
+
+        returns a list of `_evaluate_event()` 3-tuples, in the order of `events`
+        '''
+        events = list(events)
+        vectorize = self._vector_evaluator is not None and \
+                self.vectorize_min_events is not None and \
+                len(events) >= self.vectorize_min_events
+
+        if not vectorize:
+            results = []
+            for e in events:
+                try:
+                    results.append(self._evaluate_event(e, now))
+                except Exception as ex:
+                    logging.exception("Error parsing event: %s", ex)
+            return results
+
+        plan, batch = self._get_vector_plan(events)
+        vector_results = self._vector_evaluator.evaluate(batch, now)
+        if plan is None:
+            return vector_results
+
+        vector_results = iter(vector_results)
+        results = []
+        for record in plan:
+            if record is None:
+                results.append(next(vector_results))
+                continue
+            try:
+                results.append(self._evaluate_event(record, now))
+            except Exception as ex:
+                logging.exception("Error parsing event: %s", ex)
+
+        return results
+
+
+    def _get_vector_plan(self, events):
+        '''
+        Work out which events can be evaluated with numpy, and pack them.  The
+        result is reused for as long as the same event objects are passed in
+        (e.g. from `EventHandler.get_active_records()`), so an unchanged set
+        of events costs nothing to set up.
+
+        returns a 2-tuple of (plan, batch).  plan has an EventRecord for each
+            event that has to be evaluated on its own, or None for the next
+            result from the batch; or plan is None if every event is in the
+            batch.  batch is from `VectorEvaluator.prepare()`.
+        '''
+        ids = map(id, events)
+        cached = self._vector_plan
+        if cached is not None and cached[1] == ids:
+            return cached[2], cached[3]
+
+        plan = []
+        packed_events = []
         for e in events:
             try:
-                e_id = event.get_event_id(e, self.event_handler.ns_map)
-                e_mod_num = event.get_mod_number(e, self.event_handler.ns_map)
-                e_status = event.get_status(e, self.event_handler.ns_map)
+                record = e if isinstance(e, event.EventRecord) \
+                        else event.parse_event(e, self.event_handler.ns_map)
 
-                if not self.event_handler.check_target_info(e):
-                    logging.debug("Ignoring event %s - no target match", e_id)
-                    continue
+                packed = None
+                if record.signals is not None and self.event_handler.check_target_info(record):
+                    packed = self._vector_evaluator.pack(record)
 
-                event_start_dttm = event.get_active_period_start(e, self.event_handler.ns_map)
-                signals = event.get_signals(e, self.event_handler.ns_map)
+                if packed is None:
+                    plan.append(record)
+                else:
+                    packed_events.append(packed)
+                    plan.append(None)
 
-                if signals is None:
-                    logging.debug("Ignoring event %s - no valid signals", e_id)
-                    continue
+            except Exception as ex:
+                logging.exception("Error parsing event: %s", ex)
 
-                logging.debug("All signals: %r", signals)
-                intervals = [s[0] for s in signals]
-                current_interval = schedule.choose_interval( event_start_dttm, intervals )
+        batch = self._vector_evaluator.prepare(packed_events)
+        if len(packed_events) == len(events):
+            plan = None
 
-                if current_interval is None:
-                    logging.debug("Event %s(%d) has ended", e_id, e_mod_num)
-                    remove_events.append(e_id)
-                    continue
+        # Holding on to `events` keeps their id()s from being reused
+        self._vector_plan = (events, ids, plan, batch)
+        return plan, batch
 
-                if current_interval < 0:
-                    logging.debug("Event %s(%d) has not started yet.", e_id, e_mod_num)
-                    continue
 
-                logging.debug('---------- chose interval %d', current_interval)
-                _, interval_uid, signal_level = signals[current_interval]
-#                signal_level = event.get_current_signal_value(e, self.event_handler.ns_map)
+    def _evaluate_event(self, e, now):
+        '''
+        Find where an event is in its schedule at `now`.
 
-                logging.debug('Control loop: Evt ID: %s(%s); Interval: %s; Current Signal: %s',
-                        e_id, e_mod_num, interval_uid, signal_level )
-                
-                signal_level = float(signal_level) if signal_level is not None else 0
+        e -- An event.EventRecord, or an lxml.etree.ElementTree object w/ an
+             OpenADR Event structure
 
-                if signal_level > highest_signal_val:
-                    highest_signal_val = signal_level
-                    current_event_id = e_id
+        returns a 3-tuple of (event_id, signal_level, next_transition).
+            signal_level is None if the event is not active for us.
+            next_transition is the datetime when the event's interval changes
+            next, None if it won't, or False if the event has ended.
+        '''
+        record = e if isinstance(e, event.EventRecord) \
+                else event.parse_event(e, self.event_handler.ns_map)
+        e_id = record.event_id
+        e_mod_num = record.mod_number
 
-            except Exception as e:
-                logging.exception("Error parsing event: %s", e)
+        if not self.event_handler.check_target_info(record):
+            logging.debug("Ignoring event %s - no target match", e_id)
+            return e_id, None, None
 
-        return highest_signal_val, current_event_id, remove_events
+        signals = record.signals
+
+        if signals is None:
+            logging.debug("Ignoring event %s - no valid signals", e_id)
+            return e_id, None, None
+
+        logging.debug("All signals: %r", signals)
+        timeline = record.get_timeline()
+        current_interval = timeline.choose_interval( now )
+
+        if current_interval is None:
+            logging.debug("Event %s(%d) has ended", e_id, e_mod_num)
+            return e_id, None, False
+
+        next_transition = timeline.next_transition( now )
+
+        if current_interval < 0:
+            logging.debug("Event %s(%d) has not started yet.", e_id, e_mod_num)
+            return e_id, None, next_transition
+
+        logging.debug('---------- chose interval %d', current_interval)
+        _, interval_uid, signal_level = signals[current_interval]
+#        signal_level = event.get_current_signal_value(e, self.event_handler.ns_map)
+
+        logging.debug('Control loop: Evt ID: %s(%s); Interval: %s; Current Signal: %s',
+                e_id, e_mod_num, interval_uid, signal_level )
+        
+        signal_level = float(signal_level) if signal_level is not None else 0
+        return e_id, signal_level, next_transition
     
     
     def _update_signal_level(self, signal_level):
         '''
         Called once each control interval with the 'current' signal level.
         If the signal level has changed from `current_signal_level`, this 
-        calls `self.signal_changed_callback(current_signal_level, new_signal_level)`
-        and then sets `self.current_signal_level = new_signal_level`.
+        queues up `self.signal_changed_callback(current_signal_level, new_signal_level)`
+        on `dispatcher` and then sets `self.current_signal_level = new_signal_level`.
+        If the callback for an earlier change hasn't started yet, the two
+        are merged into one, so a slow relay only gets the latest level.
+        Signal level changes aren't dropped when the dispatcher's queue is
+        full; if it can't take the callback at all (i.e. it's closed),
+        `current_signal_level` is left alone so the change is tried again.
 
         signal_level -- If it is the same as the current signal level, the
                         function will exit.  Else, it will change the
                         signal relay
 
         returns True if the signal level has changed from the `current_signal_level`
-            or False if the signal level has not changed.
+            or False if the signal level has not changed (or couldn't be).
         '''
 
         # check if the current signal level is different from the new signal level
         if signal_level == self.current_signal_level:
             return False
 
-        try:
-            self.signal_changed_callback(self.current_signal_level, signal_level)
-        
-        except Exception as ex:
-            logging.exception("Error from callback! %s", ex)
+        if not self.dispatcher.submit(('signal_level', self), self.signal_changed_callback,
+                (self.current_signal_level, signal_level), merge=_merge_levels, force=True):
+            logging.warn("Couldn't queue up signal level change to %s, will retry", signal_level)
+            return False
 
         self.current_signal_level = signal_level
         return True
@@ -231,5 +658,165 @@ class EventController(object):
         '''
         self._exit.set()
         self._control_loop_signal.set()  # interrupt sleep
-        self.control_thread.join(2)
+        if self.engine is not None:
+            self.engine.remove(self)
+        if self.control_thread is not None:
+            self.control_thread.join(2)
+
+
+
+def _merge_levels(waiting, changed):
+    '''
+    Merge two (old_level, new_level) signal changes for the dispatcher.
+
+    Returns: (old_level, new_level) for both, or None if the level ends up
+        back where it started
+    '''
+
+    if waiting[0] == changed[1]:
+        return None
+    return waiting[0], changed[1]
+
+
+
+class VectorEvaluator(object):
+    '''
+    Finds where many events are in their schedules at once with numpy; the
+    same answers as `EventController._evaluate_event()`.  The interval
+    boundaries (as integer microseconds, so comparisons are exact) and
+    signal levels of each event are packed into arrays once per
+    (event_id, mod_number), and again if its intervals or levels change
+    without the mod_number going up.  Every event's boundaries are then laid end to
+    end, and counting the boundaries that have passed per event (with
+    `numpy.add.reduceat`) gives every current interval in one go.
+    '''
+
+    def __init__(self):
+        self._packed = {}   # (event_id, mod_number) -> _PackedEvent
+
+
+    def pack(self, record):
+        '''
+        Get the arrays for an event, which should be targeted at us & have
+        signals.
+
+        Returns: A _PackedEvent, or None if the event can't be vectorized
+            (its intervals aren't in order, or a signal level isn't a number)
+        '''
+        key = (record.event_id, record.mod_number)
+        timeline = record.get_timeline()
+        values = tuple(s[2] for s in record.signals)
+        packed = self._packed.get(key)
+        if packed is not None and packed.timeline is timeline and packed.values == values:
+            return packed
+
+        if not timeline.is_ordered():
+            return None
+
+        try:
+            levels = [float(s[2]) if s[2] is not None else 0 for s in record.signals]
+        except (TypeError, ValueError):
+            return None
+
+        if len(self._packed) >= schedule.TIMELINE_CACHE_SIZE:
+            self._packed.clear()
+
+        packed = _PackedEvent(record.event_id, timeline, values,
+                numpy.array([_to_micros(b) for b in timeline.boundaries], dtype=numpy.int64),
+                numpy.array(levels, dtype=numpy.float64))
+        self._packed[key] = packed
+        return packed
+
+
+    def prepare(self, packed_events):
+        '''
+        Lay the arrays of many events end to end, ready for `evaluate()`.
+
+        packed_events -- List of _PackedEvent from `pack()`
+
+        Returns: A _PackedBatch
+        '''
+        return _PackedBatch(packed_events)
+
+
+    def evaluate(self, batch, now):
+        '''
+        batch -- _PackedBatch from `prepare()`
+        now -- datetime (UTC) to evaluate the events at
+
+        returns a list of `EventController._evaluate_event()` 3-tuples, one for
+            each event in the batch
+        '''
+        if not batch.events:
+            return []
+
+        # Index of the first boundary after 'now' (or ending a 0 duration interval)
+        passed = numpy.add.reduceat(batch.boundaries <= _to_micros(now), batch.starts,
+                dtype=numpy.intp)
+        found = numpy.minimum(passed, batch.unending)
+
+        ended = found == batch.lengths
+        active = (found > 0) & ~ended
+        current_levels = batch.levels[numpy.where(active, batch.level_starts + found - 1, -1)]
+
+        return [(e_id, None, False) if is_ended else
+                (e_id, level if is_active else None,
+                    boundaries[i] if i != unending else None)
+                for e_id, boundaries, unending, i, is_ended, is_active, level in zip(
+                    batch.event_ids, batch.boundary_lists, batch.unending_list,
+                    found.tolist(), ended.tolist(), active.tolist(), current_levels.tolist())]
+
+
+class _PackedBatch(object):
+    '''
+    The arrays of many events laid end to end, for VectorEvaluator
+    '''
+
+    __slots__ = ('events', 'boundaries', 'levels', 'lengths', 'starts',
+                 'level_starts', 'unending', 'event_ids', 'boundary_lists',
+                 'unending_list')
+
+    def __init__(self, packed_events):
+        self.events = packed_events
+        if not packed_events:
+            return
+
+        # For building the results without going through each _PackedEvent
+        self.event_ids = [p.event_id for p in packed_events]
+        self.boundary_lists = [p.timeline.boundaries for p in packed_events]
+        self.unending_list = [p.unending for p in packed_events]
 
+        self.lengths = numpy.array([len(p.boundaries) for p in packed_events], dtype=numpy.intp)
+        self.unending = numpy.array([p.unending for p in packed_events], dtype=numpy.intp)
+        self.starts = numpy.zeros(len(packed_events), dtype=numpy.intp)
+        numpy.cumsum(self.lengths[:-1], out=self.starts[1:])
+
+        # Each event has one less level than boundaries.  The extra 0 at the
+        # end is looked up for the events that aren't active.
+        self.level_starts = self.starts - numpy.arange(len(packed_events))
+        self.boundaries = numpy.concatenate([p.boundaries for p in packed_events])
+        self.levels = numpy.concatenate([p.levels for p in packed_events] + [numpy.zeros(1)])
+
+
+class _PackedEvent(object):
+    '''
+    An event's arrays, for VectorEvaluator
+    '''
+
+    __slots__ = ('event_id', 'timeline', 'values', 'boundaries', 'levels', 'unending')
+
+    def __init__(self, event_id, timeline, values, boundaries, levels):
+        self.event_id = event_id
+        self.timeline = timeline
+        self.values = values        # the signal values the levels came from
+        self.boundaries = boundaries
+        self.levels = levels
+        self.unending = timeline.unending if timeline.unending is not None \
+                else len(boundaries)
+
+
+def _to_micros(dttm):
+    '''
+    Convert a (naive, UTC) datetime to integer microseconds since the epoch
+    '''
+    return calendar.timegm(dttm.utctimetuple()) * 1000000 + dttm.microsecond
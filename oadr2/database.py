@@ -2,33 +2,208 @@
 
 import logging
 import sqlite3
+import threading
+import zlib
 
 
 DEFAULT_DB_PATH = 'oadr2.db'
 
+# Run on every new connection.  WAL lets the control thread read while the
+# poll thread writes; with WAL, synchronous=NORMAL is still safe against
+# corruption (a power loss can only roll back the last commits).
+CONNECTION_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -4096',    # in KiB
+    'PRAGMA temp_store = MEMORY',
+)
+CONNECT_TIMEOUT = 10    # seconds to wait on a locked database
+
+# Columns of the event table, in the order event records are passed around in.
+# The last four are pulled out of the event when it is written, so the
+# schedule of the stored events can be seen without parsing them.  Times are
+# UTC seconds since the epoch; a NULL dtstart means the start is unknown and a
+# NULL end_time means the event doesn't end (or the end is unknown).
+EVENT_COLUMNS = ('vtn_id', 'event_id', 'mod_num', 'raw_xml',
+                 'status', 'dtstart', 'end_time', 'market_context')
+SCHEDULE_COLUMNS = (
+    ('status', 'VARCHAR'),
+    ('dtstart', 'REAL'),
+    ('end_time', 'REAL'),
+    ('market_context', 'VARCHAR'),
+)
+# The schedule columns used to be indexed, for looking up active events in
+# SQL; the EventHandler answers those from memory now, so the indexes would
+# only slow down writes.  Dropped from databases that still have them.
+DROP_SCHEDULE_INDEXES = '''
+    DROP INDEX IF EXISTS idx_event_dtstart;
+    DROP INDEX IF EXISTS idx_event_end_time;
+    DROP INDEX IF EXISTS idx_event_status;
+    DROP INDEX IF EXISTS idx_event_market_context;
+'''
+REPLACE_EVENT_SQL = 'REPLACE INTO event(%s) VALUES(%s)' % (
+        ', '.join(EVENT_COLUMNS), ', '.join('?' * len(EVENT_COLUMNS)))
+
+# Replies waiting to be sent to the VTN (see poll.ReplySender), so they
+# aren't lost if the VEN is restarted.  Made in any database that doesn't
+# have it yet.
+REPLY_TABLE = '''
+    CREATE TABLE IF NOT EXISTS reply (
+        id INTEGER PRIMARY KEY,
+        uri VARCHAR NOT NULL,
+        body TEXT NOT NULL,
+        attempts INT NOT NULL DEFAULT 0
+    );
+'''
+
+
+# Storage codecs for the raw_xml column.  With CODEC_PLAIN events are stored as
+# TEXT, like they always have been.  With CODEC_ZLIB events of at least
+# ZLIB_MIN_SIZE bytes are stored as a BLOB of a format byte followed by the
+# zlib compressed XML; smaller ones are still stored as TEXT.  Either way, rows
+# written with any codec can be read back by any DBHandler.
+CODEC_PLAIN = 'plain'
+CODEC_ZLIB = 'zlib'
+CODECS = (CODEC_PLAIN, CODEC_ZLIB)
+FORMAT_ZLIB = '\x01'
+ZLIB_LEVEL = 6
+ZLIB_MIN_SIZE = 512
+
+
+# Encode an event's XML for the raw_xml column
+#
+# raw_xml - XML string for the event
+# codec - One of CODECS
+def encode_xml(raw_xml, codec=CODEC_PLAIN):
+    if codec == CODEC_ZLIB and len(raw_xml) >= ZLIB_MIN_SIZE:
+        if isinstance(raw_xml, unicode):
+            raw_xml = raw_xml.encode('utf-8')
+        return sqlite3.Binary(FORMAT_ZLIB + zlib.compress(raw_xml, ZLIB_LEVEL))
+    return raw_xml
+
+
+# Decode a value of the raw_xml column, no matter what codec wrote it
+#
+# Returns: An XML string
+def decode_xml(value):
+    if value is None or isinstance(value, basestring):
+        return value    # stored as TEXT
+
+    value = str(value)
+    if value[:1] == FORMAT_ZLIB:
+        return zlib.decompress(value[1:])
+    raise ValueError('Unknown event storage format: %r' % value[:1])
+
+
+# Fill in the schedule columns of a short (4 value) event record with NULLs
+def _full_record(record):
+    return tuple(record) + (None,) * (len(EVENT_COLUMNS) - len(record))
+
 
 class DBHandler(object):
     # Member varialbes:
     # --------
     # db_path
+    # _local - threading.local() holding each thread's connection
+    # _connections - All of the open connections (so close() can get to them)
+    # _conn_lock - Guards _connections
+    # migrated - True if the schedule columns were just added to an older
+    #            database, and so need to be filled in
+    # codec - How new events are stored (one of CODECS)
 
 
     # The following is a list of which functions relate to which class/handler/module.
     # --------
     # EventHandler (event.py):
     #   get_active_events()
+    #   get_event_index()
     #   update_all_events()
     #   update_event()
     #   get_event()
     #   remove_events()
+    #   update_event_columns()
+    #   batch()
+    #   commit_batch()
+    #
+    # ReplySender (poll.py):
+    #   add_reply()
+    #   get_replies()
+    #   update_reply()
+    #   remove_reply()
 
     
     # Intilize the handler
     #
     # db_path - Path to where the database is located
-    def __init__(self, db_path=DEFAULT_DB_PATH):
+    # codec - How to store the XML of new events (one of CODECS)
+    def __init__(self, db_path=DEFAULT_DB_PATH, codec=CODEC_PLAIN):
+        if codec not in CODECS:
+            raise ValueError( "Unknown storage codec: %s" % codec )
+
         self.db_path = db_path
+        self.codec = codec
+        self._local = threading.local()
+        self._connections = []
+        self._conn_lock = threading.Lock()
+        self.migrated = False
         self.init_database()
+
+
+    # Gets the calling thread's connection, opening it the first time.  Each
+    # thread keeps its connection open until close() is called.
+    #
+    # Returns: A sqlite3.Connection
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            return conn
+
+        # check_same_thread is off only so that close() can be called from
+        # another thread; a connection is never shared between threads.
+        conn = sqlite3.connect(self.db_path, timeout=CONNECT_TIMEOUT,
+                check_same_thread=False)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+
+        self._local.conn = conn
+        with self._conn_lock:
+            self._connections.append(conn)
+        logging.debug('Opened connection to `%s` for thread %s',
+                self.db_path, threading.current_thread().name)
+        return conn
+
+
+    # Closes the calling thread's connection, if it has one; for threads that
+    # come and go (e.g. one per request), so their connections don't pile up.
+    # The thread gets a new connection if it uses the handler again.
+    def release(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            return
+
+        self._local.conn = None
+        with self._conn_lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+        try:
+            conn.close()
+        except Exception as ex:
+            logging.warn('Error closing connection to `%s`: %s', self.db_path, ex)
+
+
+    # Closes all of the open connections.  A thread that uses the handler
+    # after this gets a new connection.
+    def close(self):
+        with self._conn_lock:
+            connections, self._connections = self._connections, []
+            self._local = threading.local()
+
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as ex:
+                logging.warn('Error closing connection to `%s`: %s', self.db_path, ex)
+        logging.debug('Closed %d connections to `%s`', len(connections), self.db_path)
         
 
     # Builds the databse, only if it doesn't already exist
@@ -37,12 +212,18 @@ class DBHandler(object):
         if self.db_path is None or '':
             raise ValueError( "Database path cannot be empty" )
 
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         c = conn.cursor()
+        c.executescript(REPLY_TABLE)
+
         # verify if the table already exists:
         c.execute("pragma table_info('event')")
-        if c.fetchone() is not None:
+        columns = [row[1] for row in c.fetchall()]
+        if columns:
             logging.debug('Database `%s` is setup.', self.db_path)
+            c.executescript(DROP_SCHEDULE_INDEXES)
+            c.close()
+            self._migrate(columns)
             return # table exists.
     
         try:
@@ -56,7 +237,11 @@ class DBHandler(object):
                     vtn_id VARCHAR NOT NULL,
                     event_id VARCHAR NOT NULL,
                     mod_num INT NOT NULL DEFAULT 0,
-                    raw_xml TEXT NOT NULL
+                    raw_xml TEXT NOT NULL,
+                    status VARCHAR,
+                    dtstart REAL,
+                    end_time REAL,
+                    market_context VARCHAR
                 );
                 CREATE UNIQUE INDEX idx_event_vtn_id ON event (
                     vtn_id, event_id
@@ -70,7 +255,43 @@ class DBHandler(object):
             conn.rollback()
         finally:
             c.close()
-            conn.close()
+
+
+    # Adds the schedule columns to a database made by an
+    # older version.  Sets `migrated` so the caller knows to fill them in.
+    #
+    # columns - Names of the columns the event table has now
+    def _migrate(self, columns):
+        missing = [(name, sql_type) for name, sql_type in SCHEDULE_COLUMNS
+                   if name not in columns]
+        if not missing:
+            return
+
+        conn = self._connect()
+        c = conn.cursor()
+
+        try:
+            for name, sql_type in missing:
+                c.execute('ALTER TABLE event ADD COLUMN %s %s' % (name, sql_type))
+            conn.commit()
+            self.migrated = True
+            logging.info('Added columns %s to the event table of `%s`',
+                    [name for name, sql_type in missing], self.db_path)
+
+        except Exception as ex:
+            logging.exception('Error migrating database `%s`: %s', self.db_path, ex)
+            conn.rollback()
+            raise
+        finally:
+            c.close()
+
+
+
+    # Gets an event record ready to be written: encodes the XML with the
+    # handler's codec and fills in any missing schedule columns with NULLs
+    def _encode_record(self, record):
+        record = _full_record(record)
+        return record[:3] + (encode_xml(record[3], self.codec),) + record[4:]
 
 
 
@@ -81,28 +302,47 @@ class DBHandler(object):
     # Returns: An empty dictionary or a dictionary following the pattern:
     #           dict['event_id'] = '<xml>blob_for_event</xml>'
     def get_active_events(self):
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         c = conn.cursor()
     
         try:
             c.execute('SELECT event_id, raw_xml FROM event')
 
             # key= event_id, val= xml blob
-            return {_id: blob for _id, blob in c.fetchall()}
+            return {_id: decode_xml(blob) for _id, blob in c.fetchall()}
         except Exception as ex:
             logging.exception('Error getting active events! %s', ex)
             raise
         finally:
             c.close()
-            conn.close()
+
+
+    # Gets the event ID, VTN ID and modification number of every stored event
+    #
+    # Returns: An empty dictionary or a dictionary following the pattern:
+    #           dict['event_id'] = ('vtn_id', MOD_NUM(integer))
+    def get_event_index(self):
+        conn = self._connect()
+        c = conn.cursor()
+
+        try:
+            c.execute('SELECT event_id, vtn_id, mod_num FROM event')
+            return {_id: (vtn_id, mod_num) for _id, vtn_id, mod_num in c.fetchall()}
+        except Exception as ex:
+            logging.exception('Error getting the event index! %s', ex)
+            raise
+        finally:
+            c.close()
 
         
     # Clears our the current event table and shoves in new ones
     #
     # records - A list of tuples with the folowing format:
-    #             ('vtn_id', 'event_id', MOD_NUM(integer), '<xml>for_event</xml>')
+    #             ('vtn_id', 'event_id', MOD_NUM(integer), '<xml>for_event</xml>',
+    #              'status', DTSTART, END_TIME, 'market_context')
+    #           The last four values (see EVENT_COLUMNS) may be left off.
     def update_all_events(self, records):
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         c = conn.cursor()
     
         try:
@@ -111,8 +351,7 @@ class DBHandler(object):
             logging.debug('Wiped the event table to update all of the events')
 
             # Insert them into the database
-            c.executemany('''Insert INTO event(vtn_id, event_id, mod_num, raw_xml)
-                    VALUES(?, ?, ?, ?)''', records)
+            c.executemany(REPLACE_EVENT_SQL, [self._encode_record(r) for r in records])
             logging.debug('Inserted the new events into the database')
             conn.commit()
 
@@ -122,7 +361,6 @@ class DBHandler(object):
             raise
         finally:
             c.close()
-            conn.close()
 
 
     # Updates an existing event, or inserts a new one
@@ -131,14 +369,17 @@ class DBHandler(object):
     # mod_num - Current modification number of event  (must be an integer)
     # raw_xml - Raw XML data for event
     # vtn_id - ID of issuing VTN
-    def update_event(self, e_id, mod_num, raw_xml, vtn_id):
-        conn = sqlite3.connect(self.db_path)
+    # status, dtstart, end_time, market_context - Schedule columns (see EVENT_COLUMNS)
+    def update_event(self, e_id, mod_num, raw_xml, vtn_id,
+                     status=None, dtstart=None, end_time=None, market_context=None):
+        conn = self._connect()
         c = conn.cursor()
 
         try:
             # Insert it into the database (or update it)
-            c.execute('''REPLACE INTO event(vtn_id, event_id, mod_num, raw_xml)
-                    VALUES(?, ?, ?, ?)''', (vtn_id, e_id, mod_num, raw_xml))
+            c.execute(REPLACE_EVENT_SQL, (vtn_id, e_id, mod_num,
+                    encode_xml(raw_xml, self.codec),
+                    status, dtstart, end_time, market_context))
             conn.commit()
             logging.debug('Inserted/updated event_id [%s]', e_id)
 
@@ -148,7 +389,6 @@ class DBHandler(object):
             raise
         finally:
             c.close()
-            conn.close()
 
     
     # Gets an event for us
@@ -156,21 +396,20 @@ class DBHandler(object):
     # event_id - ID of event
     # Returns: None on failure, or xml blob
     def get_event(self, event_id):
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         c = conn.cursor()
     
         try:
             # Run the SELECT and see if we got a result
             c.execute('SELECT raw_xml FROM event WHERE event_id=?', (event_id,))
             row = c.fetchone()
-            return row[0] if row else None
+            return decode_xml(row[0]) if row else None
 
         except Exception as ex:
             logging.error('Error getting event ID [%s]: %s', event_id, ex)
             raise
         finally:
             c.close()
-            conn.close()
 
 
     # Remove a list of events
@@ -181,7 +420,7 @@ class DBHandler(object):
         if not event_ids:
             return
 
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         c = conn.cursor()
 
         # Convert them to tuples
@@ -202,6 +441,203 @@ class DBHandler(object):
 
         finally:
             c.close()
-            conn.close()
 
 
+    # Fills in the schedule columns of events that are already stored
+    #
+    # rows - A list of tuples with the folowing format:
+    #           ('event_id', 'status', DTSTART, END_TIME, 'market_context')
+    def update_event_columns(self, rows):
+        conn = self._connect()
+        c = conn.cursor()
+
+        try:
+            c.executemany('''UPDATE event SET status=?, dtstart=?, end_time=?, market_context=?
+                    WHERE event_id=?''', [tuple(row[1:]) + (row[0],) for row in rows])
+            conn.commit()
+            logging.debug('Updated the columns of %d events', len(rows))
+
+        except Exception as ex:
+            logging.error('Error updating event columns: %s', ex)
+            conn.rollback()
+            raise
+        finally:
+            c.close()
+
+
+    # Starts a unit of work for event changes.  Nothing is written until
+    # the batch's commit() is called.
+    #
+    # Returns: An EventBatch
+    def batch(self):
+        return EventBatch(self)
+
+
+    # Applies a set of upserts and deletes in a single transaction
+    #
+    # records - A list of event records, like for update_all_events()
+    # event_ids - List of event IDs to remove
+    def commit_batch(self, records, event_ids):
+        if not records and not event_ids:
+            return
+
+        conn = self._connect()
+        c = conn.cursor()
+
+        try:
+            if records:
+                c.executemany(REPLACE_EVENT_SQL, [self._encode_record(r) for r in records])
+            if event_ids:
+                c.executemany('DELETE FROM event WHERE event_id=?',
+                        [(e_id,) for e_id in event_ids])
+            conn.commit()
+            logging.debug('Inserted/updated %d and removed %d events',
+                    len(records), len(event_ids))
+
+        except Exception as ex:
+            logging.error('Error committing event batch: %s', ex)
+            conn.rollback()
+            raise
+        finally:
+            c.close()
+
+
+
+
+    ### ReplySender related functions ###
+
+    # Spools a reply to be sent
+    #
+    # uri - Where to send it
+    # body - The payload, an XML string
+    # Returns: ID of the spooled reply
+    def add_reply(self, uri, body):
+        conn = self._connect()
+        c = conn.cursor()
+
+        try:
+            c.execute('INSERT INTO reply(uri, body) VALUES(?, ?)', (uri, body))
+            conn.commit()
+            return c.lastrowid
+
+        except Exception as ex:
+            logging.error('Error spooling reply: %s', ex)
+            conn.rollback()
+            raise
+        finally:
+            c.close()
+
+
+    # Gets all of the spooled replies, oldest first
+    #
+    # Returns: A list of (ID, 'uri', '<xml>body</xml>', ATTEMPTS) tuples
+    def get_replies(self):
+        conn = self._connect()
+        c = conn.cursor()
+
+        try:
+            c.execute('SELECT id, uri, body, attempts FROM reply ORDER BY id')
+            return c.fetchall()
+        except Exception as ex:
+            logging.exception('Error getting spooled replies! %s', ex)
+            raise
+        finally:
+            c.close()
+
+
+    # Records another failed attempt at sending a spooled reply
+    #
+    # reply_id - ID from add_reply()
+    # attempts - How many times it has been tried
+    def update_reply(self, reply_id, attempts):
+        conn = self._connect()
+        c = conn.cursor()
+
+        try:
+            c.execute('UPDATE reply SET attempts=? WHERE id=?', (attempts, reply_id))
+            conn.commit()
+
+        except Exception as ex:
+            logging.error('Error updating spooled reply [%s]: %s', reply_id, ex)
+            conn.rollback()
+            raise
+        finally:
+            c.close()
+
+
+    # Removes a spooled reply, once it's been sent (or given up on)
+    #
+    # reply_id - ID from add_reply()
+    def remove_reply(self, reply_id):
+        conn = self._connect()
+        c = conn.cursor()
+
+        try:
+            c.execute('DELETE FROM reply WHERE id=?', (reply_id,))
+            conn.commit()
+
+        except Exception as ex:
+            logging.error('Error removing spooled reply [%s]: %s', reply_id, ex)
+            conn.rollback()
+            raise
+        finally:
+            c.close()
+
+
+
+class EventBatch(object):
+    # Collects the event upserts and deletes from one payload, so they can be
+    # applied with DBHandler.commit_batch() in one transaction.  A later change
+    # to the same event ID replaces an earlier one.
+    #
+    # Member varialbes:
+    # --------
+    # db
+    # updates - dict['event_id'] = event record (see EVENT_COLUMNS)
+    # removes - set of event IDs
+
+
+    # db - The DBHandler to commit to
+    def __init__(self, db):
+        self.db = db
+        self.updates = {}
+        self.removes = set()
+
+
+    # Same arguments as DBHandler.update_event()
+    def update_event(self, e_id, mod_num, raw_xml, vtn_id,
+                     status=None, dtstart=None, end_time=None, market_context=None):
+        self.removes.discard(e_id)
+        self.updates[e_id] = (vtn_id, e_id, mod_num, raw_xml,
+                              status, dtstart, end_time, market_context)
+
+
+    # Same arguments as DBHandler.remove_events()
+    def remove_events(self, event_ids):
+        for e_id in event_ids:
+            self.updates.pop(e_id, None)
+            self.removes.add(e_id)
+
+
+    # (vtn_id, mod_num) of an event waiting to be stored, or None
+    def get_pending(self, e_id):
+        update = self.updates.get(e_id)
+        if update is None:
+            return None
+        return (update[0], update[2])
+
+
+    # dict['event_id'] = (vtn_id, mod_num) of every event waiting to be stored
+    def pending_index(self):
+        return dict((e_id, (u[0], u[2])) for e_id, u in self.updates.iteritems())
+
+
+    # Write everything out and start over with an empty batch
+    def commit(self):
+        self.db.commit_batch(self.updates.values(), list(self.removes))
+        self.updates = {}
+        self.removes = set()
+
+
+    def __len__(self):
+        return len(self.updates) + len(self.removes)
@@ -0,0 +1,266 @@
+# Runs callbacks (i.e. ones that talk to hardware) off of the control & poll threads
+
+import collections
+import logging
+import threading
+import time
+
+
+DISPATCH_WORKERS = 1            # threads to run callbacks on; 0 to run them inline
+DISPATCH_QUEUE_SIZE = 256       # most callbacks waiting to run, past this they are dropped
+                                # (unless they are submitted with `force`)
+DISPATCH_CLOSE_TIMEOUT = 5      # seconds to wait for the queue to drain on close()
+
+
+
+class Dispatcher(object):
+    '''
+    Runs callbacks on a pool of worker threads, so a slow callback can't hold
+    up the thread that submitted it.
+
+    Every callback is submitted under a key.  Callbacks with the same key are
+    run one at a time in the order they were submitted, callbacks with
+    different keys can run at the same time (if there is more than one
+    worker).  A callback can also be merged into the one still waiting to run
+    ahead of it with the same key; e.g. only the latest of a few quick signal
+    level changes needs to be sent to a relay.
+
+    Member Variables:
+    --------
+    workers -- List of threading.Thread() objects w/ name of 'oadr2.dispatch'
+    max_queue -- Most callbacks that can be waiting to run
+    stats -- dict of counters, see `get_stats()`
+    _pending -- dict of key -> collections.deque of _Task, waiting to run
+    _ready -- collections.deque of keys with callbacks that can run now
+    _running -- set of keys with a callback running right now
+    _queued -- Number of callbacks waiting to run
+    _lock -- threading.Condition() guarding all of the above
+    _closed -- Set once `close()` is called; nothing more can be submitted
+    --------
+    '''
+
+    def __init__(self, workers=DISPATCH_WORKERS, max_queue=DISPATCH_QUEUE_SIZE):
+        '''
+        Start up the worker threads
+
+        workers -- How many threads to run callbacks on.  With 0 callbacks are
+                   run right away on the submitting thread.
+        max_queue -- Most callbacks that can be waiting to run
+        '''
+
+        self.max_queue = max_queue
+        self.stats = dict.fromkeys(('submitted', 'coalesced', 'dropped', 'completed',
+                'errors', 'max_queued', 'callback_time', 'max_callback_time',
+                'max_wait_time'), 0)
+
+        self._pending = {}
+        self._ready = collections.deque()
+        self._running = set()
+        self._queued = 0
+        self._lock = threading.Condition()
+        self._closed = False
+
+        self.workers = []
+        for i in xrange(workers):
+            worker = threading.Thread(name='oadr2.dispatch', target=self._work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+
+    def submit(self, key, func, args=(), merge=None, force=False):
+        '''
+        Queue up `func(*args)` to be run after the callbacks already submitted
+        with the same key.
+
+        key -- Callbacks with the same key are run in order, one at a time
+        func -- The callback
+        args -- tuple of arguments for the callback
+        merge -- Optional function of `merge(waiting_args, args)`.  If the
+                 last callback waiting with this key is `func` (and also
+                 has a merge function), it is run with the arguments this
+                 returns instead of queuing up another one.  If it returns
+                 None, the waiting callback is dropped.
+        force -- Queue it even if the queue is full; for callbacks that can't
+                 be lost, like signal level changes (which are merged, so
+                 they only ever take up one spot per key)
+
+        Returns: True if the callback was queued (or merged), False if the
+            queue is full or the dispatcher has been closed.
+        '''
+
+        if not self.workers:
+            self._run(func, args, time.time())
+            return True
+
+        with self._lock:
+            if self._closed:
+                logging.warn('Dispatcher is closed, dropping callback for %s', key)
+                return False
+
+            tasks = self._pending.get(key)
+            if merge is not None and tasks and tasks[-1].func == func \
+                    and tasks[-1].merge is not None:
+                self.stats['coalesced'] += 1
+                merged = merge(tasks[-1].args, args)
+                if merged is not None:
+                    tasks[-1].args = merged
+                    return True
+
+                # The changes cancelled each other out
+                tasks.pop()
+                self._queued -= 1
+                if not tasks:
+                    del self._pending[key]
+                    if key in self._ready:
+                        self._ready.remove(key)
+                return True
+
+            if self._queued >= self.max_queue and not force:
+                self.stats['dropped'] += 1
+                logging.warn('Dispatch queue is full, dropping callback for %s', key)
+                return False
+
+            if tasks is None:
+                tasks = self._pending[key] = collections.deque()
+                if key not in self._running:
+                    self._ready.append(key)
+            tasks.append(_Task(func, args, merge, time.time()))
+
+            self._queued += 1
+            self.stats['submitted'] += 1
+            self.stats['max_queued'] = max(self.stats['max_queued'], self._queued)
+            self._lock.notify()
+
+        return True
+
+
+    def get_stats(self):
+        '''
+        Get a snapshot of how the dispatcher has been doing.
+
+        Returns: A dict of:
+            queued -- callbacks waiting to run right now
+            max_queued -- the most there have ever been waiting
+            submitted, coalesced, dropped, completed, errors -- callback counts
+            callback_time -- total seconds spent in callbacks
+            max_callback_time -- the longest a callback has taken (seconds)
+            max_wait_time -- the longest a callback has waited to run (seconds)
+        '''
+
+        with self._lock:
+            stats = dict(self.stats)
+            stats['queued'] = self._queued
+        return stats
+
+
+    def join(self, timeout=None):
+        '''
+        Wait for all of the callbacks submitted so far to finish.
+
+        timeout -- Most seconds to wait, or None to wait as long as it takes
+
+        Returns: True if they all finished, False if it timed out
+        '''
+
+        end = time.time() + timeout if timeout is not None else None
+        with self._lock:
+            while self._queued or self._running:
+                remaining = end - time.time() if end is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+        return True
+
+
+    def close(self, timeout=DISPATCH_CLOSE_TIMEOUT):
+        '''
+        Stop taking callbacks, and stop the workers once the ones already
+        queued have run.
+
+        timeout -- Most seconds to wait for the workers
+        '''
+
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+
+        end = time.time() + timeout
+        for worker in self.workers:
+            worker.join(max(end - time.time(), 0))
+
+
+    def _work(self):
+        '''
+        A worker thread; runs callbacks until the dispatcher is closed and
+        there are none left.
+        '''
+
+        while True:
+            with self._lock:
+                while not self._ready and not (self._closed and not self._pending):
+                    self._lock.wait()
+                if not self._ready:
+                    return      # closed & drained
+
+                key = self._ready.popleft()
+                tasks = self._pending[key]
+                task = tasks.popleft()
+                if not tasks:
+                    del self._pending[key]
+                self._queued -= 1
+                self._running.add(key)
+
+            self._run(task.func, task.args, task.submitted)
+
+            with self._lock:
+                self._running.discard(key)
+                if key in self._pending:
+                    self._ready.append(key)
+                self._lock.notify_all()
+
+
+    def _run(self, func, args, submitted):
+        '''
+        Run one callback, keeping track of how long it took.
+        '''
+
+        start = time.time()
+        try:
+            func(*args)
+            error = False
+        except Exception as ex:
+            logging.exception("Error from callback! %s", ex)
+            error = True
+        end = time.time()
+
+        with self._lock:
+            stats = self.stats
+            stats['completed'] += 1
+            stats['errors'] += error
+            stats['callback_time'] += end - start
+            stats['max_callback_time'] = max(stats['max_callback_time'], end - start)
+            stats['max_wait_time'] = max(stats['max_wait_time'], start - submitted)
+
+
+
+class _Task(object):
+    '''
+    A callback waiting to run.
+
+    Member Variables:
+    --------
+    func -- The callback
+    args -- tuple of arguments for it
+    merge -- Function to merge another callback's arguments into this one
+    submitted -- time.time() when it was submitted
+    --------
+    '''
+
+    __slots__ = ('func', 'args', 'merge', 'submitted')
+
+    def __init__(self, func, args, merge, submitted):
+        self.func = func
+        self.args = args
+        self.merge = merge
+        self.submitted = submitted
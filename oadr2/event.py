@@ -4,12 +4,15 @@
 
 __author__ = "Thom Nichols <tnichols@enernoc.com>, Ben Summerton <bsummerton@enernoc.com>"
 
+import copy
 import uuid
 import logging
+import time
+import threading
 from lxml import etree
 from lxml.builder import ElementMaker, E
 
-import schedule, database
+import schedule, database, dispatch
 
 
 # Stuff for the 2.0a spec of OpenADR
@@ -81,12 +84,26 @@ class EventHandler(object):
     group_id -- ID of group that VEN belogns to
     resource_id -- ID of resource in VEN we want to manipulate
     party_id -- ID of the party we are party of
+    db -- The database.DBHandler where events are stored
+    dispatcher -- The dispatch.Dispatcher callbacks are run on
+    _own_dispatcher -- True if the handler started `dispatcher` itself
+    _event_index -- Dictionary of {event_id: (vtn_id, mod_num)} for every
+                    stored event, kept in sync with `db`
+    _event_cache -- Dictionary of {event_id: CachedEvent} for every stored
+                    event, or None until it is first needed.  Written through
+                    on every change, so reads never have to go to `db`.
+    _cache_lock -- threading.RLock() guarding `_event_cache`
+    cache_version -- Goes up every time the stored events change, so other
+                     things worked out from the events know to start over
     '''
     
     def __init__(self, ven_id, vtn_ids=None, market_contexts=None,
                  group_id=None, resource_id=None, party_id=None,
                  oadr_profile_level=OADR_PROFILE_20A,
-                 event_callback=None):
+                 event_callback=None,
+                 db_path=database.DEFAULT_DB_PATH,
+                 db_codec=database.CODEC_PLAIN,
+                 dispatcher=None):
         '''
         Class constructor
 
@@ -102,6 +119,14 @@ class EventHandler(object):
            each parameter will be passed a dict in the form `{event_id, event_etree}`
            where `oadr:oadrEvent` is the root element.  You can use functions defined
            in the `event` module to pick out individual values from each event.
+           The callback gets its own copies of the events, so it can change them.
+           It is never dropped, however many callbacks are waiting to run.
+        db_path -- Path to the SQLite database events are stored in
+        db_codec -- How events are stored in the database; one of
+           `database.CODECS`.  `database.CODEC_ZLIB` compresses them.
+        dispatcher -- A dispatch.Dispatcher to run `event_callback` (and the
+           EventController's callback) on.  By default the handler starts
+           its own, which is stopped by `close()`.
         '''
 
         # 'vtn_ids' is a CSV string of 
@@ -122,6 +147,10 @@ class EventHandler(object):
 
         self.event_callback = event_callback
 
+        # Callbacks are run here, so a slow one doesn't hold up polling
+        self._own_dispatcher = dispatcher is None
+        self.dispatcher = dispatcher if dispatcher is not None else dispatch.Dispatcher()
+
         # the default profile is '2.0a'; do this to set the ns_map
         self.oadr_profile_level = oadr_profile_level
         if self.oadr_profile_level == OADR_PROFILE_20A:
@@ -133,7 +162,19 @@ class EventHandler(object):
             self.oadr_profile_level = OADR_PROFILE_20A
             self.ns_map = NS_A      
 
-        self.db = database.DBHandler()
+        self.db = database.DBHandler(db_path, db_codec)
+
+        # Fill in the schedule columns of a database from an older version
+        if self.db.migrated:
+            self._update_event_columns()
+
+        # Lets us skip over unchanged events without going to the database
+        self._event_index = self.db.get_event_index()
+
+        # The control thread reads events from here (see `_load_cache()`)
+        self._event_cache = None
+        self._cache_lock = threading.RLock()
+        self.cache_version = 0
 
 
     def handle_payload(self, payload):
@@ -145,9 +186,6 @@ class EventHandler(object):
         Returns: An lxml.etree.Element object; which should be used as a response payload
         '''
 
-        reply_events = []
-        all_events = []
-
         requestID = payload.findtext('pyld:requestID',namespaces=self.ns_map)
         vtnID = payload.findtext('ei:vtnID',namespaces=self.ns_map)
 
@@ -157,99 +195,252 @@ class EventHandler(object):
             logging.warn("Unexpected VTN ID: %s, expected one of %r", vtnID, self.vtn_ids)
             return self.build_error_response( requestID, '400', 'Unknown vtnID: %s'% vtnID )
 
-        updated_events={}
+        reply_events = []
+        all_events = set()
+        updated_events = {}
+        cached_events = {}
+        batch = self.db.batch()     # all database changes go in one transaction
 
         # Loop through all of the oadr:oadrEvent 's in the payload
         for evt in payload.iterfind('oadr:oadrEvent',namespaces=self.ns_map):
-            response_required = evt.findtext("oadr:oadrResponseRequired",namespaces=self.ns_map)
-            evt = evt.find('ei:eiEvent',namespaces=self.ns_map) # go to nested eiEvent
+            self._handle_event(evt, requestID, vtnID,
+                    reply_events, all_events, updated_events, batch, cached_events)
+
+        return self._finish_payload(reply_events, all_events, updated_events,
+                batch, cached_events)
+
+
+    def handle_payload_stream(self, source):
+        '''
+        Handle a payload as it is being read.  This works like `handle_payload()`,
+        but uses `lxml.etree.iterparse` to handle each oadr:oadrEvent as soon as
+        it has been parsed, then frees it.  Only the events that are passed to
+        `event_callback` are kept around, so if no callback is set the memory
+        used is bounded by the size of a single event.  (The event cache only
+        gets the parsed EventRecord of each event, not its tree.)
+
+        source -- A file-like object (or file name) with an
+                  oadr:oadrDistributeEvent as root node
+
+        Returns: An lxml.etree.Element object; which should be used as a response payload
+        '''
+
+        request_tag = '{%s}requestID' % self.ns_map['pyld']
+        vtn_tag = '{%s}vtnID' % self.ns_map['ei']
+        event_tag = '{%s}oadrEvent' % self.ns_map['oadr']
+
+        requestID = None
+        vtnID = None
+        vtn_checked = False
+
+        reply_events = []
+        all_events = set()
+        updated_events = {}
+        keep_events = updated_events if self.event_callback is not None else None
+        cached_events = {}
+        batch = self.db.batch()     # all database changes go in one transaction
+
+        context = etree.iterparse(source, events=('end',),
+                tag=(request_tag, vtn_tag, event_tag))
+
+        for _, elem in context:
+            # Only look at direct children of the oadr:oadrDistributeEvent
+            parent = elem.getparent()
+            if parent is None or parent.getparent() is not None:
+                continue
+
+            if elem.tag == request_tag:
+                requestID = elem.text
+                continue
+
+            if elem.tag == vtn_tag:
+                vtnID = elem.text
+                continue
+
+            # pyld:requestID & ei:vtnID come before any events
+            if not vtn_checked:
+                if self.vtn_ids and (vtnID not in self.vtn_ids):
+                    break
+                vtn_checked = True
+
+            self._handle_event(elem, requestID, vtnID,
+                    reply_events, all_events, keep_events, batch, cached_events,
+                    keep_tree=False)
+
+            # Free the event (and anything before it) now that we're done
+            elem.clear()
+            while elem.getprevious() is not None:
+                del parent[0]
+
+        del context
+
+        if not vtn_checked and self.vtn_ids and (vtnID not in self.vtn_ids):
+            logging.warn("Unexpected VTN ID: %s, expected one of %r", vtnID, self.vtn_ids)
+            return self.build_error_response( requestID, '400', 'Unknown vtnID: %s'% vtnID )
+
+        return self._finish_payload(reply_events, all_events, updated_events,
+                batch, cached_events)
+
+
+    def _handle_event(self, evt, requestID, vtnID,
+                      reply_events, all_events, updated_events, batch,
+                      cached_events, keep_tree=True):
+        '''
+        Handle a single event from a payload.  Called by `handle_payload()`
+        and `handle_payload_stream()`.
+
+        evt -- An lxml.etree.Element object of oadr:oadrEvent
+        requestID -- pyld:requestID of the payload
+        vtnID -- ei:vtnID of the payload
+        reply_events -- List to append (Event ID, Modification Number,
+                        Request ID, Opt, Status) reply tuples to
+        all_events -- Set to add the Event ID to
+        updated_events -- Dictionary to put new or updated events in; or None
+                          if they don't need to be kept
+        batch -- database.EventBatch to put new or updated events in
+        cached_events -- Dictionary to put the CachedEvent of new or updated
+                         events in, for the event cache
+        keep_tree -- If False, the event cache doesn't hold on to `evt`
+        '''
+
+        response_required = evt.findtext("oadr:oadrResponseRequired",namespaces=self.ns_map)
+        evt = evt.find('ei:eiEvent',namespaces=self.ns_map) # go to nested eiEvent
+        try:
+            record = parse_event(evt, self.ns_map)
+        except ValueError as ex:
+            # e.g. a malformed date-time; the rest of the payload is still
+            # handled, and an older version of the event (if any) is kept
             e_id = get_event_id(evt, self.ns_map)
-            e_mod_num = get_mod_number(evt, self.ns_map)
-            e_status = get_status(evt, self.ns_map)
-            e_market_context = get_market_context(evt, self.ns_map)
-            current_signal_val = get_current_signal_value(evt, self.ns_map)
+            logging.warn("Opting out of event %s - unable to parse it: %s", e_id, ex)
+            all_events.add(e_id)
+            reply_events.append((e_id, _findtext(evt, 'mod_number', self.ns_map),
+                    requestID, 'optOut', '400'))
+            return
 
-            logging.debug('------ EVENT ID: %s(%s); Status: %s; Current Signal: %s',
-                    e_id, e_mod_num, e_status, current_signal_val)
-            
-            all_events.append(e_id)
-            old_event = self.get_event(e_id)
-            old_mod_num = None
-            
-            if old_event is not None:                                   # If there is an older event
-                old_mod_num = get_mod_number(old_event, self.ns_map)    # get it's mod number
-
-            # For the events we need to reply to, make our "opts," and check the status of the event
-            if (old_event is None) or (e_mod_num > old_mod_num) or (response_required == 'always'):
-                # By default, we optIn and have an "OK," status (200)
-                opt = 'optIn'
-                status = '200'
-
-                if (old_event is not None) and (old_mod_num > e_mod_num):
-                    logging.warn(
-                            "Got a smaller modification number (%d < %d) for event %s",
-                            e_mod_num, old_mod_num, e_id )
-                    status = '403'
-                    opt = 'optOut'
-                    
-                if not self.check_target_info(evt):
-                    logging.info("Opting out of event %s - no target match",e_id)
-                    status = '403'
-                    opt = 'optOut'
-
-                valid_signals = get_signals(evt, self.ns_map)
-                if valid_signals is None:
-                    logging.info("Opting out of event %s - no simple signal",e_id)
-                    opt = 'optOut'
-                    status = '403'
-
-                if self.market_contexts and (e_market_context not in self.market_contexts):
-                    logging.info("Opting out of event %s - market context %s does not match",
-                            e_id, e_market_context )
-                    opt = 'optOut'
-                    status = '405'
-
-                reply_events.append((e_id,e_mod_num,requestID,opt,status))
-
-            # We have a new event or an updated old one
-            if (old_event is None) or (e_mod_num > old_mod_num):
-                start_offset = get_start_before_after(evt, self.ns_map)
-
-                # if we got some start offests
-                if start_offset[0] or start_offset[1]:
-                    start = get_active_period_start(evt, self.ns_map)
-
-                    new_start = schedule.random_offset( start, 
-                            start_offset[0], start_offset[1] )
-
-                    logging.debug( "Randomizing start time for %s(%d) - " + \
-                            "startBefore/ startAfter: %r. New start time: %s", 
-                            e_id, e_mod_num, start_offset, new_start )
-
-                    set_active_period_start(evt, new_start, self.ns_map)
+        e_id = record.event_id
+        e_mod_num = record.mod_number
+
+        logging.debug('------ EVENT ID: %s(%s); Status: %s; Current Signal: %s',
+                e_id, e_mod_num, record.status, record.current_value)
+        
+        all_events.add(e_id)
+        # (vtn_id, mod_num) of an older event; it may be earlier in this payload
+        old_event = batch.get_pending(e_id) or self._event_index.get(e_id)
+        old_mod_num = None
+        
+        if old_event is not None:                   # If there is an older event
+            old_mod_num = old_event[1]              # get it's mod number
+
+        # For the events we need to reply to, make our "opts," and check the status of the event
+        if (old_event is None) or (e_mod_num > old_mod_num) or (response_required == 'always'):
+            # By default, we optIn and have an "OK," status (200)
+            opt = 'optIn'
+            status = '200'
+
+            if (old_event is not None) and (old_mod_num > e_mod_num):
+                logging.warn(
+                        "Got a smaller modification number (%d < %d) for event %s",
+                        e_mod_num, old_mod_num, e_id )
+                status = '403'
+                opt = 'optOut'
                 
-                # Add/update the event to our list
+            if not self.check_target_info(record):
+                logging.info("Opting out of event %s - no target match",e_id)
+                status = '403'
+                opt = 'optOut'
+
+            if record.signals is None:
+                logging.info("Opting out of event %s - no simple signal",e_id)
+                opt = 'optOut'
+                status = '403'
+
+            if self.market_contexts and (record.market_context not in self.market_contexts):
+                logging.info("Opting out of event %s - market context %s does not match",
+                        e_id, record.market_context )
+                opt = 'optOut'
+                status = '405'
+
+            reply_events.append((e_id,e_mod_num,requestID,opt,status))
+
+        # We have a new event or an updated old one
+        if (old_event is None) or (e_mod_num > old_mod_num):
+            start_offset = (record.start_before, record.start_after)
+
+            # if we got some start offests
+            if start_offset[0] or start_offset[1]:
+                new_start = schedule.random_offset( record.dtstart,
+                        start_offset[0], start_offset[1] )
+
+                logging.debug( "Randomizing start time for %s(%d) - " + \
+                        "startBefore/ startAfter: %r. New start time: %s", 
+                        e_id, e_mod_num, start_offset, new_start )
+
+                set_active_period_start(evt, new_start, self.ns_map)
+                record.dtstart = new_start
+            
+            # Add/update the event to our list
+            if updated_events is not None:
                 updated_events[e_id] = evt
-                self.update_event(e_id, evt, vtnID)
+            columns = self._event_columns(record)
+            batch.update_event(e_id, e_mod_num, etree.tostring(evt), vtnID, **columns)
+            cached_events[e_id] = CachedEvent(record, evt if keep_tree else None,
+                    columns['dtstart'], columns['end_time'])
+
+
+    def _finish_payload(self, reply_events, all_events, updated_events, batch,
+                        cached_events):
+        '''
+        Remove the events that were implicitly cancelled by a payload, commit
+        the changes to the database, call `event_callback` and build the reply.
+
+        reply_events -- List of reply tuples (see `build_created_payload()`)
+        all_events -- Set of all the Event IDs in the payload
+        updated_events -- Dictionary of new or updated events
+        batch -- database.EventBatch of the payload's changes
+        cached_events -- Dictionary of CachedEvent for the new or updated events
+
+        Returns: An lxml.etree.Element object; which should be used as a response payload
+        '''
 
         # Find implicitly cancelled events and get rid of them
         remove_events = {}
-        for evt in self.get_active_events():
-            e_id = get_event_id(evt, self.ns_map)
-
+        for e_id in self._event_index.keys():
             if e_id not in all_events: 
                 logging.debug('Removing cancelled event %s', e_id)
-                remove_events[e_id] = self.get_event(e_id)
+                # Only the callback needs the event itself
+                remove_events[e_id] = self.get_event(e_id) \
+                        if self.event_callback is not None else None
+
+        batch.remove_events(remove_events.keys())
+
+        # The index only changes once the batch is in the database, so a
+        # payload that fails part way through leaves it as it was
+        index_updates = batch.pending_index()
 
-        # call the callback of updated & removed events.  
         try:
-            if self.event_callback is not None:
-                self.event_callback(updated_events, remove_events )
+            batch.commit()
+        except Exception:
+            # Get back in sync with whatever made it into the database
+            self._event_index = self.db.get_event_index()
+            self._invalidate_cache()
+            raise
 
-        except Exception as ex:
-            logging.warn("Error in event callback! %s", ex)
+        self._event_index.update(index_updates)
+        for e_id in remove_events:
+            self._event_index.pop(e_id, None)
+
+        self._update_cache(cached_events, remove_events)
 
-        self.remove_events(remove_events.keys())
+        # call the callback of updated & removed events.  
+        if self.event_callback is not None:
+            # The event cache holds on to the updated events; don't let the
+            # callback change them under it
+            updated_events = dict((e_id, copy.deepcopy(evt))
+                    for e_id, evt in updated_events.iteritems())
+            if not self.dispatcher.submit(('events', self), self.event_callback,
+                    (updated_events, remove_events), force=True):
+                logging.error('event_callback dropped for updated events %r, removed events %r',
+                        updated_events.keys(), remove_events.keys())
 
         # If we have any in the reply_events list, build some payloads
         logging.debug("Replying for events %r", reply_events)
@@ -286,6 +477,28 @@ class EventHandler(object):
         return payload
 
 
+    def build_poll_payload(self):
+        '''
+        Assemble an oadrPoll payload, to ask the VTN if it has anything new
+        for us (rather than for all of the events).  This is only in the
+        OpenADR 2.0b spec.
+
+        Returns: An lxml.etree.Element object
+        '''
+
+        if self.oadr_profile_level != OADR_PROFILE_20B:
+            raise ValueError('oadrPoll needs OpenADR %s, not %s' % (
+                    OADR_PROFILE_20B, self.oadr_profile_level))
+
+        oadr = ElementMaker(namespace=self.ns_map['oadr'], nsmap=self.ns_map)
+        ei = ElementMaker(namespace=self.ns_map['ei'], nsmap=self.ns_map)
+
+        payload = oadr.oadrPoll(ei.venID(self.ven_id))
+        payload.set('{%s}schemaVersion' % self.ns_map['ei'], OADR_PROFILE_20B)
+
+        return payload
+
+
     def build_created_payload(self, events):
         '''
         Assemble an XML payload to send out for events marked "response
@@ -357,18 +570,22 @@ class EventHandler(object):
         '''
         Checks to see if we haven been targeted by the event.
 
-        evt -- lxml.etree.ElementTree object w/ an OpenADR Event structure
+        evt -- An EventRecord, or an lxml.etree.ElementTree object w/ an
+               OpenADR Event structure
 
         Returns: True if we are in the target info, False otherwise.
         '''
 
+        if not isinstance(evt, EventRecord):
+            evt = parse_event(evt, self.ns_map)
+
         accept = True
-        party_ids = get_party_ids(evt, self.ns_map)
-        group_ids = get_group_ids(evt, self.ns_map)
-        resource_ids = get_resource_ids(evt, self.ns_map)
-        ven_ids = get_ven_ids(evt, self.ns_map)
+        party_ids = evt.party_ids
+        group_ids = evt.group_ids
+        resource_ids = evt.resource_ids
+        ven_ids = evt.ven_ids
 
-        if party_ids or group_ids or resource_ids or ven_ids:
+        if evt.has_targets():
             accept = False
 
             if party_ids and self.party_id in party_ids:
@@ -386,18 +603,173 @@ class EventHandler(object):
         return accept
    
 
-    def get_active_events(self):
+    def get_active_events(self, within=None):
         '''
-        Get an iterator of all the active events.
+        Get an iterator of all the active events.  These come from the event
+        cache, so they are shared; don't modify them.
+
+        within -- If given, only get the events that are active now or start
+                  within this many seconds.  Otherwise all stored events are
+                  returned.
 
         Return: An iterator containing lxml.etree.ElementTree EiEvent objects
         '''
-        # Get the events, and convert their XML blobs to lxml objects
-        active = self.db.get_active_events()
-        for e_id in active.iterkeys():
-            active[e_id] = etree.XML(active[e_id])
-        
-        return active.itervalues()
+        events = []
+        for e_id, cached in self._get_active_cached(within):
+            if cached.element is None:
+                cached.element = self._read_event(e_id)
+            if cached.element is not None:
+                events.append(cached.element)
+
+        return iter(events)
+
+
+    def get_active_records(self, within=None, now=None):
+        '''
+        Like `get_active_events()`, but gets the parsed events.  This never
+        touches the database once the event cache is loaded.
+
+        within -- If given, only get the events that are active now or start
+                  within this many seconds.  Otherwise all stored events are
+                  returned.
+        now -- datetime (UTC) to check against, defaults to utcnow()
+
+        Return: A list of EventRecord objects
+        '''
+        return [cached.record for e_id, cached in self._get_active_cached(within, now)]
+
+
+    def get_event_record(self, e_id):
+        '''
+        Get the parsed event w/ a specific id, from the event cache.
+
+        e_id -- ID of the event we want
+
+        Returns: An EventRecord, or None
+        '''
+        cached = self._load_cache().get(e_id)
+        return cached.record if cached is not None else None
+
+
+    def get_expired_events(self, now=None):
+        '''
+        Get the IDs of the events whose last interval has ended.
+
+        now -- datetime (UTC) to check against, defaults to utcnow()
+
+        Returns: A list of Event IDs
+        '''
+        now = schedule.dttm_to_timestamp(now) if now is not None else time.time()
+
+        with self._cache_lock:
+            return [e_id for e_id, cached in self._load_cache().iteritems()
+                    if cached.end_time is not None and cached.end_time <= now]
+
+
+    def get_next_start(self, now=None):
+        '''
+        Find when the next event starts (or its start tolerance window opens,
+        if it has an xcal:startbefore).
+
+        now -- datetime (UTC) to check against, defaults to utcnow()
+
+        Returns: Seconds since the epoch of the earliest start after `now`, or
+            None if there are no upcoming events
+        '''
+        now = schedule.dttm_to_timestamp(now) if now is not None else time.time()
+
+        next_start = None
+        with self._cache_lock:
+            for cached in self._load_cache().itervalues():
+                if cached.dtstart is None or cached.dtstart <= now:
+                    continue
+
+                start = cached.dtstart
+                if cached.record.start_before:
+                    try:
+                        opens = cached.record.dtstart - schedule.duration_to_offset(
+                                cached.record.start_before)[0]
+                        start = min(start, schedule.dttm_to_timestamp(opens))
+                    except (AttributeError, ValueError):
+                        pass    # a bad duration; just use the start
+
+                if start <= now:
+                    return now      # in the window now
+                if next_start is None or start < next_start:
+                    next_start = start
+
+        return next_start
+
+
+    def _get_active_cached(self, within=None, now=None):
+        '''
+        Returns: A list of (event_id, CachedEvent) for the active events.  The
+            same rules as `DBHandler.get_active_events()` are used.
+        '''
+        with self._cache_lock:
+            cache = self._load_cache()
+            if within is None:
+                return cache.items()
+
+            now = schedule.dttm_to_timestamp(now) if now is not None else time.time()
+            return [(e_id, cached) for e_id, cached in cache.iteritems()
+                    if cached.dtstart is None or (cached.dtstart <= now + within and
+                        (cached.end_time is None or cached.end_time > now))]
+
+
+    def _load_cache(self):
+        '''
+        Fill the event cache from the database, the first time it's needed.
+
+        Returns: The event cache dictionary
+        '''
+        with self._cache_lock:
+            if self._event_cache is not None:
+                return self._event_cache
+
+            cache = {}
+            for e_id, raw_xml in self.db.get_active_events().iteritems():
+                try:
+                    evt = etree.XML(raw_xml)
+                    record = parse_event(evt, self.ns_map)
+                except Exception as ex:
+                    logging.warn('Unable to read stored event %s: %s', e_id, ex)
+                    continue
+                columns = self._event_columns(record)
+                cache[e_id] = CachedEvent(record, evt, columns['dtstart'], columns['end_time'])
+
+            logging.debug('Loaded %d events into the event cache', len(cache))
+            self._event_cache = cache
+            return cache
+
+
+    def _update_cache(self, cached_events, remove_events=()):
+        '''
+        Write changes through to the event cache, if it's loaded.
+
+        cached_events -- Dictionary of {event_id: CachedEvent} to add/replace
+        remove_events -- Event IDs to drop
+        '''
+        if not cached_events and not remove_events:
+            return
+
+        with self._cache_lock:
+            self.cache_version += 1
+            if self._event_cache is None:
+                return
+
+            for e_id in remove_events:
+                self._event_cache.pop(e_id, None)
+            self._event_cache.update(cached_events)
+
+
+    def _invalidate_cache(self):
+        '''
+        Drop the event cache; it gets loaded again on the next read.
+        '''
+        with self._cache_lock:
+            self._event_cache = None
+            self.cache_version += 1
 
 
     def update_all_events(self, event_dict, vtn_id):
@@ -411,12 +783,22 @@ class EventHandler(object):
         '''
         # Format the event diciontary int a list of event records for the database
         event_list = []
+        cache = {}
         for e_id in event_dict.iterkeys():
-            mod_num = get_mod_number(event_dict[e_id], self.ns_map)
+            record = parse_event(event_dict[e_id], self.ns_map)
             raw_xml = etree.tostring(event_dict[e_id])
-            event_list.append((vtn_id, e_id, mod_num, raw_xml))
+            columns = self._event_columns(record)
+            event_list.append((vtn_id, e_id, record.mod_number, raw_xml,
+                    columns['status'], columns['dtstart'], columns['end_time'],
+                    columns['market_context']))
+            cache[e_id] = CachedEvent(record, event_dict[e_id],
+                    columns['dtstart'], columns['end_time'])
 
         self.db.update_all_events(event_list)
+        self._event_index = dict( (r[1], (r[0], r[2])) for r in event_list )
+        with self._cache_lock:
+            self._event_cache = cache
+            self.cache_version += 1
 
 
     def update_event(self, e_id, event, vtn_id):
@@ -427,20 +809,82 @@ class EventHandler(object):
         event -- the event we want to add in
         vtn_id -- ID of VTN this event is associated with
         '''
+        record = parse_event(event, self.ns_map)
+        columns = self._event_columns(record)
         self.db.update_event(e_id,
-                             get_mod_number(event, self.ns_map),
+                             record.mod_number,
                              etree.tostring(event),
-                             vtn_id)
+                             vtn_id,
+                             **columns)
+        self._event_index[e_id] = (vtn_id, record.mod_number)
+        self._update_cache({e_id: CachedEvent(record, event,
+                columns['dtstart'], columns['end_time'])})
+
+
+    def _event_columns(self, record):
+        '''
+        Get the values for the schedule columns of the database.
+
+        record -- An EventRecord
+
+        Returns: A dictionary of keyword arguments for `DBHandler.update_event()`
+        '''
+
+        end_time = record.get_end_time()
+        return {
+            'status': record.status,
+            'dtstart': schedule.dttm_to_timestamp(record.dtstart) \
+                    if record.dtstart is not None else None,
+            'end_time': schedule.dttm_to_timestamp(end_time) \
+                    if end_time is not None else None,
+            'market_context': record.market_context,
+        }
+
+
+    def _update_event_columns(self):
+        '''
+        Fill in the schedule columns for all of the stored events.  Used when
+        the database has just been migrated from an older version.
+        '''
+
+        rows = []
+        for e_id, raw_xml in self.db.get_active_events().iteritems():
+            try:
+                columns = self._event_columns(parse_event(etree.XML(raw_xml), self.ns_map))
+            except Exception as ex:
+                logging.warn('Unable to read stored event %s: %s', e_id, ex)
+                continue
+            rows.append((e_id, columns['status'], columns['dtstart'],
+                    columns['end_time'], columns['market_context']))
+
+        self.db.update_event_columns(rows)
+        logging.info('Filled in the schedule of %d stored events', len(rows))
 
 
     def get_event(self, e_id):
         '''
-        Get an event w/ a specific id.
+        Get an event w/ a specific id.  This comes from the event cache, so
+        it is shared; don't modify it.
 
         e_id -- ID of the event we want
 
         Returns: The event we want, or None
         '''
+        cached = self._load_cache().get(e_id)
+        if cached is None:
+            return None
+
+        if cached.element is None:
+            cached.element = self._read_event(e_id)
+        return cached.element
+
+
+    def _read_event(self, e_id):
+        '''
+        Read & parse an event from the database.
+
+        Returns: An lxml.etree.Element object, or None
+        '''
         evt = self.db.get_event(e_id)
 
         # Only parse it if it isn't None
@@ -456,8 +900,358 @@ class EventHandler(object):
 
         event_id_list - List of Event IDs 
         '''
-        self.db.remove_events(evt_id_list)
+        evt_id_list = list(evt_id_list)
+        self.db.remove_events(list(evt_id_list))    # (it rewrites the list)
+        for e_id in evt_id_list:
+            self._event_index.pop(e_id, None)
+        self._update_cache({}, evt_id_list)
+
+
+    def close(self):
+        '''
+        Release the handler's resources (i.e. its database connections and
+        callback dispatcher).
+        '''
+
+        if self._own_dispatcher:
+            self.dispatcher.close()
+        self.db.close()
+
+
+
+# Paths used by the accessor functions below.  They get compiled to
+# `etree.XPath` objects once per namespace map (see `get_xpaths()`), rather than
+# re-parsing the path string and namespace map on every call.
+EVENT_PATHS = {
+    'event_id'          : 'ei:eventDescriptor/ei:eventID',
+    'status'            : 'ei:eventDescriptor/ei:eventStatus',
+    'mod_number'        : 'ei:eventDescriptor/ei:modificationNumber',
+    'market_context'    : 'ei:eventDescriptor/ei:eiMarketContext/emix:marketContext',
+    'current_value'     : 'ei:eiEventSignals/ei:eiEventSignal/ei:currentValue/ei:payloadFloat/ei:value',
+    'signals'           : 'ei:eiEventSignals/ei:eiEventSignal',
+    'signal_name'       : 'ei:signalName',
+    'signal_type'       : 'ei:signalType',
+    'intervals'         : 'strm:intervals/ei:interval',
+    'interval_duration' : 'xcal:duration/xcal:duration',
+    'interval_uid'      : 'xcal:uid/xcal:text',
+    'interval_value'    : 'ei:signalPayload//ei:value',
+    'dtstart'           : 'ei:eiActivePeriod/xcal:properties/xcal:dtstart/xcal:date-time',
+    'start_before'      : 'ei:eiActivePeriod/xcal:properties/xcal:tolerance/xcal:tolerate/xcal:startbefore',
+    'start_after'       : 'ei:eiActivePeriod/xcal:properties/xcal:tolerance/xcal:tolerate/xcal:startafter',
+    'group_ids'         : 'ei:eiTarget/ei:groupID',
+    'resource_ids'      : 'ei:eiTarget/ei:resourceID',
+    'party_ids'         : 'ei:eiTarget/ei:partyID',
+    'ven_ids'           : 'ei:eiTarget/ei:venID',
+}
+
+# Key: id() of a namespace map, Value: (ns_map, {name: etree.XPath})
+# The ns_map itself is held on to so that its id() can't be reused.
+_xpath_registry = {}
+
+
+def get_xpaths(ns_map=NS_A):
+    '''
+    Gets the precompiled XPath expressions of `EVENT_PATHS` for a namespace map.
+    They are compiled the first time a namespace map is seen.
+
+    ns_map -- Dictionary of namesapces for OpenADR 2.0; default is the 2.0a spec
+
+    Returns: A dictionary of {name: etree.XPath}
+    '''
+
+    entry = _xpath_registry.get(id(ns_map))
+    if entry is None or entry[0] is not ns_map:
+        xpaths = dict( (name, etree.XPath(path, namespaces=ns_map))
+                for name, path in EVENT_PATHS.iteritems() )
+        entry = (ns_map, xpaths)
+        _xpath_registry[id(ns_map)] = entry
+
+    return entry[1]
+
+
+def _find(evt, name, ns_map):
+    '''
+    Works like `evt.find()`, but with a precompiled path from `EVENT_PATHS`
+    '''
+
+    found = get_xpaths(ns_map)[name](evt)
+    return found[0] if found else None
+
+
+def _findtext(evt, name, ns_map):
+    '''
+    Works like `evt.findtext()`, but with a precompiled path from `EVENT_PATHS`
+    '''
+
+    found = get_xpaths(ns_map)[name](evt)
+    if not found:
+        return None
+    return found[0].text or ''
+
+
+# Compile the paths for the two profiles up front
+get_xpaths(NS_A)
+get_xpaths(NS_B)
+
+
+# Element names that `parse_event()` looks for, per namespace map.  Same
+# bookkeeping as `_xpath_registry`.
+_tag_registry = {}
+
+
+def _get_tags(ns_map):
+    '''
+    Gets a dictionary of {local name: Clark notation tag} for the elements
+    `parse_event()` walks through.
+    '''
+
+    entry = _tag_registry.get(id(ns_map))
+    if entry is None or entry[0] is not ns_map:
+        ei, emix, xcal, strm = ns_map['ei'], ns_map['emix'], ns_map['xcal'], ns_map['strm']
+        tags = {}
+        for name in ('eventDescriptor', 'eventID', 'modificationNumber', 'eventStatus',
+                     'eiMarketContext', 'eiActivePeriod', 'eiEventSignals', 'eiEventSignal',
+                     'signalName', 'signalType', 'interval', 'signalPayload', 'value',
+                     'eiTarget', 'partyID', 'groupID', 'resourceID', 'venID',
+                     'currentValue', 'payloadFloat'):
+            tags[name] = '{%s}%s' % (ei, name)
+        for name in ('properties', 'dtstart', 'date-time', 'tolerance', 'tolerate',
+                     'startbefore', 'startafter', 'duration', 'uid', 'text'):
+            tags[name] = '{%s}%s' % (xcal, name)
+        tags['marketContext'] = '{%s}marketContext' % emix
+        tags['intervals'] = '{%s}intervals' % strm
+        entry = (ns_map, tags)
+        _tag_registry[id(ns_map)] = entry
+
+    return entry[1]
+
+
+class EventRecord(object):
+    '''
+    The values we care about from an ei:eiEvent, pulled out in a single walk
+    of the tree by `parse_event()`.
+
+    Member Variables:
+    --------
+    event_id -- ei:eventID value
+    mod_number -- ei:modificationNumber value (as an integer)
+    status -- ei:eventStatus value
+    market_context -- emix:marketContext value
+    current_value -- ei:currentValue of the event signal
+    dtstart -- Active period start, as a datetime object (or None)
+    start_before -- xcal:startbefore tolerance (or None)
+    start_after -- xcal:startafter tolerance (or None)
+    party_ids -- frozenset of ei:partyID targets
+    group_ids -- frozenset of ei:groupID targets
+    resource_ids -- frozenset of ei:resourceID targets
+    ven_ids -- frozenset of ei:venID targets
+    signals -- Intervals of the simple signal, in the same form as
+               `get_signals()`, or None if there is no simple signal
+    --------
+    '''
+
+    __slots__ = ('event_id', 'mod_number', 'status', 'market_context',
+                 'current_value', 'dtstart', 'start_before', 'start_after',
+                 'party_ids', 'group_ids', 'resource_ids', 'ven_ids', 'signals')
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.get(name))
+
+
+    def has_targets(self):
+        '''
+        Returns: True if the event targets anyone specific.
+        '''
+
+        return bool(self.party_ids or self.group_ids or self.resource_ids or self.ven_ids)
+
+
+    def get_end_time(self):
+        '''
+        Works out when the last interval of the simple signal ends.
+
+        Returns: A datetime object, or None if the event never ends (it has
+                 a zero duration interval) or if the end can't be worked out
+        '''
+
+        if self.dtstart is None or not self.signals:
+            return None
 
+        try:
+            return self.get_timeline().get_end_time()
+        except Exception as ex:
+            logging.debug('Unable to work out the end of event %s: %s', self.event_id, ex)
+            return None
+
+
+    def get_timeline(self):
+        '''
+        Returns: The schedule.Timeline of the simple signal's intervals, shared
+                 by every record of this (event_id, mod_number)
+        '''
+
+        return schedule.get_timeline((self.event_id, self.mod_number),
+                self.dtstart, [s[0] for s in self.signals])
+
+
+    def __repr__(self):
+        return 'EventRecord(%s(%s), status=%s, dtstart=%s)' % (
+                self.event_id, self.mod_number, self.status, self.dtstart)
+
+
+class CachedEvent(object):
+    '''
+    An entry of `EventHandler`'s event cache; a stored event, parsed, with its
+    schedule worked out.
+
+    Member Variables:
+    --------
+    record -- The EventRecord of the event
+    element -- The ei:eiEvent lxml.etree.Element, or None if it hasn't been
+               read from the database yet
+    dtstart -- Start of the event, in seconds since the epoch (or None)
+    end_time -- End of the event, in seconds since the epoch (or None)
+    --------
+    '''
+
+    __slots__ = ('record', 'element', 'dtstart', 'end_time')
+
+    def __init__(self, record, element, dtstart, end_time):
+        self.record = record
+        self.element = element
+        self.dtstart = dtstart
+        self.end_time = end_time
+
+
+def _first_text(elem, tag):
+    '''
+    Text of the first child of `elem` with `tag`, like `findtext()`
+    '''
+
+    for child in elem:
+        if child.tag == tag:
+            return child.text or ''
+    return None
+
+
+def parse_event(evt, ns_map=NS_A):
+    '''
+    Pull everything the handler and controller need out of an event, walking
+    the tree just once.
+
+    evt -- lxml.etree.Element object of ei:eiEvent
+    ns_map -- Dictionary of namesapces for OpenADR 2.0; default is the 2.0a spec
+
+    Returns: An EventRecord
+    '''
+
+    t = _get_tags(ns_map)
+    values = {}
+    targets = {'partyID': [], 'groupID': [], 'resourceID': [], 'venID': []}
+    simple_signal = None
+    current_value = None
+
+    for child in evt:
+        tag = child.tag
+
+        if tag == t['eventDescriptor']:
+            for desc in child:
+                if desc.tag == t['eventID']:
+                    values.setdefault('event_id', desc.text or '')
+                elif desc.tag == t['modificationNumber']:
+                    values.setdefault('mod_number', desc.text)
+                elif desc.tag == t['eventStatus']:
+                    values.setdefault('status', desc.text or '')
+                elif desc.tag == t['eiMarketContext'] and 'market_context' not in values:
+                    market_context = _first_text(desc, t['marketContext'])
+                    if market_context is not None:
+                        values['market_context'] = market_context
+
+        elif tag == t['eiActivePeriod']:
+            for props in child:
+                if props.tag != t['properties']:
+                    continue
+                for prop in props:
+                    if prop.tag == t['dtstart'] and 'dtstart' not in values:
+                        dttm_str = _first_text(prop, t['date-time'])
+                        if dttm_str is not None:
+                            values['dtstart'] = dttm_str
+                    elif prop.tag == t['tolerance']:
+                        for tolerate in prop:
+                            if tolerate.tag != t['tolerate']:
+                                continue
+                            for tol in tolerate:
+                                if tol.tag == t['startbefore']:
+                                    values.setdefault('start_before', tol.text or '')
+                                elif tol.tag == t['startafter']:
+                                    values.setdefault('start_after', tol.text or '')
+
+        elif tag == t['eiEventSignals']:
+            for signal in child:
+                if signal.tag != t['eiEventSignal']:
+                    continue
+                signal_name = signal_type = intervals = None
+                for part in signal:
+                    if part.tag == t['signalName'] and signal_name is None:
+                        signal_name = part.text or ''
+                    elif part.tag == t['signalType'] and signal_type is None:
+                        signal_type = part.text or ''
+                    elif part.tag == t['intervals'] and intervals is None:
+                        intervals = part
+                    elif part.tag == t['currentValue'] and current_value is None:
+                        for payload in part:
+                            if payload.tag == t['payloadFloat']:
+                                current_value = _first_text(payload, t['value'])
+                                break
+
+                if signal_name == 'simple' and signal_type in VALID_SIGNAL_TYPES:
+                    simple_signal = intervals  # This is A profile only conformance rule!
+                    if simple_signal is None:
+                        simple_signal = ()
+
+        elif tag == t['eiTarget']:
+            for target in child:
+                for name, ids in targets.iteritems():
+                    if target.tag == t[name]:
+                        ids.append(target.text)
+                        break
+
+    signals = None
+    if simple_signal is not None:
+        signals = []
+        for interval in simple_signal:
+            if interval.tag != t['interval']:
+                continue
+            duration = uid = value = None
+            for part in interval:
+                if part.tag == t['duration'] and duration is None:
+                    duration = _first_text(part, t['duration'])
+                elif part.tag == t['uid'] and uid is None:
+                    uid = _first_text(part, t['text'])
+                elif part.tag == t['signalPayload'] and value is None:
+                    for val in part.iter(t['value']):
+                        value = val.text or ''
+                        break
+            signals.append( (duration,uid,value) )
+
+    mod_number = values.get('mod_number')
+    dtstart = values.get('dtstart')
+
+    return EventRecord(
+            event_id = values.get('event_id'),
+            mod_number = int(mod_number) if mod_number is not None else None,
+            status = values.get('status'),
+            market_context = values.get('market_context'),
+            current_value = current_value,
+            dtstart = schedule.str_to_datetime(dtstart) if dtstart else None,
+            start_before = values.get('start_before'),
+            start_after = values.get('start_after'),
+            party_ids = frozenset(targets['partyID']),
+            group_ids = frozenset(targets['groupID']),
+            resource_ids = frozenset(targets['resourceID']),
+            ven_ids = frozenset(targets['venID']),
+            signals = signals )
 
 
 def get_event_id(evt, ns_map=NS_A):
@@ -470,7 +1264,7 @@ def get_event_id(evt, ns_map=NS_A):
     Returns: an ei:eventID value
     '''
 
-    return evt.findtext("ei:eventDescriptor/ei:eventID",namespaces=ns_map)
+    return _findtext(evt, 'event_id', ns_map)
 
 
 def get_status(evt, ns_map=NS_A):
@@ -483,7 +1277,7 @@ def get_status(evt, ns_map=NS_A):
     Returns: an ei:eventStatus value
     '''
 
-    return evt.findtext("ei:eventDescriptor/ei:eventStatus",namespaces=ns_map)
+    return _findtext(evt, 'status', ns_map)
 
 
 def get_mod_number(evt, ns_map=NS_A):
@@ -496,9 +1290,7 @@ def get_mod_number(evt, ns_map=NS_A):
     Returns: an ei:modificationNumber value
     '''
 
-    return int( evt.findtext(
-        "ei:eventDescriptor/ei:modificationNumber",
-        namespaces=ns_map) )
+    return int( _findtext(evt, 'mod_number', ns_map) )
 
 
 def get_market_context(evt, ns_map=NS_A):
@@ -510,7 +1302,7 @@ def get_market_context(evt, ns_map=NS_A):
 
     Returns: an emix:marketContext value
     '''
-    return evt.findtext("ei:eventDescriptor/ei:eiMarketContext/emix:marketContext",namespaces=ns_map)
+    return _findtext(evt, 'market_context', ns_map)
 
 
 def get_current_signal_value(evt, ns_map=NS_A):
@@ -523,9 +1315,7 @@ def get_current_signal_value(evt, ns_map=NS_A):
     Returns: an ei:value value
     '''
 
-    return evt.findtext(
-        'ei:eiEventSignals/ei:eiEventSignal/ei:currentValue/' + \
-        'ei:payloadFloat/ei:value', namespaces=ns_map)
+    return _findtext(evt, 'current_value', ns_map)
 
 
 def get_signals(evt, ns_map=NS_A):
@@ -540,9 +1330,10 @@ def get_signals(evt, ns_map=NS_A):
 
     simple_signal = None
     signals = []
-    for signal in evt.iterfind( 'ei:eiEventSignals/ei:eiEventSignal', namespaces=ns_map ):
-        signal_name = signal.findtext('ei:signalName', namespaces=ns_map)
-        signal_type = signal.findtext('ei:signalType', namespaces=ns_map)
+    xpaths = get_xpaths(ns_map)
+    for signal in xpaths['signals'](evt):
+        signal_name = _findtext(signal, 'signal_name', ns_map)
+        signal_type = _findtext(signal, 'signal_type', ns_map)
         
         if signal_name == 'simple' and signal_type in VALID_SIGNAL_TYPES:
             simple_signal = signal  # This is A profile only conformance rule!
@@ -550,10 +1341,10 @@ def get_signals(evt, ns_map=NS_A):
     if simple_signal is None:
         return None
 
-    for interval in simple_signal.iterfind( 'strm:intervals/ei:interval', namespaces=ns_map ):
-        duration = interval.findtext( 'xcal:duration/xcal:duration', namespaces=ns_map )
-        uid = interval.findtext('xcal:uid/xcal:text', namespaces=ns_map)
-        value = interval.findtext('ei:signalPayload//ei:value', namespaces=ns_map)
+    for interval in xpaths['intervals'](simple_signal):
+        duration = _findtext(interval, 'interval_duration', ns_map)
+        uid = _findtext(interval, 'interval_uid', ns_map)
+        value = _findtext(interval, 'interval_value', ns_map)
         signals.append( (duration,uid,value) )
 
     return signals
@@ -569,9 +1360,7 @@ def get_active_period_start(evt, ns_map=NS_A):
     Returns: a scheduled datetime object
     '''
 
-    dttm_str = evt.findtext(
-            'ei:eiActivePeriod/xcal:properties/xcal:dtstart/xcal:date-time',
-            namespaces=ns_map )
+    dttm_str = _findtext(evt, 'dtstart', ns_map)
     return schedule.str_to_datetime(dttm_str)
 
 
@@ -583,9 +1372,7 @@ def set_active_period_start(evt,dttm, ns_map=NS_A):
     ns_map - Dictionary of namesapces for OpenADR 2.0; default is the 2.0a spec
     '''
 
-    active_period_element = evt.find(
-            'ei:eiActivePeriod/xcal:properties/xcal:dtstart/xcal:date-time',
-            namespaces=ns_map )
+    active_period_element = _find(evt, 'dtstart', ns_map)
     active_period_element.text = schedule.dttm_to_str(dttm)
 
 
@@ -599,12 +1386,8 @@ def get_start_before_after(evt, ns_map=NS_A):
     Returns: A tuple of (xcal:startbefore, xcal:startafter)
     '''
 
-    return ( evt.findtext(
-            'ei:eiActivePeriod/xcal:properties/xcal:tolerance/xcal:tolerate/xcal:startbefore',
-            namespaces=ns_map ),
-            evt.findtext(
-            'ei:eiActivePeriod/xcal:properties/xcal:tolerance/xcal:tolerate/xcal:startafter',
-            namespaces=ns_map ) )
+    return ( _findtext(evt, 'start_before', ns_map),
+             _findtext(evt, 'start_after', ns_map) )
 
 
 def get_group_ids(evt, ns_map=NS_A):
@@ -617,7 +1400,7 @@ def get_group_ids(evt, ns_map=NS_A):
     Returns: A list of ei:groupID
     '''
 
-    return [e.text for e in evt.iterfind('ei:eiTarget/ei:groupID',namespaces=ns_map)]
+    return [e.text for e in get_xpaths(ns_map)['group_ids'](evt)]
 
 def get_resource_ids(evt, ns_map=NS_A):
     '''
@@ -629,7 +1412,7 @@ def get_resource_ids(evt, ns_map=NS_A):
     Returns: A list of ei:resourceID
     '''
 
-    return [e.text for e in evt.iterfind('ei:eiTarget/ei:resourceID',namespaces=ns_map)]
+    return [e.text for e in get_xpaths(ns_map)['resource_ids'](evt)]
 
 
 def get_party_ids(evt, ns_map=NS_A):
@@ -642,7 +1425,7 @@ def get_party_ids(evt, ns_map=NS_A):
     Returns: A list of ei:partyID
     '''
 
-    return [e.text for e in evt.iterfind('ei:eiTarget/ei:partyID',namespaces=ns_map)]
+    return [e.text for e in get_xpaths(ns_map)['party_ids'](evt)]
 
 
 def get_ven_ids(evt, ns_map=NS_A):
@@ -655,5 +1438,5 @@ def get_ven_ids(evt, ns_map=NS_A):
     Returns: A list of ei:venID
     '''
 
-    return [e.text for e in evt.iterfind('ei:eiTarget/ei:venID',namespaces=ns_map)]
+    return [e.text for e in get_xpaths(ns_map)['ven_ids'](evt)]
 
@@ -3,12 +3,18 @@
 # Requires the python libXML wrapper "lxml"
 
 import os
+import errno
 import threading, logging
-import urllib2
+import heapq, itertools, Queue
+import random
+import time
+import urllib2, urlparse
 import httplib
+import select
 import ssl, socket
+import zlib
 from lxml import etree
-import base, schedule
+import base, event, schedule, dispatch, database
 
 # HTTP parameters:
 CONTENT_TYPE = 'application/xml'
@@ -17,7 +23,22 @@ DEFAULT_HEADERS = {
     'content-type': CONTENT_TYPE
 }
 REQUEST_TIMEOUT = 5                  # HTTP request timeout
+KEEPALIVE_TIMEOUT = 30               # don't reuse connections idle for longer than X seconds
+MAX_IDLE_CONNECTIONS = 2             # idle connections kept open to each host
+RETRY_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')  # safe to send again if a
+                                     # reused connection fails part way through
+ACCEPT_ENCODING = 'gzip, deflate'    # compressed responses we take
+READ_CHUNK_SIZE = 16 * 1024          # read (and decompress) responses X bytes at a time
+MIN_COMPRESS_SIZE = 1024             # don't bother compressing requests smaller than X bytes
+POLL_WORKERS = 8                     # most VTN polls a PollEngine runs at once
+REPLY_QUEUE_SIZE = 100               # most replies waiting to be sent
+REPLY_MAX_ATTEMPTS = 8               # give up on a reply after X tries
+REPLY_RETRY_INTERVAL = 5             # first retry of a reply after X seconds,
+REPLY_MAX_RETRY_INTERVAL = 300       # ...doubling up to X seconds
 DEFAULT_VTN_POLL_INTERVAL = 300      # poll the VTN every X seconds
+POLL_PROXIMITY_DIVISOR = 4           # poll X times before the next event starts
+MAX_BACKOFF_EXPONENT = 10            # back off up to 2^X times the poll interval on errors,
+MAX_BACKOFF_INTERVAL = 3600          # ...but no more than X seconds (or `max_poll_interval`)
 OADR2_URI_PATH = 'OpenADR2/Simple/'  # URI of where the VEN needs to request from
 
 # A Cipther list.  To configure properly, see: http://www.openssl.org/docs/apps/ciphers.html#CIPHER_LIST_FORMAT
@@ -35,10 +56,23 @@ class OpenADR2(base.BaseHandler):
     (Everything from base.BaseHandler)
     vtn_base_uri
     vtn_poll_interval
+    min_poll_interval -- Shortest time between polls, as an event gets close
+    max_poll_interval -- Longest time between polls, when there are no events
+    poll_errors -- How many polls in a row have failed
     ven_client_cert_key
     ven_client_cert_pem
     vtn_ca_certs 
+    stream_payloads
+    compress -- Ask the VTN for compressed (gzip or deflate) responses
+    compress_replies -- gzip replies to a VTN that sends compressed responses
+    use_oadr_poll -- Ask the VTN with an oadrPoll if there is anything new,
+                     before requesting the events (2.0b only)
+    transport -- HTTPTransport the VTN is reached through
+    reply_sender -- ReplySender that sends replies to the VTN
     poll_thread
+    engine -- The PollEngine polling for us, if there is one (instead of
+              `poll_thread`)
+    _reply_spool -- database.DBHandler replies are spooled to, or None
     '''
    
 
@@ -48,7 +82,15 @@ class OpenADR2(base.BaseHandler):
                  ven_client_cert_pem=None,
                  vtn_ca_certs=None,
                  vtn_poll_interval=DEFAULT_VTN_POLL_INTERVAL, 
-                 start_thread=True):
+                 min_poll_interval=None,
+                 max_poll_interval=None,
+                 stream_payloads=False,
+                 start_thread=True,
+                 engine=None,
+                 spool_replies=False,
+                 use_oadr_poll=False,
+                 compress=True,
+                 compress_replies=False):
         '''
         Sets up the class and intializes the HTTP client.
 
@@ -58,10 +100,45 @@ class OpenADR2(base.BaseHandler):
         ven_client_cert_pem -- PEM file/string for the HTTP Client
         vtn_base_uri -- Base URI of the VTN's location
         vtn_poll_interval -- How often we should poll the VTN
+        min_poll_interval -- Poll as often as this when an event is about
+                             to start.  Defaults to `vtn_poll_interval`.
+        max_poll_interval -- Poll as seldom as this when there are no events.
+                             Defaults to `vtn_poll_interval`.
         vtn_ca_certs -- CA Certs for the VTN
+        stream_payloads -- Handle each event of a distribution as it is read
+                           from the VTN, rather than reading the whole payload
+                           into memory first (see `EventHandler.handle_payload_stream()`)
         start_thread -- start the thread for the poll loop or not?
+        engine -- A PollEngine to poll the VTN on, rather than a thread of
+                  our own (`start_thread` is ignored).  The event controller,
+                  callbacks and replies are run on the engine's threads too.
+                  Each target of an engine needs a `db_path` of its own in
+                  `event_config`.
+        spool_replies -- Keep replies that haven't been sent yet in the event
+                         database, so they are still sent after a restart
+        use_oadr_poll -- Poll with oadrPoll, and only request the events when
+                         the VTN says something changed.  Needs the 2.0b
+                         profile.
+        compress -- Ask the VTN for compressed (gzip or deflate) responses
+        compress_replies -- Also gzip replies (and other requests) to the VTN,
+                            once it has sent a compressed response; a VTN
+                            that can't take them gets them uncompressed again
         '''
 
+        if engine is not None:
+            # The database holds one target's events and spooled replies;
+            # sharing it, targets would cancel each other's events and send
+            # each other's replies
+            db_path = event_config.get('db_path', database.DEFAULT_DB_PATH)
+            if engine.uses_db(db_path):
+                raise ValueError('%s is already used by another target of the engine; '
+                        'give each one a db_path of its own' % db_path)
+
+            # Use the engine's threads, rather than starting a set of our own
+            event_config = dict(event_config)
+            event_config.setdefault('dispatcher', engine.dispatcher)
+            control_opts = dict(control_opts, engine=engine)
+
         # Call the parent's methods
         super(OpenADR2,self).__init__(event_config, control_opts)
 
@@ -76,15 +153,39 @@ class OpenADR2(base.BaseHandler):
             logging.warn('Invalid poll interval: %s', self.vtn_poll_interval)
             self.vtn_poll_interval = DEFAULT_VTN_POLL_INTERVAL
 
+        # By default, the interval doesn't change
+        self.min_poll_interval = min(min_poll_interval, self.vtn_poll_interval) \
+                if min_poll_interval is not None else self.vtn_poll_interval
+        self.max_poll_interval = max(max_poll_interval, self.vtn_poll_interval) \
+                if max_poll_interval is not None else self.vtn_poll_interval
+        self.poll_errors = 0
+
         # Security & Authentication related
         self.ven_client_cert_key = ven_client_cert_key
         self.ven_client_cert_pem = ven_client_cert_pem
         self.vtn_ca_certs = vtn_ca_certs
+
+        self.stream_payloads = bool(stream_payloads)
+        self.spool_replies = bool(spool_replies)
+        self.compress = bool(compress)
+        self.compress_replies = bool(compress_replies)
+
+        self.use_oadr_poll = bool(use_oadr_poll)
+        if self.use_oadr_poll and self.event_handler.oadr_profile_level != event.OADR_PROFILE_20B:
+            logging.warn('oadrPoll needs OpenADR %s, requesting events instead',
+                    event.OADR_PROFILE_20B)
+            self.use_oadr_poll = False
+        self._synced = False        # have the events been requested since we started?
+        self._notified_version = self.event_handler.cache_version   # see `_send_reply()`
       
         self.poll_thread = None
-        start_thread = bool(start_thread)
+        self.engine = engine
+        start_thread = bool(start_thread) and engine is None
         self._init_client(start_thread)
 
+        if self.engine is not None:
+            self.engine.add(self)
+
         logging.info( " +++++++++++++++ OADR2 module started ++++++++++++++ " )
 
     
@@ -94,22 +195,29 @@ class OpenADR2(base.BaseHandler):
 
         start_thread -- To start the polling thread or not.
         '''
-        handlers = []
+        ssl_context = None
 
         if self.ven_client_cert_key:
             logging.debug("Adding HTTPS client cert key: %s, pem: %s", 
                     self.ven_client_cert_key, self.ven_client_cert_pem)
-            handlers.append(
-                HTTPSClientAuthHandler( 
+            ssl_context = build_ssl_context(
                     self.ven_client_cert_key,
                     self.ven_client_cert_pem,
                     self.vtn_ca_certs,
                     ssl_version = ssl.PROTOCOL_TLSv1,
                     ciphers = HTTPS_CIPHERS )
-            )
 
         # This is our HTTP client:
-        self.http = urllib2.build_opener(*handlers)
+        self.transport = HTTPTransport(ssl_context,
+                compress=self.compress,
+                compress_requests=self.compress_replies)
+        self._reply_spool = self.event_handler.db if self.spool_replies else None
+        if self.engine is not None:
+            self.reply_sender = self.engine.reply_sender
+            if self._reply_spool is not None:
+                self.reply_sender.resume(self._reply_spool, self.transport)
+        else:
+            self.reply_sender = ReplySender(self.transport, spool=self._reply_spool)
 
         self.poll_thread = threading.Thread(
                 name='oadr2.poll',
@@ -124,9 +232,17 @@ class OpenADR2(base.BaseHandler):
         Shutdown the HTTP client, join the running threads and exit.
         '''
 
-        if self.poll_thread is not None:
+        if self.engine is not None:
+            self.engine.remove(self)
+
+        if self.poll_thread is not None and self.poll_thread.is_alive():
             self.poll_thread.join(2)        # they are daemons.
 
+        if self.engine is not None:
+            self.reply_sender.discard(self.transport)   # shared; the engine closes it
+        else:
+            self.reply_sender.close()
+        self.transport.close()
         super(OpenADR2,self).exit()
    
 
@@ -136,68 +252,223 @@ class OpenADR2(base.BaseHandler):
         '''
 
         while not self._exit.is_set():
-            try:
-                self.query_vtn()
+            self._exit.wait(self.poll_once())
+        logging.info(" +++++++++++++++ OADR2 polling thread has exited." )
 
-            except urllib2.HTTPError as ex: # 4xx or 5xx HTTP response:
-                logging.warn("HTTP error: %s\n%s", ex, ex.read())
 
-            except urllib2.URLError, ex: # network error.
-                logging.debug("Network error: %s", ex)
+    def poll_once(self):
+        '''
+        Query the VTN once, logging (rather than raising) any errors.
 
-            except Exception, ex:
-                logging.exception("Error in OADR2 poll thread: %s",ex)
+        Returns: Seconds to wait until the next poll (see `next_poll_interval()`)
+        '''
 
-            self._exit.wait(self.vtn_poll_interval)
-        logging.info(" +++++++++++++++ OADR2 polling thread has exited." )
+        try:
+            self.query_vtn()
+            self.poll_errors = 0
+
+        except urllib2.HTTPError as ex: # 4xx or 5xx HTTP response:
+            logging.warn("HTTP error: %s\n%s", ex, ex.read())
+            self.poll_errors += 1
+
+        except urllib2.URLError, ex: # network error.
+            logging.debug("Network error: %s", ex)
+            self.poll_errors += 1
+
+        except Exception, ex:
+            logging.exception("Error in OADR2 poll thread: %s",ex)
+
+        try:
+            return self.next_poll_interval()
+        finally:
+            if self.engine is not None:
+                # An engine worker polls many targets; don't keep a
+                # connection to each one's database open on every worker
+                self.event_handler.db.release()
+
+
+    def next_poll_interval(self, now=None):
+        '''
+        Work out how long to wait until the next poll, between
+        `min_poll_interval` and `max_poll_interval`:
+
+         * After failed polls, back off exponentially (with some jitter, so
+           that many VENs don't all come back at once); up to
+           `MAX_BACKOFF_INTERVAL`, or `max_poll_interval` if that's longer
+         * While an event is running, every `vtn_poll_interval`
+         * Before the next event (or its start tolerance window), poll a few
+           times as it gets closer; so changes right before it starts are
+           picked up
+         * With no events at all, every `max_poll_interval`
+
+        now -- datetime (UTC) to check against, defaults to utcnow()
+
+        Returns: Seconds until the next poll
+        '''
+
+        interval = self.vtn_poll_interval
+        if self.poll_errors:
+            backoff = min(max(self.max_poll_interval, MAX_BACKOFF_INTERVAL),
+                    interval * 2 ** min(self.poll_errors, MAX_BACKOFF_EXPONENT))
+            return random.uniform(max(interval, backoff / 2.0), backoff)
+
+        if self.min_poll_interval == self.max_poll_interval:
+            return interval     # nothing to work out
+
+        timestamp = schedule.dttm_to_timestamp(now) if now is not None else time.time()
+        running = bool(self.event_handler.get_active_records(within=0, now=now))
+        next_start = self.event_handler.get_next_start(now)
+
+        if next_start is not None:
+            interval = (next_start - timestamp) / POLL_PROXIMITY_DIVISOR
+        elif not running:
+            interval = self.max_poll_interval
+
+        if running:
+            interval = min(interval, self.vtn_poll_interval)
+
+        return min(max(interval, self.min_poll_interval), self.max_poll_interval)
 
 
     def query_vtn(self):
         '''
         Query the VTN for an event.
+
+        With `use_oadr_poll`, an oadrPoll is sent instead; the events are only
+        requested when the VTN has something for us that isn't a distribution
+        of its own.  (The events are requested until a full set of them has
+        been handled, so we start off in sync.)
         '''
 
         if not self.vtn_base_uri:
             logging.warn("VTN base URI is invalid: %s", self.vtn_base_uri)
             return
 
+        if self.use_oadr_poll and self._synced and not self._poll_vtn():
+            return
+
+        if self._request_events():
+            self._synced = True
+
+
+    def _request_events(self):
+        '''
+        Request all of the events from the VTN with an oadrRequestEvent.
+
+        Returns: True if the VTN's payload was handled, False if it couldn't be
+        '''
+
         event_uri = self.vtn_base_uri + 'EiEvent'
         payload = self.event_handler.build_request_payload()
 
         # Make the request
-        req = urllib2.Request(event_uri, etree.tostring(payload), dict(DEFAULT_HEADERS))
-        logging.debug( 'Request to: %s\n%s\n----', req.get_full_url(), 
+        logging.debug( 'Request to: %s\n%s\n----', event_uri, 
                 etree.tostring(payload, pretty_print=True) )
 
         # Get the response
-        resp = self.http.open(req, None, REQUEST_TIMEOUT)
-        data = resp.read()
-        resp.close()
+        resp = self.transport.request(event_uri, etree.tostring(payload), DEFAULT_HEADERS)
 #        logging.debug("EiRequestEvent response: %s\n%s", resp.getcode(), data)
 
         if resp.headers.gettype() != CONTENT_TYPE:
             logging.warn('Unexpected content type')
 
         reply = None
+        handled = False
         try:
-            payload = etree.fromstring(data)
-            logging.debug('Got Payload:\n%s\n----', etree.tostring(payload, pretty_print=True))
-            reply = self.event_handler.handle_payload(payload)
+            if self.stream_payloads:
+                # Events are handled as they come off the wire
+                reply = self.event_handler.handle_payload_stream(resp)
+
+            else:
+                payload = read_payload(resp)
+                if logging.getLogger().isEnabledFor(logging.DEBUG):
+                    logging.debug('Got Payload:\n%s\n----', etree.tostring(payload, pretty_print=True))
+                reply = self.event_handler.handle_payload(payload)
+            handled = True
 
         except Exception as ex:
             logging.warn("error parsing payload: %s", ex)
 
+        finally:
+            resp.close()
+
+        self._send_reply(reply, event_uri)
+        return handled
+
+
+    def _poll_vtn(self):
+        '''
+        Ask the VTN if it has anything for us with an oadrPoll.  An
+        oadrResponse means nothing changed, so there's nothing to do; an
+        oadrDistributeEvent is handled right away.
+
+        Returns: True if the events need to be requested, False if not
+        '''
+
+        poll_uri = self.vtn_base_uri + 'OadrPoll'
+        payload = self.event_handler.build_poll_payload()
+        logging.debug('Poll to: %s', poll_uri)
+
+        resp = self.transport.request(poll_uri, etree.tostring(payload), DEFAULT_HEADERS)
+        try:
+            payload = read_payload(resp)
+        except etree.XMLSyntaxError as ex:
+            logging.warn("error parsing oadrPoll response: %s", ex)
+            return True
+        finally:
+            resp.close()
+
+        ns_map = self.event_handler.ns_map
+        if payload.tag == '{%s}oadrResponse' % ns_map['oadr']:
+            # Nothing new
+            code = payload.findtext('ei:eiResponse/ei:responseCode', namespaces=ns_map)
+            if code != '200':
+                logging.warn('oadrPoll response from VTN: %s %s', code,
+                        payload.findtext('ei:eiResponse/ei:responseDescription', namespaces=ns_map))
+            return False
+
+        if payload.tag == '{%s}oadrDistributeEvent' % ns_map['oadr']:
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug('Got Payload:\n%s\n----', etree.tostring(payload, pretty_print=True))
+            try:
+                reply = self.event_handler.handle_payload(payload)
+            except Exception as ex:
+                logging.warn("error parsing payload: %s", ex)
+                return False
+            self._send_reply(reply, self.vtn_base_uri + 'EiEvent')
+            return False
+
+        # e.g. a registration or report request, which we don't handle here;
+        # make sure we haven't missed any events
+        logging.info('VTN answered oadrPoll with %s, requesting events', etree.QName(payload).localname)
+        return True
+
+
+    def _send_reply(self, reply, uri):
+        '''
+        Let the control loop know the events may have changed, and queue up
+        the reply (if there is one) to be sent back to the VTN.
+
+        reply -- An lxml.etree.Element object, or None
+        uri -- The URI (of the VTN) to send it to
+        '''
+
+        # tell the control loop that events may have updated; a payload that
+        # only cancels events has no reply, but the stored events changed
+        # (note `self.event_controller` is defined in base.BaseHandler)
+        version = self.event_handler.cache_version
+        if reply is not None or version != self._notified_version:
+            self._notified_version = version
+            self.event_controller.events_updated()
+
         # If we have a generated reply:
         if reply is not None:
             logging.debug('Reply to: %s\n%s\n----', 
-                    event_uri, 
+                    uri, 
                     etree.tostring(reply, pretty_print=True) )
 
-            # tell the control loop that events may have updated
-            # (note `self.event_controller` is defined in base.BaseHandler)
-            self.event_controller.events_updated()
-
-            self.send_reply(reply, event_uri)       # And send the response
+            # And send the response
+            self.reply_sender.send(reply, uri, self.transport, self._reply_spool)
 
 
     def send_reply(self, payload, uri):
@@ -209,114 +480,1034 @@ class OpenADR2(base.BaseHandler):
         uri -- The URI (of the VTN) where the response should be sent
         '''
 
-        request = urllib2.Request(uri, etree.tostring(payload), dict(DEFAULT_HEADERS))
-        resp = self.http.open(request,None,REQUEST_TIMEOUT)
+        resp = self.transport.request(uri, etree.tostring(payload), DEFAULT_HEADERS)
+        try:
+            resp.read()
+        finally:
+            resp.close()
         logging.debug("EiEvent response: %s", resp.getcode())
 
 
 
+class PollEngine(object):
+    '''
+    Polls many VTNs (or many VENs of one VTN) with a few threads, rather than
+    a thread for each one.  A scheduler thread keeps a heap of when each
+    target is next due, and hands the ones that are due to a fixed pool of
+    workers; so at most `workers` polls (and the event handling that goes
+    with them) run at once, however many targets there are.  Like the poll
+    loop, a target's next poll is scheduled its interval after the last one
+    finished, so a target is never polled twice at the same time.
+
+    A target is anything with a `poll_once()` method and a
+    `vtn_poll_interval` (in seconds); i.e. an OpenADR2 object.  If
+    `poll_once()` returns a number, that's how many seconds to wait until the
+    next poll instead.  Other periodic jobs can be run the same way with
+    `add(target, func=...)`; e.g. each OpenADR2's EventController runs its
+    control updates on the engine, rather than on a thread of its own.
+
+    The OpenADR2 objects polled by an engine also share its `dispatcher` and
+    `reply_sender`, so the number of threads stays the same however many
+    targets there are.  They each need a database of their own though (see
+    `uses_db()`).
 
-# http://stackoverflow.com/questions/1875052/using-paired-certificates-with-urllib2
-class HTTPSClientAuthHandler(urllib2.HTTPSHandler):
+    Member Variables:
+    --------
+    workers -- List of threading.Thread() objects w/ name of 'oadr2.poll'
+    scheduler_thread -- threading.Thread() object w/ name of 'oadr2.poll.scheduler'
+    dispatcher -- dispatch.Dispatcher the targets' callbacks are run on
+    reply_sender -- ReplySender the targets' replies are sent with
+    stats -- dict of counters, see `get_stats()`
+    _jobs -- dict of target -> _PollJob
+    _heap -- min-heap of (due time, sequence, _PollJob)
+    _work -- Queue.Queue of the _PollJobs that are due
+    _lock -- threading.Condition() guarding `_jobs` & `_heap`
+    _closed -- Set once `close()` is called
+    --------
     '''
-    Allows sending a client certificate with the HTTPS connection.
-    This version also validates the peer (server) certificate.
+
+    def __init__(self, workers=POLL_WORKERS, dispatch_workers=dispatch.DISPATCH_WORKERS):
+        '''
+        Start up the scheduler & worker threads
+
+        workers -- Most polls to run at once
+        dispatch_workers -- Threads to run the targets' callbacks on
+        '''
+
+        self.stats = dict.fromkeys(('polls', 'errors', 'max_lag'), 0)
+        self._jobs = {}
+        self._heap = []
+        self._sequence = itertools.count()
+        self._work = Queue.Queue()
+        self._lock = threading.Condition()
+        self._closed = False
+
+        self.dispatcher = dispatch.Dispatcher(workers=dispatch_workers)
+        self.reply_sender = ReplySender()
+
+        self.scheduler_thread = threading.Thread(
+                name='oadr2.poll.scheduler',
+                target=self._schedule)
+        self.scheduler_thread.daemon = True
+        self.scheduler_thread.start()
+
+        self.workers = []
+        for i in xrange(workers):
+            worker = threading.Thread(name='oadr2.poll', target=self._poll)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+
+    def add(self, target, interval=None, delay=0, func=None):
+        '''
+        Start polling a target.
+
+        target -- Object with a `poll_once()` method
+        interval -- Seconds between polls; by default what the target's
+                    `poll_once()` returns, or its `vtn_poll_interval`.  If
+                    there's neither, it isn't polled again until `wake()`
+        delay -- Seconds until the first poll
+        func -- What to call for each poll, instead of `target.poll_once`
+        '''
+
+        job = _PollJob(target, func if func is not None else target.poll_once, interval)
+        with self._lock:
+            old = self._jobs.get(target)
+            if old is not None:
+                old.removed = True
+            self._jobs[target] = job
+            self._push(job, time.time() + delay)
+
+
+    def remove(self, target):
+        '''
+        Stop polling a target.  A poll of it that's already running will
+        still finish.
+        '''
+
+        with self._lock:
+            job = self._jobs.pop(target, None)
+            if job is not None:
+                job.removed = True
+
+
+    def uses_db(self, db_path):
+        '''
+        Check if a target being polled keeps its events in a database.
+
+        db_path -- Path to the SQLite database
+
+        Returns: True if one of the targets' event handlers uses it
+        '''
+
+        db_path = os.path.abspath(db_path)
+        with self._lock:
+            handlers = [getattr(target, 'event_handler', None) for target in self._jobs]
+        return any(os.path.abspath(handler.db.db_path) == db_path
+                   for handler in handlers if handler is not None)
+
+
+    def wake(self, target):
+        '''
+        Poll a target now, rather than when it's next due.  If it is being
+        polled right now, it's polled again as soon as that's done.
+        '''
+
+        with self._lock:
+            job = self._jobs.get(target)
+            if job is None:
+                return
+            if job.running:
+                job.woken = True
+            else:
+                self._push(job, time.time())
+
+
+    def get_stats(self):
+        '''
+        Get a snapshot of how the engine has been doing.
+
+        Returns: A dict of:
+            targets -- how many targets are being polled
+            polls -- how many polls have been run
+            errors -- polls that raised an exception
+            max_lag -- the latest (in seconds) a poll has started after it
+                       was due; if this grows, more workers are needed
+        '''
+
+        with self._lock:
+            stats = dict(self.stats)
+            stats['targets'] = len(self._jobs)
+        return stats
+
+
+    def close(self, timeout=2):
+        '''
+        Stop polling; waits up to `timeout` seconds for running polls to finish.
+        '''
+
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+
+        end = time.time() + timeout
+        for thread in [self.scheduler_thread] + self.workers:
+            thread.join(max(end - time.time(), 0))
+
+        self.reply_sender.close(max(end - time.time(), 0))
+        self.dispatcher.close()
+
+
+    def _push(self, job, due):
+        # Any earlier entry of the job in the heap is skipped
+        job.sequence = next(self._sequence)
+        heapq.heappush(self._heap, (due, job.sequence, job))
+        if self._heap[0][2] is job:
+            self._lock.notify()     # the scheduler is waiting on a later one
+
+
+    def _schedule(self):
+        '''
+        The scheduler thread; hands targets to the workers as they are due.
+        '''
+
+        with self._lock:
+            while not self._closed:
+                if not self._heap:
+                    self._lock.wait()
+                    continue
+
+                due, seq, job = self._heap[0]
+                wait = due - time.time()
+                if wait > 0:
+                    self._lock.wait(wait)
+                    continue
+
+                heapq.heappop(self._heap)
+                if not job.removed and seq == job.sequence:
+                    job.due = due
+                    job.running = True
+                    job.woken = False
+                    self._work.put(job)
+
+        for worker in self.workers:
+            self._work.put(None)
+
+
+    def _poll(self):
+        '''
+        A worker thread; polls the targets the scheduler hands it.
+        '''
+
+        while True:
+            job = self._work.get()
+            if job is None:
+                return
+
+            start = time.time()
+            error = False
+            wait = None
+            try:
+                wait = job.func()
+            except Exception as ex:
+                logging.exception("Error polling %r: %s", job.target, ex)
+                error = True
+
+            with self._lock:
+                self.stats['polls'] += 1
+                self.stats['errors'] += error
+                self.stats['max_lag'] = max(self.stats['max_lag'], start - job.due)
+
+                job.running = False
+                if not job.removed and not self._closed:
+                    if job.woken:
+                        wait = 0
+                    elif job.interval is not None:
+                        wait = job.interval
+                    elif wait is None:
+                        wait = getattr(job.target, 'vtn_poll_interval', None)
+                    if wait is not None:
+                        self._push(job, time.time() + wait)
+
+
+
+class _PollJob(object):
     '''
+    A target being polled by a PollEngine.
+
+    Member Variables:
+    --------
+    target -- The object being polled
+    func -- What to call for each poll
+    interval -- Seconds between polls, or None for the target's own
+    due -- When the poll running now was due
+    sequence -- Sequence number of the job's latest entry in the heap
+    running -- Set while it's handed to (or being polled by) a worker
+    woken -- Set if `PollEngine.wake()` was called while it was running
+    removed -- Set when the target shouldn't be polled anymore
+    --------
+    '''
+
+    __slots__ = ('target', 'func', 'interval', 'due', 'sequence', 'running',
+                 'woken', 'removed')
+
+    def __init__(self, target, func, interval):
+        self.target = target
+        self.func = func
+        self.interval = interval
+        self.due = None
+        self.sequence = None
+        self.running = False
+        self.woken = False
+        self.removed = False
+
 
-    def __init__(self, key, cert, ca_certs, ssl_version=None, ciphers=None):
+
+class ReplySender(object):
+    '''
+    Sends replies to the VTN on a thread of its own, so a slow or failing
+    reply doesn't hold up polling.  A reply that fails is retried with
+    exponential backoff (plus some jitter), unless the VTN rejected it with a
+    4xx; after `max_attempts` it's given up on.  Replies can also be spooled
+    to the database, so ones that haven't been sent yet are picked back up
+    after a restart.
+
+    One sender can be shared by many OpenADR2 objects (see PollEngine); each
+    of their replies is sent with its own transport and spooled to its own
+    database.
+
+    Member Variables:
+    --------
+    transport -- HTTPTransport to send replies with, by default
+    spool -- database.DBHandler to spool replies to by default, or None
+    max_queue -- Most replies that can be waiting to be sent
+    max_attempts -- Tries before giving up on a reply
+    retry_interval -- Seconds before the first retry of a reply
+    max_retry_interval -- Longest wait between retries
+    send_thread -- threading.Thread() object w/ name of 'oadr2.poll.reply'
+    stats -- dict of counters, see `get_stats()`
+    _heap -- min-heap of (time to send, sequence, _Reply)
+    _sending -- The _Reply being sent right now, or None
+    _lock -- threading.Condition() guarding `_heap` & `_sending`
+    _closed -- Set once `close()` is called
+    --------
+    '''
+
+    def __init__(self, transport=None, spool=None, max_queue=REPLY_QUEUE_SIZE,
+                 max_attempts=REPLY_MAX_ATTEMPTS,
+                 retry_interval=REPLY_RETRY_INTERVAL,
+                 max_retry_interval=REPLY_MAX_RETRY_INTERVAL):
         '''
-        Intiailize the Client Authentication Handler
-        
-        key -- An encryption key
-        cert -- A Certificate
-        ca_certs -- CA Certificates
-        ssl_version -- What version of SSL are we using
-        ciphers -- What encryption method
+        Start up the sending thread, with any replies left in the spool
+
+        transport -- HTTPTransport to send replies with, unless `send()` is
+                     given another one
+        spool -- database.DBHandler to spool replies to, or None to only keep
+                 them in memory (unless `send()` is given one)
+        max_queue -- Most replies that can be waiting to be sent
+        max_attempts -- Tries before giving up on a reply
+        retry_interval -- Seconds before the first retry of a reply
+        max_retry_interval -- Longest wait between retries
         '''
 
-        urllib2.HTTPSHandler.__init__(self)
-        self.key = key
-        self.cert = cert
-        self.ca_certs = ca_certs
-        self.ssl_version = ssl_version
-        self.ciphers = ciphers
+        self.transport = transport
+        self.spool = spool
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
 
+        self.stats = dict.fromkeys(('sent', 'retries', 'failed', 'dropped'), 0)
+        self._heap = []
+        self._sequence = itertools.count()
+        self._sending = None
+        self._lock = threading.Condition()
+        self._closed = False
 
-    def https_open(self, req):
+        if self.spool is not None:
+            self.resume(self.spool)
+
+        self.send_thread = threading.Thread(
+                name='oadr2.poll.reply',
+                target=self._send_loop)
+        self.send_thread.daemon = True
+        self.send_thread.start()
+
+
+    def resume(self, spool, transport=None):
         '''
-        Open a connection.
-        Rather than pass in a reference to a connection class, we pass in
-        a reference to a function which, for all intents and purposes,
-        will behave as a constructor
+        Queue up the replies left in a spool.
 
-        req -- A request
+        spool -- database.DBHandler the replies were spooled to
+        transport -- HTTPTransport to send them with, or None for `transport`
         '''
 
-        return self.do_open(self.get_connection, req)
+        transport = transport if transport is not None else self.transport
+        with self._lock:
+            replies = spool.get_replies()
+            for reply_id, uri, body, attempts in replies:
+                self._push(_Reply(uri, body, reply_id, attempts, transport, spool),
+                        time.time())
+        if replies:
+            logging.info('%d replies left in the spool', len(replies))
 
 
-    def get_connection(self, host, timeout=REQUEST_TIMEOUT):
+    def send(self, payload, uri, transport=None, spool=None):
         '''
-        Gets a HTTPS connection.
+        Queue up a reply to be sent.
 
-        host -- What host
-        timeout -- How long to wait.
+        payload -- An lxml.etree.ElementTree object (or XML string) of the
+                   OpenADR 2.0 payload
+        uri -- The URI (of the VTN) where the response should be sent
+        transport -- HTTPTransport to send it with, or None for `transport`
+        spool -- database.DBHandler to spool it to, or None for `spool`
 
-        Return HTTPSConnection object
+        Returns: True if it was queued, False if the queue is full (or the
+            sender is closed)
         '''
 
-        return HTTPSConnection( host, 
-                key_file = self.key, 
-                cert_file = self.cert,
-                timeout = timeout,
-                ciphers = self.ciphers,
-                ca_certs = self.ca_certs, 
-                ssl_version = self.ssl_version )
+        body = etree.tostring(payload) if not isinstance(payload, basestring) else payload
+        transport = transport if transport is not None else self.transport
+        spool = spool if spool is not None else self.spool
+
+        with self._lock:
+            if self._closed:
+                self.stats['dropped'] += 1
+                logging.warn('Reply sender is closed, dropping reply to %s', uri)
+                return False
 
+            queued = len(self._heap) + (self._sending is not None)
+            if queued >= self.max_queue:
+                self.stats['dropped'] += 1
+                logging.warn('Reply queue is full, dropping reply to %s', uri)
+                return False
 
+            # Spooled under the lock too, so the queue can't go over max_queue
+            reply_id = spool.add_reply(uri, body) if spool is not None else None
+            self._push(_Reply(uri, body, reply_id, 0, transport, spool), time.time())
+        return True
+
+
+    def discard(self, transport):
+        '''
+        Stop sending the replies that go out with `transport` (i.e. its
+        OpenADR2 object is exiting).  Spooled ones stay in the spool for
+        next time.
+        '''
 
-class HTTPSConnection(httplib.HTTPSConnection):
+        with self._lock:
+            keep = [item for item in self._heap if item[2].transport is not transport]
+            dropped = [item[2] for item in self._heap if item[2].transport is transport]
+            if dropped:
+                self._heap = keep
+                heapq.heapify(self._heap)
+                self._lock.notify_all()
+
+            # Not retried if it fails
+            if self._sending is not None and self._sending.transport is transport:
+                self._sending.discarded = True
+
+        unspooled = sum(1 for reply in dropped if reply.reply_id is None)
+        if unspooled:
+            logging.warn('Dropping %d replies that were not sent', unspooled)
+
+
+    def get_stats(self):
+        '''
+        Returns: A dict of the number of replies `sent`, `retries`, `failed`
+            (given up on), `dropped` (because the queue was full) and
+            `queued` (waiting to be sent now)
+        '''
+
+        with self._lock:
+            stats = dict(self.stats)
+            stats['queued'] = len(self._heap)
+        return stats
+
+
+    def join(self, timeout=None):
+        '''
+        Wait until there are no replies left to send.
+
+        Returns: True if they were all sent (or given up on), False if it
+            timed out
+        '''
+
+        end = time.time() + timeout if timeout is not None else None
+        with self._lock:
+            while self._heap or self._sending is not None:
+                remaining = end - time.time() if end is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+        return True
+
+
+    def close(self, timeout=2):
+        '''
+        Stop sending.  Replies that haven't been sent yet stay in the spool
+        (if there is one) for next time.
+        '''
+
+        with self._lock:
+            self._closed = True
+            unspooled = sum(1 for item in self._heap if item[2].reply_id is None)
+            if unspooled:
+                logging.warn('Dropping %d replies that were not sent', unspooled)
+            self._lock.notify_all()
+        self.send_thread.join(timeout)
+
+
+    def _push(self, reply, when):
+        heapq.heappush(self._heap, (when, next(self._sequence), reply))
+        self._lock.notify_all()
+
+
+    def _send_loop(self):
+        '''
+        The sending thread; sends replies as they come due.
+        '''
+
+        while True:
+            with self._lock:
+                while not self._closed:
+                    wait = self._heap[0][0] - time.time() if self._heap else None
+                    if wait is not None and wait <= 0:
+                        break
+                    self._lock.wait(wait)
+                if self._closed:
+                    return
+                self._sending = heapq.heappop(self._heap)[2]
+
+            reply = self._sending
+            retry_at = None
+            try:
+                retry_at = self._send(reply)
+            except Exception as ex:
+                # e.g. the spool couldn't be updated; don't take the thread down
+                logging.exception("Error handling reply to %s: %s", reply.uri, ex)
+
+            with self._lock:
+                if retry_at is not None and not self._closed and not reply.discarded:
+                    self._push(reply, retry_at)
+                self._sending = None
+                self._lock.notify_all()
+
+
+    def _send(self, reply):
+        '''
+        Try to send a reply.
+
+        Returns: When to try again, or None if it's done with
+        '''
+
+        try:
+            resp = reply.transport.request(reply.uri, reply.body, DEFAULT_HEADERS)
+            try:
+                resp.read()
+            finally:
+                resp.close()
+
+        except urllib2.HTTPError as ex:
+            logging.warn("HTTP error sending reply: %s\n%s", ex, ex.read())
+            if 400 <= ex.code < 500:
+                self._finish(reply, 'failed')   # it won't do any better next time
+                return None
+
+        except urllib2.URLError as ex:
+            logging.debug("Network error sending reply: %s", ex)
+
+        except Exception as ex:
+            logging.exception("Error sending reply: %s", ex)
+
+        else:
+            # Outside of the try, so a spool error doesn't send it again
+            logging.debug("EiEvent response: %s", resp.getcode())
+            self._finish(reply, 'sent')
+            return None
+
+        reply.attempts += 1
+        if reply.attempts >= self.max_attempts:
+            logging.warn('Giving up on reply to %s after %d attempts', reply.uri, reply.attempts)
+            self._finish(reply, 'failed')
+            return None
+
+        if reply.reply_id is not None:
+            reply.spool.update_reply(reply.reply_id, reply.attempts)
+        with self._lock:
+            self.stats['retries'] += 1
+
+        backoff = min(self.max_retry_interval, self.retry_interval * 2 ** (reply.attempts - 1))
+        return time.time() + random.uniform(backoff / 2.0, backoff)
+
+
+    def _finish(self, reply, outcome):
+        with self._lock:
+            self.stats[outcome] += 1
+        if reply.reply_id is not None:
+            reply.spool.remove_reply(reply.reply_id)
+
+
+
+class _Reply(object):
+    '''
+    A reply waiting to be sent.
+
+    Member Variables:
+    --------
+    uri -- Where it goes
+    body -- The payload, an XML string
+    reply_id -- ID in the spool, or None
+    attempts -- How many times it has been tried
+    transport -- HTTPTransport to send it with
+    spool -- database.DBHandler it is spooled to, or None
+    discarded -- Set if it shouldn't be retried, see `ReplySender.discard()`
+    --------
+    '''
+
+    __slots__ = ('uri', 'body', 'reply_id', 'attempts', 'transport', 'spool',
+                 'discarded')
+
+    def __init__(self, uri, body, reply_id, attempts, transport, spool):
+        self.uri = uri
+        self.body = body
+        self.reply_id = reply_id
+        self.attempts = attempts
+        self.transport = transport
+        self.spool = spool
+        self.discarded = False
+
+
+
+def read_payload(resp):
+    '''
+    Parse a response as it is read, rather than reading all of it into a
+    string first.
+
+    resp -- A file-like object, i.e. a PooledResponse
+
+    Returns: An lxml.etree.Element object of the payload
+    '''
+
+    parser = etree.XMLParser()
+    while True:
+        data = resp.read(READ_CHUNK_SIZE)
+        if not data:
+            break
+        parser.feed(data)
+    return parser.close()
+
+
+
+def build_ssl_context(key, cert, ca_certs, ssl_version=ssl.PROTOCOL_SSLv23, ciphers=None):
+    '''
+    Build the SSL context for talking to the VTN: the peer certificate is
+    validated if there are CA certs, but not its hostname.
+
+    key -- Client certificate key file
+    cert -- Client certificate file
+    ca_certs -- CA Certificates to validate the VTN with (or None)
+    ssl_version -- What version of SSL are we using
+    ciphers -- What encryption method
+
+    Returns: an ssl.SSLContext
+    '''
+
+    if ca_certs and not os.path.isfile( ca_certs ):
+        logging.warn("CA certs file does not exist: %s", ca_certs)
+
+    context = ssl.SSLContext(ssl_version)
+    context.check_hostname = False
+    if ca_certs:
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.load_verify_locations(ca_certs)
+    if cert or key:
+        context.load_cert_chain(cert or key, key)
+    if ciphers:
+        context.set_ciphers(ciphers)
+
+    return context
+
+
+
+class HTTPTransport(object):
     '''
-    Overridden to allow peer certificate validation, configuration
-    of SSL/ TLS version and cipher selection.  See:
-    http://hg.python.org/cpython/file/c1c45755397b/Lib/httplib.py#l1144
-    and `ssl.wrap_socket()`
+    Sends requests over persistent (keep-alive) HTTP & HTTPS connections.
+    Idle connections are kept around for the next request to the same host,
+    so polling doesn't pay for a new TCP connection and TLS handshake every
+    time.  All HTTPS connections share one SSL context (i.e. the certs are
+    only loaded once).  An idle connection the server has closed is thrown
+    away before a request goes out on it.  If a reused connection fails
+    once the request is on its way, idempotent requests (see
+    `RETRY_METHODS`) are sent again on a new one.  A POST may have been
+    handled already, so it's only sent again (once, on a new connection)
+    if the server closed the connection without any of a response coming
+    back, i.e. it went idle just as the request went out.
+
+    Unlike urllib2, redirects aren't followed (a 3xx is returned as it is)
+    and proxies (i.e. from the `http_proxy` environment variables) aren't
+    used; a VTN should be reached directly.
+
+    With `compress`, the server is asked for gzip or deflate compressed
+    responses, which are decompressed as they are read.  With
+    `compress_requests` as well, request bodies are gzipped to hosts that
+    have sent compressed responses (there's no way to ask first); if one
+    answers a compressed request with a 415, it's sent again uncompressed
+    and that host doesn't get compressed requests any more.
+
+    Errors are raised like urllib2 does; urllib2.HTTPError for 4xx & 5xx
+    responses and urllib2.URLError for network errors.
+
+    Member Variables:
+    --------
+    ssl_context -- ssl.SSLContext for HTTPS connections
+    timeout -- Request timeout, in seconds
+    keepalive_timeout -- Don't reuse connections idle for longer than this
+    max_idle -- Most idle connections to keep for each host
+    compress -- Ask for compressed responses
+    compress_requests -- Compress requests to hosts that compress responses
+    connects -- How many connections have been opened
+    _gzip_hosts -- dict of (scheme, host:port) -> True for hosts that have
+                   sent compressed responses, False once they've refused a
+                   compressed request
+    _idle -- dict of (scheme, host:port) -> list of (connection, time idle since)
+    _lock -- threading.Lock() guarding `_idle`
+    --------
     '''
 
-    def __init__(self, host, **kwargs):
+    def __init__(self, ssl_context=None, timeout=REQUEST_TIMEOUT,
+                 keepalive_timeout=KEEPALIVE_TIMEOUT, max_idle=MAX_IDLE_CONNECTIONS,
+                 compress=True, compress_requests=False):
+        '''
+        ssl_context -- ssl.SSLContext for HTTPS connections; None for the
+                       default one (see `ssl.create_default_context()`)
+        timeout -- Request timeout, in seconds
+        keepalive_timeout -- Don't reuse connections idle for longer than this
+        max_idle -- Most idle connections to keep for each host
+        compress -- Ask for compressed responses
+        compress_requests -- gzip request bodies to hosts that have sent
+                             compressed responses
         '''
-        Initilize the HTTPS conneciton
 
-        host -- See httplib.HTTPSConnection's documentation
-        kwargs -- See httplib.HTTPSConnection's documentation
+        self.ssl_context = ssl_context if ssl_context is not None \
+                else ssl.create_default_context()
+        self.timeout = timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.max_idle = max_idle
+        self.compress = compress
+        self.compress_requests = compress_requests
+        self.connects = 0
+        self._gzip_hosts = {}
+        self._idle = {}
+        self._lock = threading.Lock()
+
+
+    def request(self, uri, body=None, headers={}, method='POST'):
+        '''
+        Send a request.
+
+        uri -- Full URI to send it to
+        body -- String of the request body
+        headers -- dict of request headers
+        method -- HTTP method
+
+        Returns: A PooledResponse.  Read all of it or close it, so that the
+            connection can be used again.
+        '''
+
+        parts = urlparse.urlsplit(uri)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        headers = dict(headers)
+        if self.compress:
+            headers.setdefault('accept-encoding', ACCEPT_ENCODING)
+        compressed = self.compress_requests and self._gzip_hosts.get(key) \
+                and body is not None and len(body) >= MIN_COMPRESS_SIZE
+        if compressed:
+            plain_body, body = body, gzip_compress(body)
+            headers['content-encoding'] = 'gzip'
+
+        resent = False
+        while True:
+            conn, reused = self._get_connection(key, reuse=not resent)
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                    # Small requests go out right away, rather than waiting
+                    # on the ACK of the last one (Nagle's algorithm)
+                    conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                conn.request(method, path, body, headers)
+                resp = conn.getresponse()
+                break
+
+            except (socket.error, httplib.HTTPException) as ex:
+                conn.close()
+
+                # The server closed it just as we used it; try a new one, if
+                # the request can safely be sent twice
+                if reused and method in RETRY_METHODS and not isinstance(ex, socket.timeout):
+                    logging.debug("Connection to %s was closed, reconnecting: %s", parts.netloc, ex)
+                    continue
+                if reused and not resent and _nothing_received(ex):
+                    logging.debug("Connection to %s was closed, sending again: %s", parts.netloc, ex)
+                    resent = True
+                    continue
+                raise urllib2.URLError(ex)
+
+        response = PooledResponse(self, key, conn, resp)
+        if response.encoding is not None and self.compress_requests:
+            self._gzip_hosts.setdefault(key, True)
+
+        if compressed and resp.status == 415:
+            logging.info("%s doesn't take compressed requests", parts.netloc)
+            response.close()
+            self._gzip_hosts[key] = False
+            headers.pop('content-encoding')
+            return self.request(uri, plain_body, headers, method)
+
+        if resp.status >= 400:
+            raise urllib2.HTTPError(uri, resp.status, resp.reason, resp.msg, response)
+        return response
+
+
+    def close(self):
+        '''
+        Close all of the idle connections.
+        '''
+
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.itervalues():
+            for conn, since in conns:
+                conn.close()
+
+
+    def _get_connection(self, key, reuse=True):
         '''
+        Take an idle connection to the host, or open a new one.
 
-        self.ciphers = kwargs.pop('ciphers',None)
-        self.ca_certs = kwargs.pop('ca_certs',None)
-        self.ssl_version = kwargs.pop('ssl_version',ssl.PROTOCOL_SSLv23)
+        key -- (scheme, host:port)
+        reuse -- False to always open a new one
 
-        httplib.HTTPSConnection.__init__(self,host,**kwargs)
+        Returns: (httplib.HTTPConnection, True if it has been used before)
+        '''
 
-    def connect(self):
+        stale = []
+        conn = None
+        with self._lock:
+            conns = self._idle.get(key) if reuse else None
+            while conns:
+                conn, since = conns.pop()
+                if time.time() - since < self.keepalive_timeout and not _is_dropped(conn):
+                    break
+                stale.append(conn)
+                conn = None
+
+        for old in stale:
+            old.close()
+        if conn is not None:
+            return conn, True
+
+        scheme, host = key
+        self.connects += 1
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=self.timeout,
+                    context=self.ssl_context), False
+        return httplib.HTTPConnection(host, timeout=self.timeout), False
+
+
+    def _release(self, key, conn):
         '''
-        Connect to the server.
+        Put a connection back to be used again.
         '''
 
-        sock = socket.create_connection( (self.host, self.port), self.timeout )
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.max_idle:
+                conns.append((conn, time.time()))
+                return
+        conn.close()
+
+
+
+def _nothing_received(ex):
+    '''
+    Check why a request on a reused connection failed.  A keep-alive
+    connection the server closes (or resets) while it's idle fails with
+    no status line, or a reset/broken pipe, before any of a response.
+
+    ex -- The socket.error or httplib.HTTPException
+
+    Returns: True if none of the response was read, so the request can be
+        sent again
+    '''
+
+    if isinstance(ex, httplib.BadStatusLine):
+        # The wording for an empty status line depends on the python version
+        line = ex.line or ''
+        return line in ("''", '""') or line.startswith('No status line received')
+    if isinstance(ex, socket.timeout):
+        return False
+    return isinstance(ex, socket.error) and \
+            ex.errno in (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE)
 
-        if self._tunnel_host:
-            self.sock = sock
-            self._tunnel()
 
-        if self.ca_certs and not os.path.isfile( self.ca_certs ):
-                logging.warn("CA certs file does not exist: %s", self.ca_certs)
-            
-        self.sock = ssl.wrap_socket( sock, 
-                self.key_file, self.cert_file,
-                ca_certs = self.ca_certs,
-                ciphers = self.ciphers,  # NOTE: This is Python 2.7-only!
-                cert_reqs = ssl.CERT_REQUIRED if self.ca_certs else ssl.CERT_NONE,
-                ssl_version = self.ssl_version )
 
+def _is_dropped(conn):
+    '''
+    Check an idle connection before it's used again.  There's nothing for
+    the server to send on one, so if it can be read from the server has
+    closed it (or it's otherwise no good).
+
+    Returns: True if the connection shouldn't be used
+    '''
+
+    if conn.sock is None:
+        return True
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return True
+    return bool(readable)
+
+
+
+class PooledResponse(object):
+    '''
+    A response from HTTPTransport; works like the ones urllib2 returns.  Once
+    it has been read to the end, the connection goes back to the transport.
+    A gzip or deflate compressed body is decompressed as it is read.
+
+    Member Variables:
+    --------
+    headers -- The response headers, a httplib.HTTPMessage
+    encoding -- 'gzip' or 'deflate' if the body is compressed, else None
+    _transport -- The HTTPTransport it came from
+    _key -- (scheme, host:port) of the connection
+    _conn -- The httplib.HTTPConnection, until it is released or closed
+    _resp -- The httplib.HTTPResponse
+    _decompressor -- zlib decompress object for a compressed body, once
+                     it has started coming in
+    _buffer -- Decompressed data that hasn't been read yet
+    --------
+    '''
+
+    def __init__(self, transport, key, conn, resp):
+        self.headers = resp.msg
+        self._transport = transport
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+
+        self.encoding = (resp.getheader('content-encoding') or '').strip().lower()
+        if self.encoding not in ('gzip', 'deflate'):
+            self.encoding = None
+        self._decompressor = None       # see `_decompress()`
+        self._buffer = ''
+
+
+    def read(self, amt=None):
+        '''
+        Read the response body (or up to `amt` bytes of it).
+        '''
+
+        if self.encoding is None:
+            return self._read(amt)
+
+        if amt is None:
+            data = self._buffer + self._decompress(self._read())
+            self._buffer = ''
+            return data
+
+        while len(self._buffer) < amt and self._conn is not None:
+            self._buffer += self._decompress(self._read(READ_CHUNK_SIZE))
+        data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return data
+
+
+    def readline(self, limit=-1):
+        if self.encoding is not None:
+            while '\n' not in self._buffer and self._conn is not None:
+                self._buffer += self._decompress(self._read(READ_CHUNK_SIZE))
+            end = self._buffer.find('\n') + 1 or len(self._buffer)
+            if limit >= 0:
+                end = min(end, limit)
+            line, self._buffer = self._buffer[:end], self._buffer[end:]
+            return line
+
+        line = self._resp.fp.readline(limit) if self._resp.fp is not None else ''
+        if not line:
+            self.read()     # so the connection is released
+        return line
+
+
+    def getcode(self):
+        return self._resp.status
+
+
+    def info(self):
+        return self.headers
+
+
+    def close(self):
+        '''
+        Done with the response.  If it hasn't been read to the end, the
+        connection can't be used again.
+        '''
+
+        self._done(True)
+
+
+    def _read(self, amt=None):
+        '''
+        Read the (raw) body; releases the connection at the end of it.
+        '''
+
+        data = self._resp.read(amt)
+        if self._resp.isclosed():
+            self._done(self._resp.will_close)
+        return data
+
+
+    def _decompress(self, data):
+        if self._decompressor is None:
+            if self.encoding == 'gzip':
+                wbits = 16 + zlib.MAX_WBITS
+            elif len(data) >= 2 and ord(data[0]) & 0x0f == 8 \
+                    and (ord(data[0]) << 8 | ord(data[1])) % 31 == 0:
+                wbits = zlib.MAX_WBITS
+            else:
+                # Some servers send raw deflate data, without the zlib header
+                wbits = -zlib.MAX_WBITS
+            self._decompressor = zlib.decompressobj(wbits)
+
+        data = self._decompressor.decompress(data)
+        if self._conn is None:
+            data += self._decompressor.flush()
+        return data
+
+
+    def _done(self, close):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        if close:
+            conn.close()
+        else:
+            self._transport._release(self._key, conn)
+
+
+
+
+def gzip_compress(data):
+    '''
+    Returns: `data` gzipped
+    '''
 
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
 
@@ -0,0 +1,290 @@
+# push.OpenADR2 class
+# --------
+# Requires the python libXML wrapper "lxml"
+
+import threading, logging
+import BaseHTTPServer, SocketServer
+import ssl, socket
+from lxml import etree
+import base, poll
+
+# HTTP parameters:
+DEFAULT_PUSH_HOST = '127.0.0.1'     # address to listen for the VTN on
+DEFAULT_PUSH_PORT = 8080            # port to listen for the VTN on
+MAX_CONNECTIONS = 16                # connections handled at once, past this they're turned away
+MAX_REQUEST_SIZE = 1024 * 1024      # largest payload (in bytes) we'll take
+REQUEST_TIMEOUT = 10                # seconds to wait on a slow client
+EVENT_PATH = '/' + poll.OADR2_URI_PATH + 'EiEvent'
+
+
+
+class OpenADR2(base.BaseHandler):
+    '''
+    push.OpenADR2 is the push equivalent of poll.OpenADR2.  Rather than
+    polling, it runs an HTTP(S) server that the VTN sends oadrDistributeEvent
+    payloads to (at `EVENT_PATH`); each one is handled right away and the
+    oadrCreatedEvent is sent back as the response.
+
+    Each connection is handled on a thread of its own, up to
+    `max_connections` at once; past that they get a 503.  Payloads bigger
+    than `max_request_size` get a 413, and anything but an
+    oadrDistributeEvent gets a 400.  A connection's thread closes its
+    database connection when it is done.
+
+    By default the server only listens on the loopback address.  Anyone
+    that can reach it can cancel events (with an oadrDistributeEvent that
+    leaves them out), so before listening on other addresses set up HTTPS
+    with `vtn_ca_certs`, so that only the VTN gets in.
+
+    Member Variables:
+    --------
+    (Everything from base.BaseHandler)
+    listen_address -- (host, port) the server is listening on
+    max_connections
+    max_request_size
+    server -- The PushServer
+    server_thread -- threading.Thread() object w/ name of 'oadr2.push'
+    _payload_lock -- threading.Lock(); payloads are handled one at a time
+    '''
+
+    def __init__(self, event_config, control_opts={},
+                 listen_host=DEFAULT_PUSH_HOST, listen_port=DEFAULT_PUSH_PORT,
+                 ven_server_cert_key=None,
+                 ven_server_cert_pem=None,
+                 vtn_ca_certs=None,
+                 max_connections=MAX_CONNECTIONS,
+                 max_request_size=MAX_REQUEST_SIZE,
+                 start_thread=True):
+        '''
+        Sets up the class and starts the HTTP server.
+
+        event_config -- A dictionary containing key-word arugments for the
+                        EventHandller
+        control_opts -- a dict of opts for `control.EventController` init
+        listen_host -- Address to listen on ('' for all of them); the
+                       loopback address by default
+        listen_port -- Port to listen on (0 to pick a free one)
+        ven_server_cert_key -- Key of the server certificate; with it, the
+                               server takes HTTPS instead of HTTP
+        ven_server_cert_pem -- The server certificate
+        vtn_ca_certs -- CA Certs to check the VTN's client certificate against
+        max_connections -- Most connections to handle at once
+        max_request_size -- Largest payload (in bytes) to take
+        start_thread -- start the thread for the server or not?
+        '''
+
+        # Call the parent's methods
+        super(OpenADR2,self).__init__(event_config, control_opts)
+
+        self.max_connections = max_connections
+        self.max_request_size = max_request_size
+        self._payload_lock = threading.Lock()
+
+        ssl_context = None
+        if ven_server_cert_key:
+            logging.debug("Adding HTTPS server cert key: %s, pem: %s",
+                    ven_server_cert_key, ven_server_cert_pem)
+            ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            ssl_context.load_cert_chain(ven_server_cert_pem or ven_server_cert_key,
+                    ven_server_cert_key)
+            if vtn_ca_certs:
+                ssl_context.load_verify_locations(vtn_ca_certs)
+                ssl_context.verify_mode = ssl.CERT_REQUIRED
+
+        if vtn_ca_certs is None or ssl_context is None:
+            if listen_host not in ('127.0.0.1', 'localhost', '::1'):
+                logging.warn("Listening on '%s' without checking the VTN's "
+                        "client certificate; anyone can push events", listen_host)
+
+        self.server = PushServer((listen_host, listen_port), self, ssl_context)
+        self.listen_address = self.server.server_address
+
+        self.server_thread = threading.Thread(
+                name='oadr2.push',
+                target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        if start_thread:
+            self.server_thread.start()
+
+        logging.info( " +++++++++++++++ OADR2 push module listening on %s:%d",
+                *self.listen_address )
+
+
+    def handle_payload(self, body):
+        '''
+        Handle a payload pushed by the VTN.
+
+        body -- The request body, an XML string
+
+        Returns: An lxml.etree.Element object of the response payload, or None
+
+        Raises: ValueError if it isn't an oadrDistributeEvent (or isn't XML)
+        '''
+
+        payload = etree.fromstring(body)
+        expected = '{%s}oadrDistributeEvent' % self.event_handler.ns_map['oadr']
+        if payload.tag != expected:
+            raise ValueError('Expected %s, got %s' % (expected, payload.tag))
+
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('Got Payload:\n%s\n----', etree.tostring(payload, pretty_print=True))
+
+        with self._payload_lock:
+            reply = self.event_handler.handle_payload(payload)
+
+        # tell the control loop that events may have updated
+        self.event_controller.events_updated()
+        return reply
+
+
+    def exit(self):
+        '''
+        Stop the server, then shutdown the rest of the handler.
+        '''
+
+        if self.server_thread.is_alive():
+            self.server.shutdown()
+        self.server.server_close()
+
+        super(OpenADR2,self).exit()
+
+
+
+class PushServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    The HTTP(S) server of push.OpenADR2.  Turns connections away once there
+    are `handler.max_connections` of them; for HTTPS, the TLS handshake is
+    done on the connection's own thread so a slow client can't hold up the
+    others.
+
+    Plain HTTP clients that are turned away get a 503.  HTTPS clients are
+    just disconnected (they see a reset): a 503 would need the handshake
+    done first, on the thread that accepts connections, which is what the
+    limit is there to protect.
+
+    Member Variables:
+    --------
+    handler -- The push.OpenADR2 object
+    ssl_context -- ssl.SSLContext for HTTPS, or None for plain HTTP
+    active -- How many connections are being handled
+    _active_lock -- threading.Lock() guarding `active`
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, handler, ssl_context=None):
+        self.handler = handler
+        self.ssl_context = ssl_context
+        self.active = 0
+        self._active_lock = threading.Lock()
+
+        BaseHTTPServer.HTTPServer.__init__(self, address, PushRequestHandler)
+        if ssl_context is not None:
+            self.socket = ssl_context.wrap_socket(self.socket, server_side=True,
+                    do_handshake_on_connect=False)
+
+
+    def process_request(self, request, client_address):
+        with self._active_lock:
+            full = self.active >= self.handler.max_connections
+            if not full:
+                self.active += 1
+
+        if full:
+            logging.warn('Too many connections, turning away %s', client_address[0])
+            try:
+                if self.ssl_context is None:
+                    request.sendall('HTTP/1.0 503 Service Unavailable\r\n'
+                            'Content-Length: 0\r\nConnection: close\r\n\r\n')
+            except socket.error:
+                pass
+            self.shutdown_request(request)
+            return
+
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+
+    def process_request_thread(self, request, client_address):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            # The thread is going away; don't leave its connection open
+            self.handler.event_handler.db.release()
+            with self._active_lock:
+                self.active -= 1
+
+
+    def finish_request(self, request, client_address):
+        request.settimeout(REQUEST_TIMEOUT)
+        if self.ssl_context is not None:
+            request.do_handshake()
+        BaseHTTPServer.HTTPServer.finish_request(self, request, client_address)
+
+
+    def handle_error(self, request, client_address):
+        logging.debug('Error handling request from %s', client_address[0], exc_info=True)
+
+
+
+class PushRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Handles the VTN's requests to a push.OpenADR2 server.
+    '''
+
+    protocol_version = 'HTTP/1.1'
+    timeout = REQUEST_TIMEOUT
+    wbufsize = -1       # the whole response in one write
+
+
+    def do_POST(self):
+        handler = self.server.handler
+
+        if self.path.split('?')[0] != EVENT_PATH:
+            return self.respond(404)
+
+        try:
+            length = int(self.headers.get('content-length'))
+        except (TypeError, ValueError):
+            return self.respond(411, close=True)
+        if length > handler.max_request_size:
+            logging.warn('Payload of %d bytes from %s is too big', length, self.client_address[0])
+            return self.respond(413, close=True)
+
+        body = self.rfile.read(length)
+        try:
+            reply = handler.handle_payload(body)
+        except (etree.XMLSyntaxError, ValueError) as ex:
+            logging.warn('Bad payload from %s: %s', self.client_address[0], ex)
+            return self.respond(400)
+        except Exception as ex:
+            logging.exception('Error handling pushed payload: %s', ex)
+            return self.respond(500)
+
+        if reply is not None:
+            logging.debug('Reply to %s:\n%s\n----', self.client_address[0],
+                    etree.tostring(reply, pretty_print=True))
+        self.respond(200, etree.tostring(reply) if reply is not None else '')
+
+
+    def respond(self, code, body='', close=False):
+        '''
+        Send a response.
+
+        code -- HTTP status code
+        body -- String of the response body
+        close -- Close the connection afterwards (i.e. the request body wasn't read)
+        '''
+
+        self.send_response(code)
+        self.send_header('content-type', poll.CONTENT_TYPE)
+        self.send_header('content-length', str(len(body)))
+        if close:
+            self.send_header('connection', 'close')
+            self.close_connection = 1
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        logging.debug('%s - %s', self.client_address[0], format % args)
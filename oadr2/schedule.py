@@ -7,8 +7,10 @@ e.g. event schedules, price schedules, etc.
 __author__ = 'Thom Nichols tnichols@enernoc.com'
 
 import re
+import bisect
 import datetime
 import calendar
+import itertools
 import random
 #import logging
 from dateutil.relativedelta import relativedelta
@@ -19,6 +21,116 @@ DB_PATH = 'oadr2.db'
 DURATION_PAT = r'([+-])?P(?:(\d+)Y)?(?:(\d+)M)?(?:(\d+)D)?T?(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?'
 DURATION_REX = re.compile(DURATION_PAT)
 
+# xcal date-time; YYYY-MM-DDTHH:MM:SS[.ffffff] with a 'Z' or an offset from UTC
+DATETIME_PAT = r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(?:\.(\d{1,6}))?(?:(Z)|([+-])(\d\d):?(\d\d))\Z'
+DATETIME_REX = re.compile(DATETIME_PAT)
+
+TIMELINE_CACHE_SIZE = 16384 # max number of Timelines kept by `get_timeline()`
+DURATION_CACHE_SIZE = 256   # max number of parsed duration strings to keep
+
+# Key: (event_id, mod_num), Value: Timeline
+_timelines = {}
+
+
+class LRUCache(object):
+    '''
+    A bounded cache that drops the least recently used entries when it
+    fills up.  Safe to share between threads (at worst a value gets worked
+    out twice).
+
+    Member Variables:
+    --------
+    maxsize -- Most entries to keep
+    hits -- Number of lookups that were in the cache
+    misses -- Number of lookups that had to be worked out
+    evictions -- Number of entries dropped to make room
+    --------
+    '''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = {}      # key -> [value, last used]
+        self._clock = itertools.count()
+
+
+    def get(self, key, func):
+        '''
+        Get the value for `key`, calling `func(key)` to work it out if it
+        isn't cached.
+        '''
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            entry[1] = next(self._clock)
+            return entry[0]
+
+        self.misses += 1
+        value = func(key)
+        if len(self._entries) >= self.maxsize:
+            self._evict()
+        self._entries[key] = [value, next(self._clock)]
+        return value
+
+
+    def _evict(self):
+        '''
+        Drop the least recently used quarter of the entries, so a run of
+        misses doesn't sort the cache every time.
+        '''
+        entries = sorted(self._entries.items(), key=lambda item: item[1][1])
+        for key, entry in entries[:max(1, self.maxsize // 4)]:
+            if self._entries.pop(key, None) is not None:
+                self.evictions += 1
+
+
+    def clear(self):
+        self._entries.clear()
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Parsed duration strings, see `_load_duration()`
+duration_cache = LRUCache(DURATION_CACHE_SIZE)
+
+
+def _load_duration(dur_str):
+    '''
+    Parse a duration string once, for `duration_cache`.  Only things that
+    can't be changed are cached, since they are shared by every caller.
+
+    Returns: a 2-tuple of (`parse_duration()` tuple, datetime.timedelta of
+        the duration or None if it has years or months)
+    '''
+    groups = DURATION_REX.match(dur_str).groups()
+    vals = tuple(int(i) if i is not None else 0 for i in groups[1:])
+    sign = groups[0] or '+'
+
+    # Without years or months it is a fixed number of seconds
+    offset = None
+    if not vals[0] and not vals[1]:
+        offset = datetime.timedelta(days=vals[2], hours=vals[3],
+                minutes=vals[4], seconds=vals[5])
+
+    return (sign,) + vals, offset
+
+
+def _to_relativedelta(parsed):
+    '''
+    Make a new relativedelta from a `parse_duration()` tuple
+    '''
+    return relativedelta(
+                years= parsed[1],
+                months= parsed[2],
+                days= parsed[3],
+                hours= parsed[4],
+                minutes= parsed[5],
+                seconds= parsed[6] )
+
 
 def parse_duration(dur_str):
     '''
@@ -32,9 +144,7 @@ def parse_duration(dur_str):
     Example:
     `parse_duration('P15DT5H20S')` -> `('+', 0, 0, 15, 5, 0, 20)`
     '''
-    groups = DURATION_REX.match(dur_str).groups()
-    vals = tuple(int(i) if i is not None else 0 for i in groups[1:])
-    return (groups[0] or '+',) + vals
+    return duration_cache.get(dur_str, _load_duration)[0]
 
 
 def choose_interval(start,interval_list,now=None):
@@ -44,55 +154,168 @@ def choose_interval(start,interval_list,now=None):
     the last interval still ends at some point before 'now'.
     The return value will be -1 if the event has not started yet.
     '''
-    if now is None: now = datetime.datetime.utcnow()
-    total_time = 0
+    return Timeline(start, interval_list).choose_interval(now)
 
-    interval_start_list = durations_to_dates(
-            start, interval_list )
-#    logging.debug('All interval starts: %r', interval_start_list)
 
-    current_interval_end = None
-        
-    for i in range(len(interval_start_list)):
+def next_transition(start,interval_list,now=None):
+    '''
+    Given a list of durations, find the next interval boundary after 'now';
+    i.e. when the result of `choose_interval()` will change next.
+    The return value is a datetime, or `None` if nothing else will change:
+    the event has ended, or 'now' is in a 0 duration ('unending') interval.
+    '''
+    return Timeline(start, interval_list).next_transition(now)
+
 
-        new_interval_end = interval_start_list[i]
+def get_timeline(key,start,interval_list):
+    '''
+    Get the Timeline for an event, only working out its interval boundaries
+    again if the event's start or interval durations have changed (a VTN
+    might change them without bumping the modification number).
 
-        if new_interval_end > now: 
-            # if the new interval is > now, we are in the interval prior.  
-            # But if the prior interval is index 0, it means the event hasn't
-            # started yet, in which case return value will = -1
-            return i - 1
+    key -- Something to identify the event's intervals by, e.g.
+           `(event_id, mod_num)`
+    '''
+    interval_list = tuple(interval_list)
+    timeline = _timelines.get(key)
+    if timeline is not None and timeline.start == start \
+            and timeline.interval_list == interval_list:
+        return timeline
 
-        if new_interval_end == current_interval_end:
-            # means there was a 0 duration, which is a special case meaning 
-            # 'unending' - this interval will always include 'now'
-            return i - 1
+    if len(_timelines) >= TIMELINE_CACHE_SIZE:
+        _timelines.clear()
 
-        # else look at next interval: 
-        current_interval_end = new_interval_end
+    timeline = Timeline(start, interval_list)
+    _timelines[key] = timeline
+    return timeline
 
-    # the last interval still did not reach 'now',
-    # which probably means the event has ended.
-    return None
+
+class Timeline(object):
+    '''
+    The interval boundaries of an event, worked out once so that finding
+    the current interval is a binary search instead of parsing every
+    duration again.
+
+    Member Variables:
+    --------
+    start -- datetime when the first interval starts
+    interval_list -- The durations, as a tuple of ical duration strings
+    boundaries -- List of datetimes from `durations_to_dates()`
+    unending -- Index into `boundaries` where a 0 duration interval ends (so
+                never ends), or None
+    --------
+    '''
+
+    __slots__ = ('start', 'interval_list', 'boundaries', 'unending', '_ordered')
+
+    def __init__(self, start, interval_list):
+        self.start = start
+        self.interval_list = tuple(interval_list)
+        self.boundaries = durations_to_dates(start, self.interval_list)
+        self.unending = None
+        self._ordered = True
+
+        for i in xrange(1, len(self.boundaries)):
+            if self.boundaries[i] == self.boundaries[i-1] and self.unending is None:
+                self.unending = i
+            elif self.boundaries[i] < self.boundaries[i-1]:
+                self._ordered = False   # negative durations, can't bisect
+
+
+    def _find(self, now):
+        '''
+        Returns: The index of the first boundary that is after 'now' or that
+            ends a 0 duration interval; or len(boundaries) if there's none.
+        '''
+        if not self._ordered:
+            current_interval_end = None
+            for i in xrange(len(self.boundaries)):
+                new_interval_end = self.boundaries[i]
+                if new_interval_end > now or new_interval_end == current_interval_end:
+                    return i
+                current_interval_end = new_interval_end
+            return len(self.boundaries)
+
+        i = bisect.bisect_right(self.boundaries, now)
+        if self.unending is not None and self.unending < i:
+            return self.unending
+        return i
+
+
+    def choose_interval(self, now=None):
+        '''
+        Same as `choose_interval()`
+        '''
+        if now is None: now = datetime.datetime.utcnow()
+
+        i = self._find(now)
+        if i == len(self.boundaries):
+            # the last interval still did not reach 'now',
+            # which probably means the event has ended.
+            return None
+
+        # if boundary i is > now, we are in the interval prior (-1 if the
+        # event hasn't started).  If it ends a 0 duration interval, that
+        # interval is 'unending' and will always include 'now'
+        return i - 1
+
+
+    def next_transition(self, now=None):
+        '''
+        Same as `next_transition()`
+        '''
+        if now is None: now = datetime.datetime.utcnow()
+
+        i = self._find(now)
+        if i == len(self.boundaries) or i == self.unending:
+            return None
+
+        return self.boundaries[i]
+
+
+    def is_ordered(self):
+        '''
+        Returns: False if the boundaries go backwards (negative durations)
+        '''
+        return self._ordered
+
+
+    def get_end_time(self):
+        '''
+        Returns: A datetime when the last interval ends, or None if there's
+                 a 0 duration ('unending') interval
+        '''
+        if self.unending is not None:
+            return None
+
+        return self.boundaries[-1]
 
 
 def duration_to_delta(duration_str):
     '''
     Take a duration string like 'PT5M' or 'P0Y0M1DT3H2M1S'
-    and convert it to a dateutil relativedelta
+    and convert it to a dateutil relativedelta.
 
     Returns - a 2-tuple containing (delta, sign) where sign is 
               either '+' or '-'
     '''
-    vals = parse_duration( duration_str )
-    sign = vals[0]
-    return relativedelta(
-                years= vals[1],
-                months= vals[2],
-                days= vals[3],
-                hours= vals[4],
-                minutes= vals[5],
-                seconds= vals[6] ), sign
+    parsed = duration_cache.get(duration_str, _load_duration)[0]
+    return _to_relativedelta(parsed), parsed[0]
+
+
+def duration_to_offset(duration_str):
+    '''
+    Like `duration_to_delta()`, but durations without years or months
+    come back as a datetime.timedelta, which is a lot cheaper to add to a
+    datetime than a relativedelta.
+
+    Returns - a 2-tuple containing (delta, sign) where sign is
+              either '+' or '-'
+    '''
+    parsed, offset = duration_cache.get(duration_str, _load_duration)
+    if offset is None:
+        offset = _to_relativedelta(parsed)
+    return offset, parsed[0]
 
 
 def durations_to_dates(start,dur_list):
@@ -110,7 +333,7 @@ def durations_to_dates(start,dur_list):
     new_list = [start,]
 
     for i in xrange(len(dur_list)):
-        delta, sign = duration_to_delta( dur_list[i] )
+        delta, sign = duration_to_offset( dur_list[i] )
         new_dttm = new_dttm + delta if sign == '+' else new_dttm - delta
         new_list.append( new_dttm )
 
@@ -118,15 +341,56 @@ def durations_to_dates(start,dur_list):
 
 
 def str_to_datetime(dt_str):
-    fmt = '%Y-%m-%dT%H:%M:%S.%fZ' if '.' in dt_str \
-            else '%Y-%m-%dT%H:%M:%SZ'
-    return datetime.datetime.strptime(dt_str,fmt)
+    '''
+    Parse an xcal date-time string like `2013-05-12T08:33:50.25Z`.  Times
+    with an offset (e.g. `2013-05-12T10:33:50+02:00`) are converted to UTC.
+    Returns a naive datetime (in UTC).
+
+    The fixed format is picked apart by position rather than going through
+    `strptime`, which is slow.
+    '''
+    match = DATETIME_REX.match(dt_str)
+    if match is None:
+        # Not the usual format, let strptime have a go (or raise the ValueError)
+        fmt = '%Y-%m-%dT%H:%M:%S.%fZ' if '.' in dt_str \
+                else '%Y-%m-%dT%H:%M:%SZ'
+        return datetime.datetime.strptime(dt_str,fmt)
+
+    fraction, utc, sign, offset_hours, offset_minutes = match.groups()
+    dttm = datetime.datetime(
+            int(dt_str[0:4]), int(dt_str[5:7]), int(dt_str[8:10]),
+            int(dt_str[11:13]), int(dt_str[14:16]), int(dt_str[17:19]),
+            int(fraction.ljust(6, '0')) if fraction else 0 )
+
+    if utc is None:
+        offset = datetime.timedelta(hours=int(offset_hours), minutes=int(offset_minutes))
+        dttm = dttm - offset if sign == '+' else dttm + offset
+
+    return dttm
 
 
 def dttm_to_str(dttm, include_msec=True):
-    fmt = '%Y-%m-%dT%H:%M:%S.%fZ' if include_msec \
-            else '%Y-%m-%dT%H:%M:%SZ'
-    return dttm.strftime(fmt)
+    '''
+    Format a (naive, UTC) datetime as an xcal date-time string, the same as
+    `strftime('%Y-%m-%dT%H:%M:%S.%fZ')` (or without the `.%f`) would.
+    '''
+    if dttm.tzinfo is not None:
+        # isoformat() would add the offset, strftime ignores it
+        dttm = dttm.replace(tzinfo=None)
+
+    # isoformat() gives `YYYY-MM-DDTHH:MM:SS[.ffffff]`, leaving off a 0 fraction
+    dt_str = dttm.isoformat()
+    if not include_msec:
+        return dt_str[:19] + 'Z'
+
+    return dt_str + 'Z' if dttm.microsecond else dt_str + '.000000Z'
+
+
+def dttm_to_timestamp(dttm):
+    '''
+    Convert a (naive, UTC) datetime to seconds since the epoch, as a float.
+    '''
+    return calendar.timegm(dttm.utctimetuple()) + dttm.microsecond / 1e6
 
 
 def random_offset(dttm, start_before, start_after):
@@ -137,10 +401,10 @@ def random_offset(dttm, start_before, start_after):
     if not start_before and not start_after:
         return dttm # no offset
 
-    min_dttm = dttm - duration_to_delta(start_before)[0] \
+    min_dttm = dttm - duration_to_offset(start_before)[0] \
             if start_before else dttm
 
-    max_dttm = dttm + duration_to_delta(start_after)[0] \
+    max_dttm = dttm + duration_to_offset(start_after)[0] \
             if start_after else dttm
 
     timestamp1 = int(calendar.timegm(min_dttm.utctimetuple()))
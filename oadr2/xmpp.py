@@ -7,20 +7,24 @@ __author__ = 'Thom Nichols <tnichols@enernoc.com>, Benjamin N. Summerton <bsumme
 
 import threading, logging
 from cStringIO import StringIO
+from xml.sax.saxutils import quoteattr
 
 # NOTE: As stated in header, we are using two different XML libraries.
 #       The python standard XML library is needed because of SleekXMPP
-#       Yet we try to use the "lxml," module as much as we can.
+#       Yet we try to use the "lxml," module as much as we can; payloads
+#       are copied from one to the other directly (see `std_to_lxml()`) or
+#       serialized straight into the stanza (see `build_iq_set()`), rather
+#       than serialized and parsed again.
 from lxml import etree as lxml_etree
-from xml.etree import cElementTree as std_ElementTree
-from xml.etree.cElementTree import XML as std_XML
 
 import sleekxmpp
-from sleekxmpp.stanza.iq import Iq
 from sleekxmpp.plugins.base import base_plugin
 from sleekxmpp.exceptions import XMPPError
 
-import base, event
+import base, dispatch, event
+
+XMPP_WORKERS = 2            # threads handling payloads, off of SleekXMPP's event thread
+XMPP_QUEUE_SIZE = 32        # most payloads waiting to be handled, past this they're turned away
 
 
 
@@ -30,6 +34,13 @@ class OpenADR2(base.BaseHandler):
     oadrDistributeEvent IQ stanza from the XMPP server and then generate a
     response IQ and send it to the server.
 
+    Payloads are handled (and the response sent) on a pool of worker threads,
+    so a big distribution doesn't hold up SleekXMPP's event thread (i.e. the
+    keepalive pings).  Payloads from the same VTN are handled in the order they
+    came in; the event handler works on one at a time.  When more than
+    `max_queue` are waiting, new ones are turned away with a 'wait' error
+    (resource-constraint), so the VTN can send them again later.
+
     Memeber variables
     --------
     (Everything from base.BaseHandler class)
@@ -38,9 +49,12 @@ class OpenADR2(base.BaseHandler):
     password - Password for accompanying JID
     server_addr - Address of the XMPP Server
     server_port - Port we should connect to
+    payload_dispatcher - dispatch.Dispatcher the payloads are handled on
+    _payload_lock - threading.Lock(); payloads are handled one at a time
     '''
 
-    def __init__(self, event_config, user, password, server_addr='localhost', server_port=5222):
+    def __init__(self, event_config, user, password, server_addr='localhost', server_port=5222,
+                 workers=XMPP_WORKERS, max_queue=XMPP_QUEUE_SIZE):
         '''
         Initilize what will do XMPP magic for us
 
@@ -49,10 +63,15 @@ class OpenADR2(base.BaseHandler):
         password - Password for corresponding JID
         server_addr -- Address of where the XMPP server is located
         server_port -- Port that the XMPP server is listening on
+        workers -- Threads to handle payloads on
+        max_queue -- Most payloads that can be waiting to be handled
         '''
 
         base.BaseHandler.__init__(self, event_config)
 
+        self.payload_dispatcher = dispatch.Dispatcher(workers, max_queue)
+        self._payload_lock = threading.Lock()
+
         # Make sure we set these variables before calling the parent class' constructor
         self.xmpp_client = None
         self.user = user
@@ -121,17 +140,37 @@ class OpenADR2(base.BaseHandler):
         
     def _handle_oadr_payload(self, msg):
         '''
-        Handle OpenADR2 payloads
+        Handle OpenADR2 payloads; called on SleekXMPP's event thread, so they
+        are only queued up here, in order for each VTN (by bare JID).
+
+        msg - A type of OADR2Message
+
+        Returns: False if it was turned away (too many are waiting)
+        '''
+
+        vtn = sleekxmpp.JID(msg.from_).bare
+        return self.payload_dispatcher.submit(vtn, self._process_payload, (msg,))
+
+
+    def _process_payload(self, msg):
+        '''
+        Handle an OpenADR2 payload on a worker thread, and send the response.
 
         msg - A type of OADR2Message
         '''
 
         # Try to generate a response payload and send it back
         try:
-            response = self.event_handler.handle_payload(msg.payload)
-            logging.debug('Response Payload:\n%s\n----\n',
-                    lxml_etree.tostring(response, pretty_print=True))
-            self.send_reply( response, msg.from_ )
+            with self._payload_lock:
+                response = self.event_handler.handle_payload(msg.payload)
+
+            # tell the control loop that events may have updated
+            self.event_controller.events_updated()
+
+            if response is not None:
+                logging.debug('Response Payload:\n%s\n----\n',
+                        lxml_etree.tostring(response, pretty_print=True))
+                self.send_reply( response, msg.from_ )
         except Exception, ex:
             logging.exception("Error processing OADR2 log request: %s", ex)
 
@@ -151,10 +190,7 @@ class OpenADR2(base.BaseHandler):
             return
 
         # Build the IQ reply and send it
-        iq_reply = Iq(self.xmpp_client, sto=to, stype='set')
-        # Change the lxml object to a standard Python XML object
-        iq_reply.set_payload(std_XML(lxml_etree.tostring(payload))) 
-        self.xmpp_client.send(iq_reply)
+        self.xmpp_client.send_raw(build_iq_set(payload, to, self.xmpp_client.new_id()))
 
 
     def exit(self):
@@ -162,6 +198,9 @@ class OpenADR2(base.BaseHandler):
         Shutdown the module and client.
         '''
 
+        # Finish the payloads that came in (and send their responses)
+        self.payload_dispatcher.close()
+
         # Shutdown the xmpp client
         logging.info('Shutting down the XMPP Client...')
 
@@ -326,16 +365,18 @@ class OpenADR2Plugin(base_plugin):
     def _handle_iq(self, iq):
         '''
         Handle an IQ stanza with a payload containing an "oadrDistributeEvent"
-        tag.  This will pass an OADR2Message to 'self.callback'.
+        tag.  This will pass an OADR2Message to 'self.callback'; if it
+        returns False, the payload couldn't be taken right now and a 'wait'
+        error goes back to the sender.
 
         iq -- A SleekXMPP Iq object.
         '''
 
         logging.debug('OpenADR2 payload [from=%s, to=%s]',
-                (iq.get('from'), iq.get('to')))
+                iq.get('from'), iq.get('to'))
         try:
             # Convert a "Standard Python Library XML object," to one from lxml
-            payload_element = lxml_etree.XML(std_ElementTree.tostring(iq[0]))
+            payload_element = std_to_lxml(iq.xml[0])
             msg = OADR2Message(
                 iq_type = iq.get('type'),
                 id_ = iq.get('id'), 
@@ -344,8 +385,101 @@ class OpenADR2Plugin(base_plugin):
             )
             
             # And pass it to the message handler
-            self.callback(msg)
+            taken = self.callback(msg)
         except Exception, e:
             logging.exception("OADR2 XMPP parse error: %s", e)
             raise XMPPError(text=e) 
 
+        if taken is False:
+            raise XMPPError('resource-constraint', 'Too many payloads waiting', etype='wait')
+
+
+
+def std_to_lxml(element, nsmap=None):
+    '''
+    Copy a standard Python library XML element (what SleekXMPP gives us) to an
+    lxml one, without serializing it and parsing it again.
+
+    element -- An xml.etree.ElementTree.Element object
+    nsmap -- Namespace prefixes for the new element; by default the
+             namespaces used in `element` (see `get_nsmap()`)
+
+    Returns: An lxml.etree.Element object
+    '''
+
+    if nsmap is None:
+        nsmap = get_nsmap(element)
+    copy = lxml_etree.Element(element.tag, element.attrib, nsmap=nsmap)
+    copy.text = element.text
+    _copy_children(element, copy)
+    return copy
+
+
+def get_nsmap(element):
+    '''
+    Work out the namespace prefixes for a copy of a standard Python library
+    XML element.  The standard library doesn't keep the prefixes it parsed,
+    only the namespaces of the tags & attributes; so every namespace used in
+    `element` is declared, with its usual OpenADR prefix (see `event.NS_A` &
+    `event.NS_B`) if it has one.
+
+    element -- An xml.etree.ElementTree.Element object
+
+    Returns: A dict of prefix -> namespace
+    '''
+
+    # Tags repeat a lot, so each one is only looked at once
+    seen = set()
+    used = []
+    for node in element.iter():
+        names = [node.tag]
+        if node.attrib:
+            names.extend(node.attrib)
+        for name in names:
+            if name in seen or not isinstance(name, basestring):
+                continue
+            seen.add(name)
+            if name[:1] == '{':
+                uri = name[1:name.index('}')]
+                if uri not in used:
+                    used.append(uri)
+
+    nsmap = {}
+    for uri in used:
+        prefix = _PREFIXES.get(uri)
+        if prefix is None or prefix in nsmap:
+            prefix = 'ns%d' % len(nsmap)
+        nsmap[prefix] = uri
+    return nsmap
+
+
+# namespace -> usual prefix, for `get_nsmap()`
+_PREFIXES = dict((uri, prefix) for prefix, uri in event.NS_A.items() + event.NS_B.items())
+
+
+def _copy_children(element, copy):
+    for child in element:
+        if not isinstance(child.tag, basestring):
+            continue    # a comment or processing instruction
+        child_copy = lxml_etree.SubElement(copy, child.tag, child.attrib)
+        child_copy.text = child.text
+        child_copy.tail = child.tail
+        _copy_children(child, child_copy)
+
+
+def build_iq_set(payload, to, id_):
+    '''
+    Build an IQ 'set' stanza with an OpenADR 2.0 payload.  The payload is
+    serialized right into the stanza, rather than copied to a standard Python
+    library XML object for SleekXMPP to serialize.
+
+    payload -- An lxml.etree.Element object
+    to -- JID of whom the stanza goes to
+    id_ -- ID of the stanza
+
+    Returns: The stanza, an XML string
+    '''
+
+    return u'<iq type="set" to=%s id=%s>%s</iq>' % (
+            quoteattr(unicode(to)), quoteattr(unicode(id_)),
+            lxml_etree.tostring(payload, encoding=unicode))
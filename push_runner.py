@@ -0,0 +1,60 @@
+# A file to run the Push module's OpenADR2 class (HTTP server)
+
+# Make sure to run this from the root directory
+import sys, os
+sys.path.insert(0, os.getcwd())
+
+import threading, logging
+logging.basicConfig(
+        level=logging.DEBUG,
+        format="%(asctime)s  %(message)s" )
+
+from oadr2 import push
+
+# Some constants that we might need
+LISTEN_HOST = '127.0.0.1'   # '' for all addresses; set up TRUST_CERTS first
+LISTEN_PORT = 8080
+SERVER_CERT_KEY_PATH = None #'./ven_key.pem'
+SERVER_CERT_PATH = None #'./ven_cert.pem'
+TRUST_CERTS = None #'./oadr_trust_certs.pem'
+
+# Constants relating to VEN and VTN settings
+VEN_ID = 'ven_py'
+VTN_IDS = 'vtn_1,vtn_2,vtn_3,TH_VTN,vtn_rsa'
+
+
+def main():
+    logging.info('Listening for HTTP pushes')
+
+    config = {
+        'listen_host': LISTEN_HOST,
+        'listen_port': LISTEN_PORT,
+        'ven_server_cert_key': SERVER_CERT_KEY_PATH,
+        'ven_server_cert_pem': SERVER_CERT_PATH,
+        'vtn_ca_certs': TRUST_CERTS,
+        'event_config': {
+            'ven_id': VEN_ID,
+            'vtn_ids': VTN_IDS,
+        }
+    }
+     
+    receiver = push.OpenADR2(**config)
+
+    # Some sort of loop thingy here
+    print('Running...')
+    _exit = threading.Event()
+    try:
+        while not _exit.is_set():
+            _exit.wait(1)
+    except:
+        pass
+
+    # Close the receiver
+    print('Exiting the OpenADR 2 Push receiver')
+    receiver.exit()
+
+    print('========DONE========')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# Benchmarks for evaluating many events in the Event Controller
+
+# NOTE: Make sure to run this file from the root directory of the project
+import sys,os
+sys.path.insert( 0, os.getcwd() )
+
+import datetime as dt
+import random
+import shutil
+import tempfile
+import time
+from oadr2 import control, event
+
+# Some constants
+START = dt.datetime(2013,6,6,19,45,44)
+EVENT_COUNTS = (100, 1000, 10000)
+INTERVALS = 100             # 1 minute intervals in each event
+ROUNDS = 5
+
+
+
+def build_records(count):
+    '''
+    Build `count` EventRecords, starting at random times around START
+
+    Returns: A list of event.EventRecord
+    '''
+
+    rand = random.Random(count)
+    records = []
+    for i in xrange(count):
+        signals = [('PT1M', str(n), '%.1f' % rand.uniform(0, 5)) for n in xrange(INTERVALS)]
+        records.append(event.EventRecord(
+                event_id='e_%d' % i, mod_number=0, status='active',
+                dtstart=START + dt.timedelta(minutes=rand.randint(-INTERVALS, INTERVALS)),
+                signals=signals, party_ids=frozenset(), group_ids=frozenset(),
+                resource_ids=frozenset(), ven_ids=frozenset()))
+
+    return records
+
+
+def timed(controller, records, now):
+    '''
+    Returns: (milliseconds per pass, result)
+    '''
+
+    result = controller._calculate_current_event_status(records, now)    # warm up the caches
+    start = time.time()
+    for i in xrange(ROUNDS):
+        controller._calculate_current_event_status(records, now)
+    return (time.time() - start) / ROUNDS * 1000, result
+
+
+def main():
+    if control.numpy is None:
+        print('numpy is not installed')
+        return
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        handler = event.EventHandler('ven_py', db_path=os.path.join(tmp_dir, 'bench.db'))
+        controller = control.EventController(handler, start_thread=False)
+
+        print('%8s %18s %18s %10s' % ('events', 'per-event (ms)', 'vectorized (ms)', 'speedup'))
+        for count in EVENT_COUNTS:
+            records = build_records(count)
+            now = START + dt.timedelta(seconds=30)
+
+            controller.vectorize_min_events = None
+            before, expected = timed(controller, records, now)
+
+            controller.vectorize_min_events = 0
+            after, result = timed(controller, records, now)
+            assert expected == result, 'Results differ'
+
+            print('%8d %18.1f %18.1f %9.1fx' % (count, before, after, before / after))
+
+        handler.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+# Some Unit-Tests for the Event Controller
+
+# NOTE: Make sure to run this file from the root directory of the project
+import sys,os
+sys.path.insert( 0, os.getcwd() )
+xml_dir = os.path.join( os.path.dirname(__file__), 'xml_files')
+
+from oadr2 import control, event, schedule
+from lxml import etree
+import datetime as dt
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+
+# Some constants
+SAMPLE_FILE = os.path.join(xml_dir, '2.0a_spec/batch_a_2.xml')
+VTN_ID = 'TH_VTN'
+START = dt.datetime(2013,6,6,19,45,44)
+
+
+
+def build_event(e_id, start, values):
+    '''
+    Build an ei:eiEvent from the sample, with one minute intervals of `values`
+
+    Returns: An lxml.etree.Element object of ei:eiEvent
+    '''
+
+    evt = etree.parse(SAMPLE_FILE).getroot().find('oadr:oadrEvent/ei:eiEvent', namespaces=event.NS_A)
+    evt.find('ei:eventDescriptor/ei:eventID', namespaces=event.NS_A).text = e_id
+    evt.find('ei:eiActivePeriod/xcal:properties/xcal:dtstart/xcal:date-time',
+            namespaces=event.NS_A).text = schedule.dttm_to_str(start, include_msec=False)
+
+    intervals = evt.findall('ei:eiEventSignals/ei:eiEventSignal/strm:intervals/ei:interval', namespaces=event.NS_A)
+    for interval, value in zip(intervals, values):
+        interval.find('ei:signalPayload//ei:value', namespaces=event.NS_A).text = str(value)
+
+    return evt
+
+
+
+class EventControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.event_handler = event.EventHandler('ven_py', vtn_ids=VTN_ID,
+                db_path=os.path.join(self.tmp_dir, 'test.db'))
+        self.changes = []
+        self.controller = control.EventController(self.event_handler,
+                signal_changed_callback=lambda old, new: self.changes.append(new),
+                start_thread=False)
+
+
+    def tearDown(self):
+        self.event_handler.close()
+        shutil.rmtree(self.tmp_dir)
+
+
+    def test_transitions(self):
+        # e_1 runs from START for 3 minutes, e_2 from START + 2 minutes
+        later = START + dt.timedelta(minutes=2)
+        self.event_handler.update_event('e_1', build_event('e_1', START, (1.0, 2.0, 3.0)), VTN_ID)
+        self.event_handler.update_event('e_2', build_event('e_2', later, (5.0, 4.0, 0.0)), VTN_ID)
+        ts = lambda dttm: schedule.dttm_to_timestamp(dttm)
+
+        # Before anything starts, just sleep until e_1 does
+        now = START - dt.timedelta(minutes=10)
+        self.assertEqual(0, self.controller._update_control(self.event_handler.get_active_events(), now))
+        self.assertEqual([(ts(START), 'e_1'), (ts(later), 'e_2')], sorted(self.controller._transitions))
+        self.assertFalse(self.controller._transitions_due(now))
+
+        # Only the events that are due get looked at
+        now = START
+        self.assertTrue(self.controller._transitions_due(now))
+        self.assertEqual(1.0, self.controller._update_transitions(now))
+        self.assertEqual((ts(START + dt.timedelta(minutes=1)), 'e_1'), self.controller._transitions[0])
+        self.assertEqual(2, len(self.controller._transitions))
+
+        self.assertEqual(2.0, self.controller._update_transitions(START + dt.timedelta(minutes=1)))
+        self.assertEqual(5.0, self.controller._update_transitions(later))
+        self.assertEqual(4.0, self.controller._update_transitions(START + dt.timedelta(minutes=3)))
+
+        # e_1 ended, so it was removed
+        self.assertEqual(['e_2'], self.event_handler._event_index.keys())
+        self.assertEqual(0, self.controller._update_transitions(later + dt.timedelta(minutes=3)))
+        self.assertEqual({}, self.event_handler._event_index)
+        self.assertEqual([], self.controller._transitions)
+
+
+    def test_sleep_time(self):
+        # Nothing scheduled, so nothing to wake up for
+        self.assertEqual(None, self.controller._get_sleep_time())
+
+        # ...unless there's a watchdog
+        self.controller.control_loop_interval = 30
+        self.assertEqual(30, self.controller._get_sleep_time())
+
+        # An event starting in a minute
+        start = dt.datetime.utcnow().replace(microsecond=0) + dt.timedelta(minutes=1)
+        self.event_handler.update_event('e_1', build_event('e_1', start, (1.0, 2.0, 3.0)), VTN_ID)
+        self.controller._update_control(self.event_handler.get_active_events())
+        self.assertEqual(30, self.controller._get_sleep_time())
+
+        self.controller.control_loop_interval = None
+        sleep_time = self.controller._get_sleep_time()
+        self.assertTrue(50 < sleep_time <= 60, sleep_time)
+
+
+    def test_signal_changed(self):
+        self.event_handler.update_event('e_1', build_event('e_1', START, (1.0, 1.0, 3.0)), VTN_ID)
+        self.controller._update_control(self.event_handler.get_active_events(), START - dt.timedelta(minutes=1))
+
+        for minute in xrange(4):
+            level = self.controller._update_transitions(START + dt.timedelta(minutes=minute))
+            self.controller._update_signal_level(level)
+            self.event_handler.dispatcher.join()
+
+        self.assertEqual([1.0, 3.0, 0], self.changes)
+
+        # Changes that pile up behind a slow callback are merged
+        gate = threading.Event()
+        self.controller.signal_changed_callback = lambda old, new: (gate.wait(), self.changes.append((old, new)))
+        for level in (1.0, 2.0, 3.0, 4.0):
+            self.controller._update_signal_level(level)
+        gate.set()
+        self.event_handler.dispatcher.join()
+        self.assertEqual([(0, 1.0), (1.0, 4.0)], self.changes[3:])
+
+        # A change that can't be queued up is tried again
+        self.event_handler.dispatcher.close()
+        self.assertFalse(self.controller._update_signal_level(5.0))
+        self.assertEqual(4.0, self.controller.current_signal_level)
+
+
+    def test_signal_forecast(self):
+        # e_1 runs from START for 3 minutes, e_2 from START + 2 minutes
+        later = START + dt.timedelta(minutes=2)
+        minutes = lambda m: START + dt.timedelta(minutes=m)
+        self.event_handler.update_event('e_1', build_event('e_1', START, (1.0, 2.0, 3.0)), VTN_ID)
+        self.event_handler.update_event('e_2', build_event('e_2', later, (5.0, 4.0, 0.0)), VTN_ID)
+
+        now = START - dt.timedelta(minutes=10)
+        self.assertEqual([(now, 0, None), (START, 1.0, 'e_1'), (minutes(1), 2.0, 'e_1'),
+                          (minutes(2), 5.0, 'e_2'), (minutes(3), 4.0, 'e_2'), (minutes(4), 0, None)],
+                         self.controller.get_signal_forecast(now=now))
+
+        # Part way through, and only a couple minutes ahead
+        now = minutes(1) + dt.timedelta(seconds=30)
+        self.assertEqual([(now, 2.0, 'e_1'), (minutes(2), 5.0, 'e_2')],
+                         self.controller.get_signal_forecast(horizon=60, now=now))
+        self.assertEqual([(now, 2.0, 'e_1')],
+                         self.controller.get_signal_forecast(horizon=0, now=now))
+
+        # Same as the control loop would work out
+        for m in (0, 1, 2, 3, 4):
+            level = self.controller._calculate_current_event_status(
+                    self.event_handler.get_active_records(), minutes(m))[0]
+            self.assertEqual(level, self.controller.get_signal_forecast(horizon=0, now=minutes(m))[0][1])
+
+        # Only worked out again when the events change
+        forecast = self.controller._forecast
+        self.controller.get_signal_forecast()
+        self.assertTrue(forecast is self.controller._forecast)
+
+        self.event_handler.remove_events(['e_2'])
+        self.assertEqual([(START, 1.0, 'e_1'), (minutes(1), 2.0, 'e_1'),
+                          (minutes(2), 3.0, 'e_1'), (minutes(3), 0, None)],
+                         self.controller.get_signal_forecast(now=START))
+
+
+
+    @unittest.skipIf(control.numpy is None, 'numpy is not installed')
+    def test_vectorized(self):
+        rand = random.Random(1)
+        durations = ('PT1M', 'PT5M', 'PT30S', 'PT1H', 'PT0M', '-PT2M')
+        values = ('1.0', '2.5', '0', None, '3', 'bogus')
+
+        records = []
+        for i in xrange(300):
+            count = rand.randint(0, 6)
+            signals = [(rand.choice(durations[:4] if i % 3 else durations), str(n),
+                        rand.choice(values[:5] if i % 7 else values)) for n in xrange(count)]
+            records.append(event.EventRecord(
+                    event_id='e_%d' % i, mod_number=rand.randint(0, 2),
+                    dtstart=START + dt.timedelta(minutes=rand.randint(-60, 60)),
+                    signals=signals if i % 11 else None,
+                    ven_ids=frozenset(['someone_else']) if i % 13 == 0 else frozenset(),
+                    party_ids=frozenset(), group_ids=frozenset(), resource_ids=frozenset()))
+
+        for minutes in xrange(-70, 130, 7):
+            now = START + dt.timedelta(minutes=minutes, seconds=rand.choice((0, 30)))
+
+            self.controller.vectorize_min_events = None
+            expected = self.controller._evaluate_events(records, now)
+            expected_status = self.controller._calculate_current_event_status(records, now)
+
+            self.controller.vectorize_min_events = 0
+            self.assertEqual(expected, self.controller._evaluate_events(records, now))
+            self.assertEqual(expected_status, self.controller._calculate_current_event_status(records, now))
+
+        # Most of them did get vectorized
+        self.assertTrue(len(self.controller._vector_evaluator._packed) > 150)
+
+        # ... and when all of them do
+        records = [r for i, r in enumerate(records) if i % 3 and i % 7 and i % 11 and i % 13]
+        now = START + dt.timedelta(minutes=3)
+        self.controller.vectorize_min_events = None
+        expected = self.controller._evaluate_events(records, now)
+        self.controller.vectorize_min_events = 0
+        self.assertEqual(expected, self.controller._evaluate_events(records, now))
+        self.assertEqual(None, self.controller._vector_plan[2])
+
+        # Changed intervals or levels under the same mod number are packed again
+        evaluator = self.controller._vector_evaluator
+        record = event.EventRecord(event_id='e_x', mod_number=0, dtstart=START,
+                signals=[('PT1M', '0', '1.0'), ('PT1M', '1', '2.0')])
+        evaluate = lambda now: evaluator.evaluate(evaluator.prepare([evaluator.pack(record)]), now)[0]
+        packed = evaluator.pack(record)
+        self.assertTrue(evaluator.pack(record) is packed)
+
+        record.signals = [('PT2M', '0', '1.0'), ('PT2M', '1', '2.0')]
+        self.assertFalse(evaluator.pack(record) is packed)
+        self.assertEqual(('e_x', 1.0, START + dt.timedelta(minutes=2)),
+                evaluate(START + dt.timedelta(minutes=1)))
+
+        record.signals = [('PT2M', '0', '5.0'), ('PT2M', '1', '2.0')]
+        self.assertEqual(5.0, evaluate(START)[1])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+# Benchmarks for storing events in the database
+
+# NOTE: Make sure to run this file from the root directory of the project
+import sys,os
+sys.path.insert( 0, os.getcwd() )
+xml_dir = os.path.join( os.path.dirname(__file__), 'xml_files')
+
+import copy
+import shutil
+import tempfile
+import time
+from lxml import etree
+from oadr2 import database, event
+
+# Some constants
+SAMPLE_FILE = os.path.join(xml_dir, '2.0a_spec/batch_a_2.xml')
+VTN_ID = 'TH_VTN'
+EVENT_COUNTS = (10, 200, 1000)
+CODEC_EVENTS = 50           # synthetic events for the storage codec benchmark
+CODEC_INTERVALS = 1000      # intervals in each of them
+CODEC_READS = 5
+
+
+
+def build_distribution(count):
+    '''
+    Build an oadrDistributeEvent with `count` copies of the sample event,
+    each with its own event ID.
+
+    Returns: An lxml.etree.Element object of oadr:oadrDistributeEvent
+    '''
+
+    payload = etree.parse(SAMPLE_FILE).getroot()
+    template = payload.find('oadr:oadrEvent', namespaces=event.NS_A)
+    payload.remove(template)
+
+    for i in xrange(count):
+        evt = copy.deepcopy(template)
+        evt.find('ei:eiEvent/ei:eventDescriptor/ei:eventID', namespaces=event.NS_A).text = 'e_%d' % i
+        payload.append(evt)
+
+    return payload
+
+
+def build_long_event(e_id, interval_count):
+    '''
+    Build an ei:eiEvent with `interval_count` one minute intervals, each with
+    its own value.
+
+    Returns: An lxml.etree.Element object of ei:eiEvent
+    '''
+
+    evt = copy.deepcopy(etree.parse(SAMPLE_FILE).getroot().find(
+            'oadr:oadrEvent/ei:eiEvent', namespaces=event.NS_A))
+    evt.find('ei:eventDescriptor/ei:eventID', namespaces=event.NS_A).text = e_id
+
+    intervals = evt.find('ei:eiEventSignals/ei:eiEventSignal/strm:intervals', namespaces=event.NS_A)
+    template = intervals[0]
+    for child in list(intervals):
+        intervals.remove(child)
+
+    for i in xrange(interval_count):
+        interval = copy.deepcopy(template)
+        interval.find('xcal:uid/xcal:text', namespaces=event.NS_A).text = str(i)
+        interval.find('ei:signalPayload//ei:value', namespaces=event.NS_A).text = '%.1f' % (i % 7)
+        intervals.append(interval)
+
+    return evt
+
+
+def get_records(payload):
+    '''
+    Returns: A list of ('vtn_id', 'event_id', MOD_NUM, '<xml/>') tuples for the payload
+    '''
+
+    records = []
+    for evt in payload.iterfind('oadr:oadrEvent/ei:eiEvent', namespaces=event.NS_A):
+        records.append((VTN_ID, event.get_event_id(evt), event.get_mod_number(evt),
+                        etree.tostring(evt)))
+    return records
+
+
+def per_event(db, records):
+    '''
+    One connection & commit for each event, like `DBHandler.update_event()`
+    '''
+
+    for vtn_id, e_id, mod_num, raw_xml in records:
+        db.update_event(e_id, mod_num, raw_xml, vtn_id)
+    db.remove_events(['e_missing'])
+
+
+def batched(db, records):
+    '''
+    All of the events in one transaction, via `DBHandler.batch()`
+    '''
+
+    batch = db.batch()
+    for vtn_id, e_id, mod_num, raw_xml in records:
+        batch.update_event(e_id, mod_num, raw_xml, vtn_id)
+    batch.remove_events(['e_missing'])
+    batch.commit()
+
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return (time.time() - start) * 1000
+
+
+def bench_codecs(tmp_dir):
+    '''
+    Database size and read throughput of the storage codecs.
+    '''
+
+    records = []
+    for i in xrange(CODEC_EVENTS):
+        evt = build_long_event('e_%d' % i, CODEC_INTERVALS)
+        records.append((VTN_ID, 'e_%d' % i, 0, etree.tostring(evt)))
+    xml_bytes = sum(len(r[3]) for r in records)
+
+    print('%d events of %d intervals (%.1f MB of XML)' % (
+            CODEC_EVENTS, CODEC_INTERVALS, xml_bytes / 1e6))
+    print('%8s %12s %14s %16s' % ('codec', 'db size (MB)', 'read (MB/s)', 'read+parse (ms)'))
+
+    for codec in database.CODECS:
+        db_path = os.path.join(tmp_dir, 'codec_%s.db' % codec)
+        db = database.DBHandler(db_path, codec)
+        db.update_all_events(records)
+        db._connect().execute('VACUUM')
+        db._connect().execute('PRAGMA wal_checkpoint(TRUNCATE)')   # so it's all in the db file
+        size = os.path.getsize(db_path)
+
+        start = time.time()
+        for i in xrange(CODEC_READS):
+            db.get_active_events()
+        read_secs = (time.time() - start) / CODEC_READS
+
+        start = time.time()
+        for blob in db.get_active_events().itervalues():
+            etree.XML(blob)
+        parse_ms = (time.time() - start) * 1000
+
+        print('%8s %12.2f %14.1f %16.1f' % (codec, size / 1e6,
+                xml_bytes / 1e6 / read_secs, parse_ms))
+        db.close()
+
+
+def main():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        print('%8s %16s %16s %22s' % ('events', 'per-event (ms)', 'batched (ms)', 'handle_payload (ms)'))
+        for count in EVENT_COUNTS:
+            payload = build_distribution(count)
+            records = get_records(payload)
+
+            db = database.DBHandler(os.path.join(tmp_dir, 'per_event_%d.db' % count))
+            before = timed(per_event, db, records)
+
+            db = database.DBHandler(os.path.join(tmp_dir, 'batched_%d.db' % count))
+            after = timed(batched, db, records)
+
+            # Payload-to-commit for the whole handler, with every event new
+            handler = event.EventHandler('ven_py', vtn_ids=VTN_ID,
+                    db_path=os.path.join(tmp_dir, 'handler_%d.db' % count))
+            handled = timed(handler.handle_payload, payload)
+
+            print('%8d %16.1f %16.1f %22.1f' % (count, before, after, handled))
+
+        print('')
+        bench_codecs(tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+# Some Unit-Tests for the database handler
+
+# NOTE: Make sure to run this file from the root directory of the project
+import sys,os
+sys.path.insert( 0, os.getcwd() )
+
+import shutil
+import sqlite3
+import tempfile
+import threading
+from oadr2 import database
+import unittest
+
+
+
+class DBHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db = database.DBHandler(os.path.join(self.tmp_dir, 'test.db'))
+
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmp_dir)
+
+
+    def test_batch(self):
+        self.db.update_event('e_old', 0, '<old/>', 'vtn_1')
+
+        batch = self.db.batch()
+        batch.update_event('e_1', 0, '<one/>', 'vtn_1')
+        batch.update_event('e_2', 0, '<two/>', 'vtn_1')
+        batch.update_event('e_2', 3, '<two_v3/>', 'vtn_1')    # last one wins
+        batch.remove_events(['e_old'])
+        self.assertEqual(3, len(batch))
+
+        # Nothing is written until the commit
+        self.assertEqual({'e_old': ('vtn_1', 0)}, self.db.get_event_index())
+
+        batch.commit()
+        self.assertEqual(0, len(batch))
+        self.assertEqual({'e_1': ('vtn_1', 0), 'e_2': ('vtn_1', 3)},
+                         self.db.get_event_index())
+        self.assertEqual('<two_v3/>', self.db.get_event('e_2'))
+        self.assertEqual(None, self.db.get_event('e_old'))
+
+
+    def test_batch_remove_then_update(self):
+        self.db.update_event('e_1', 0, '<one/>', 'vtn_1')
+
+        batch = self.db.batch()
+        batch.remove_events(['e_1'])
+        batch.update_event('e_1', 1, '<one_v1/>', 'vtn_1')
+        batch.commit()
+
+        self.assertEqual({'e_1': ('vtn_1', 1)}, self.db.get_event_index())
+
+
+    def test_connection_per_thread(self):
+        self.assertTrue(self.db._connect() is self.db._connect())
+
+        other = []
+        thread = threading.Thread(target=lambda: other.append(self.db._connect()))
+        thread.start()
+        thread.join()
+        self.assertTrue(other[0] is not self.db._connect())
+        self.assertEqual(2, len(self.db._connections))
+
+        mode = self.db._connect().execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual('wal', mode.lower())
+
+        # After closing, the handler just opens up new connections
+        conn = self.db._connect()
+        self.db.close()
+        self.assertEqual([], self.db._connections)
+        self.assertRaises(sqlite3.ProgrammingError, conn.execute, 'SELECT 1')
+        self.db.update_event('e_1', 0, '<one/>', 'vtn_1')
+        self.assertEqual({'e_1': ('vtn_1', 0)}, self.db.get_event_index())
+
+
+    def test_read_during_write(self):
+        self.db.update_event('e_1', 0, '<one/>', 'vtn_1')
+
+        # Hold an exclusive write transaction open on another connection
+        writer = sqlite3.connect(self.db.db_path, isolation_level=None)
+        writer.execute('BEGIN EXCLUSIVE')
+        writer.execute('''INSERT INTO event(vtn_id, event_id, mod_num, raw_xml)
+                VALUES('vtn_1', 'e_2', 0, '<two/>')''')
+
+        # Readers still see the last commit, without waiting on the writer
+        self.db._connect().execute('PRAGMA busy_timeout = 0')
+        self.assertEqual({'e_1': ('vtn_1', 0)}, self.db.get_event_index())
+
+        writer.execute('COMMIT')
+        writer.close()
+        self.assertEqual(['e_1', 'e_2'], sorted(self.db.get_event_index()))
+
+
+
+    def test_get_active_events(self):
+        self.db.update_event('running', 0, '<running/>', 'vtn_1', dtstart=1000, end_time=2000)
+        self.db.update_event('unknown', 0, '<unknown/>', 'vtn_1')
+        self.assertEqual({'running': '<running/>', 'unknown': '<unknown/>'},
+                self.db.get_active_events())
+
+        # The schedule columns aren't looked up in SQL, so they aren't
+        # indexed; indexes from before are dropped
+        self.db._connect().execute('CREATE INDEX idx_event_status ON event (status)')
+        db = database.DBHandler(self.db.db_path)
+        c = db._connect().cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='event'")
+        self.assertEqual(['idx_event_vtn_id'], [row[0] for row in c.fetchall()])
+        c.close()
+        db.close()
+
+
+    def test_migration(self):
+        # A database from before the schedule columns were added
+        old_path = os.path.join(self.tmp_dir, 'old.db')
+        conn = sqlite3.connect(old_path)
+        conn.executescript('''
+            CREATE TABLE event (
+                id INTEGER PRIMARY KEY,
+                vtn_id VARCHAR NOT NULL,
+                event_id VARCHAR NOT NULL,
+                mod_num INT NOT NULL DEFAULT 0,
+                raw_xml TEXT NOT NULL
+            );
+            CREATE UNIQUE INDEX idx_event_vtn_id ON event (vtn_id, event_id);
+            INSERT INTO event(vtn_id, event_id, mod_num, raw_xml) VALUES('vtn_1', 'e_1', 2, '<one/>');
+        ''')
+        conn.commit()
+        conn.close()
+
+        db = database.DBHandler(old_path)
+        self.assertTrue(db.migrated)
+        self.assertEqual({'e_1': ('vtn_1', 2)}, db.get_event_index())
+
+        db.update_event_columns([('e_1', 'active', 1000, 2000, 'http://MarketContext1')])
+        c = db._connect().cursor()
+        c.execute('SELECT status, dtstart, end_time, market_context FROM event')
+        self.assertEqual([(u'active', 1000, 2000, u'http://MarketContext1')], c.fetchall())
+        c.close()
+        db.close()
+
+        # Only migrated once
+        db = database.DBHandler(old_path)
+        self.assertFalse(db.migrated)
+        db.close()
+
+
+
+    def test_replies(self):
+        first = self.db.add_reply('http://vtn/EiEvent', '<one/>')
+        second = self.db.add_reply('http://vtn/EiEvent', '<two/>')
+        self.db.update_reply(first, 3)
+        self.assertEqual([(first, 'http://vtn/EiEvent', '<one/>', 3),
+                          (second, 'http://vtn/EiEvent', '<two/>', 0)], self.db.get_replies())
+
+        self.db.remove_reply(first)
+        self.assertEqual([second], [r[0] for r in self.db.get_replies()])
+
+        # Still there when the database is opened again
+        self.db.close()
+        db = database.DBHandler(self.db.db_path)
+        self.assertEqual([second], [r[0] for r in db.get_replies()])
+        db.close()
+
+
+
+    def test_codec(self):
+        big_xml = '<event>%s</event>' % ('<interval>PT1M</interval>' * 100)
+        small_xml = '<event/>'
+
+        db = database.DBHandler(os.path.join(self.tmp_dir, 'test.db'), database.CODEC_ZLIB)
+        db.update_event('big', 0, big_xml, 'vtn_1')
+        batch = db.batch()
+        batch.update_event('small', 0, small_xml, 'vtn_1')
+        batch.update_event('big_2', 0, big_xml, 'vtn_1')
+        batch.commit()
+
+        # Big events are compressed, small ones aren't worth it
+        c = db._connect().cursor()
+        c.execute('SELECT event_id, typeof(raw_xml), length(raw_xml) FROM event')
+        stored = dict((e_id, (sql_type, length)) for e_id, sql_type, length in c.fetchall())
+        c.close()
+        self.assertEqual('blob', stored['big'][0])
+        self.assertTrue(stored['big'][1] < len(big_xml) / 4)
+        self.assertEqual('text', stored['small'][0])
+
+        # Any handler can read any row
+        for handler in (db, self.db):
+            self.assertEqual(big_xml, handler.get_event('big'))
+            self.assertEqual(small_xml, handler.get_event('small'))
+            self.assertEqual({'big': big_xml, 'big_2': big_xml, 'small': small_xml},
+                             handler.get_active_events())
+        db.close()
+
+        self.assertRaises(ValueError, database.DBHandler,
+                os.path.join(self.tmp_dir, 'test.db'), 'bogus')
+
+
+
+if __name__ == '__main__':
+    unittest.main()
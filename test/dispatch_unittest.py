@@ -0,0 +1,132 @@
+# Some Unit-Tests for the callback dispatcher
+# NOTE: Make sure to run this file from the root directory of the project
+import sys,os
+sys.path.insert( 0, os.getcwd() )
+
+import threading
+import time
+from oadr2 import dispatch
+import unittest
+
+
+
+class DispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = dispatch.Dispatcher(workers=2, max_queue=4)
+        self.calls = []
+        self.gate = threading.Event()
+
+
+    def tearDown(self):
+        self.gate.set()
+        self.dispatcher.close()
+
+
+    def blocked(self, *args):
+        self.gate.wait()
+        self.calls.append(args)
+
+
+    def test_ordering(self):
+        dispatcher = dispatch.Dispatcher(workers=4, max_queue=1000)
+        calls = []
+        def slow(key, i):
+            time.sleep(0.001 * (i % 3))
+            calls.append((key, i))
+
+        for i in xrange(50):
+            for key in ('a', 'b', 'c'):
+                dispatcher.submit(key, slow, (key, i))
+        self.assertTrue(dispatcher.join(10))
+        dispatcher.close()
+
+        # Each key is run in order, even with several workers
+        for key in ('a', 'b', 'c'):
+            self.assertEqual(range(50), [i for k, i in calls if k == key])
+        self.assertEqual(150, dispatcher.get_stats()['completed'])
+
+
+    def test_coalesce(self):
+        merge = lambda waiting, new: (waiting[0], new[1]) if waiting[0] != new[1] else None
+
+        # The first one is running; the rest wait behind it & get merged
+        self.dispatcher.submit('level', self.blocked, (0, 1), merge)
+        time.sleep(0.05)
+        for args in ((1, 2), (2, 3), (3, 4)):
+            self.assertTrue(self.dispatcher.submit('level', self.blocked, args, merge))
+        self.assertEqual(1, self.dispatcher.get_stats()['queued'])
+
+        # Back to where it started, so nothing to do
+        self.dispatcher.submit('other', self.blocked, (4, 5), merge)
+        time.sleep(0.05)
+        self.dispatcher.submit('other', self.blocked, (5, 6), merge)
+        self.dispatcher.submit('other', self.blocked, (6, 5), merge)
+        self.assertEqual(1, self.dispatcher.get_stats()['queued'])
+
+        self.gate.set()
+        self.assertTrue(self.dispatcher.join(5))
+        self.assertEqual([(0, 1), (1, 4), (4, 5)], sorted(self.calls))
+
+        stats = self.dispatcher.get_stats()
+        self.assertEqual(3, stats['coalesced'])
+        self.assertEqual(0, stats['queued'])
+
+
+    def test_queue_full(self):
+        # Both workers busy, then fill up the queue
+        self.dispatcher.submit('a', self.blocked, ('a',))
+        self.dispatcher.submit('b', self.blocked, ('b',))
+        time.sleep(0.05)
+        for i in xrange(4):
+            self.assertTrue(self.dispatcher.submit('c', self.blocked, (i,)))
+        self.assertFalse(self.dispatcher.submit('c', self.blocked, ('dropped',)))
+        self.assertFalse(self.dispatcher.join(0.05))
+
+        # Unless it can't be dropped
+        self.assertTrue(self.dispatcher.submit('d', self.blocked, ('forced',), force=True))
+
+        self.gate.set()
+        self.assertTrue(self.dispatcher.join(5))
+        self.assertEqual(7, len(self.calls))
+        self.assertTrue(('forced',) in self.calls)
+
+        stats = self.dispatcher.get_stats()
+        self.assertEqual(1, stats['dropped'])
+        self.assertEqual(5, stats['max_queued'])
+        self.assertTrue(stats['max_wait_time'] > 0)
+
+
+    def test_errors(self):
+        def broken():
+            raise ValueError('broken')
+
+        self.dispatcher.submit('a', broken)
+        self.dispatcher.submit('a', self.calls.append, ('after',))
+        self.assertTrue(self.dispatcher.join(5))
+        self.assertEqual(['after'], self.calls)
+        self.assertEqual(1, self.dispatcher.get_stats()['errors'])
+
+
+    def test_close(self):
+        self.gate.set()
+        self.dispatcher.submit('a', self.blocked, (1,))
+        self.dispatcher.close()
+
+        # What was queued still runs, but nothing new
+        self.assertEqual([(1,)], self.calls)
+        self.assertFalse(self.dispatcher.submit('a', self.blocked, (2,)))
+        self.assertFalse(any(w.is_alive() for w in self.dispatcher.workers))
+
+
+    def test_inline(self):
+        dispatcher = dispatch.Dispatcher(workers=0)
+        dispatcher.submit('a', self.calls.append, (1,))
+        self.assertEqual([1], self.calls)
+        self.assertEqual(1, dispatcher.get_stats()['completed'])
+        self.assertTrue(dispatcher.join(0))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -64,6 +64,26 @@ class EventHandlerTest(unittest.TestCase):
         print('build_request_payload() OK')
 
 
+    def test_build_poll_payload(self):
+        print('in test_build_poll_payload()')
+
+        payload = self.event_handler.build_poll_payload()
+        self.assertTrue(self.oadr_schema.validate(payload), msg='Schema didn\'t validate for build_poll_payload().')
+        self.assertEqual(payload.findtext('ei:venID', namespaces=event.NS_B), VEN_ID)
+
+        # Same shape as the sample
+        sample = etree.parse(os.path.join(SAMPLE_DIR, 'Sample_oadrPoll.xml')).getroot()
+        self.assertEqual(sample.tag, payload.tag)
+        self.assertEqual(sample.attrib['{%s}schemaVersion' % event.EI_XMLNS_A],
+                         payload.attrib['{%s}schemaVersion' % event.EI_XMLNS_A])
+
+        # Not in 2.0a
+        handler = event.EventHandler(VEN_ID, db_path=self.event_handler.db.db_path)
+        self.assertRaises(ValueError, handler.build_poll_payload)
+        handler.close()
+        print('build_poll_payload() OK')
+
+
     def test_build_error_response(self):
         print('in test_build_error_response')
         request = 'req_1'
@@ -0,0 +1,117 @@
+# Micro-benchmarks for pulling values out of events (2.0a & 2.0b samples)
+
+# NOTE: Make sure to run this file from the root directory of the project
+import sys,os
+sys.path.insert( 0, os.getcwd() )
+xml_dir = os.path.join( os.path.dirname(__file__), 'xml_files')
+
+import glob
+import timeit
+from lxml import etree
+from oadr2 import event, schedule
+
+# Some constants
+SAMPLE_DIRS = ((os.path.join(xml_dir, '2.0a_spec/'), event.NS_A),
+               (os.path.join(xml_dir, '2.0b_spec/'), event.NS_B))
+ROUNDS = 2000
+
+
+
+def load_events():
+    '''
+    Load every ei:eiEvent found in the sample files.
+
+    Returns: A list of tuples of (ei:eiEvent, ns_map)
+    '''
+
+    events = []
+    for sample_dir, ns_map in SAMPLE_DIRS:
+        for filename in sorted(glob.glob(os.path.join(sample_dir, '*.xml'))):
+            doc = etree.parse(filename).getroot()
+            for evt in doc.iterfind('oadr:oadrEvent/ei:eiEvent', namespaces=ns_map):
+                events.append((evt, ns_map))
+
+    return events
+
+
+def legacy_extract(evt, ns_map):
+    '''
+    Extraction the way the accessors used to do it; re-parsing each path
+    string and namespace map on every call.
+    '''
+
+    evt.findtext('ei:eventDescriptor/ei:eventID', namespaces=ns_map)
+    int(evt.findtext('ei:eventDescriptor/ei:modificationNumber', namespaces=ns_map))
+    evt.findtext('ei:eventDescriptor/ei:eventStatus', namespaces=ns_map)
+    schedule.str_to_datetime(evt.findtext(
+            'ei:eiActivePeriod/xcal:properties/xcal:dtstart/xcal:date-time', namespaces=ns_map))
+    evt.findtext('ei:eiActivePeriod/xcal:properties/xcal:tolerance/xcal:tolerate/xcal:startbefore', namespaces=ns_map)
+    evt.findtext('ei:eiActivePeriod/xcal:properties/xcal:tolerance/xcal:tolerate/xcal:startafter', namespaces=ns_map)
+
+    for signal in evt.iterfind('ei:eiEventSignals/ei:eiEventSignal', namespaces=ns_map):
+        signal.findtext('ei:signalName', namespaces=ns_map)
+        signal.findtext('ei:signalType', namespaces=ns_map)
+        for interval in signal.iterfind('strm:intervals/ei:interval', namespaces=ns_map):
+            interval.findtext('xcal:duration/xcal:duration', namespaces=ns_map)
+            interval.findtext('xcal:uid/xcal:text', namespaces=ns_map)
+            interval.findtext('ei:signalPayload//ei:value', namespaces=ns_map)
+
+    for tag in ('partyID', 'groupID', 'resourceID', 'venID'):
+        [e.text for e in evt.iterfind('ei:eiTarget/ei:' + tag, namespaces=ns_map)]
+
+
+def accessor_extract(evt, ns_map):
+    '''
+    Extraction through the `event` module's accessor functions.
+    '''
+
+    event.get_event_id(evt, ns_map)
+    event.get_mod_number(evt, ns_map)
+    event.get_status(evt, ns_map)
+    event.get_active_period_start(evt, ns_map)
+    event.get_start_before_after(evt, ns_map)
+    event.get_signals(evt, ns_map)
+    event.get_party_ids(evt, ns_map)
+    event.get_group_ids(evt, ns_map)
+    event.get_resource_ids(evt, ns_map)
+    event.get_ven_ids(evt, ns_map)
+
+
+def record_extract(evt, ns_map):
+    '''
+    Extraction with a single walk of the tree, via `event.parse_event()`.
+    '''
+
+    event.parse_event(evt, ns_map)
+
+
+def bench(name, func, events, rounds=ROUNDS):
+    '''
+    Time `func(evt, ns_map)` over every event, `rounds` times.
+
+    Returns: Cost per event, in microseconds
+    '''
+
+    def run():
+        for evt, ns_map in events:
+            func(evt, ns_map)
+
+    total = timeit.timeit(run, number=rounds)
+    per_event = total / (rounds * len(events)) * 1e6
+    print('%-24s %8.2f us/event' % (name, per_event))
+    return per_event
+
+
+def main():
+    events = load_events()
+    print('Extracting values from %d sample events, %d rounds' % (len(events), ROUNDS))
+
+    before = bench('findtext (before)', legacy_extract, events)
+    after = bench('compiled XPath (after)', accessor_extract, events)
+    print('Speedup: %.2fx' % (before / after))
+    single = bench('parse_event (one walk)', record_extract, events)
+    print('Speedup: %.2fx' % (before / single))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,8 +6,13 @@ import sys,os
 sys.path.insert( 0, os.getcwd() )
 xml_dir = os.path.join( os.path.dirname(__file__), 'xml_files')
 
-from oadr2 import event
+from oadr2 import dispatch, event, schedule
 from lxml import etree
+import datetime as dt
+import shutil
+import sqlite3
+import tempfile
+import threading
 import unittest
 
 # Some constants
@@ -143,6 +148,68 @@ class EventHandlerTest(unittest.TestCase):
         print('build_created_payload() OK')
 
 
+    def test_event_accessors(self):
+        print('in test_event_accessors()')
+
+        # The precompiled accessors should give the same results as plain findtext()
+        ns_map = self.event_handler.ns_map
+        for filename in ['batch_a_2.xml', 'batch_c_1.xml', 'sample_oadrDistributeEvent_W_something.xml']:
+            xml_doc = etree.parse(os.path.join(SAMPLE_DIR, filename)).getroot()
+            for evt in xml_doc.iterfind('oadr:oadrEvent/ei:eiEvent', namespaces=ns_map):
+                self.assertEqual(event.get_event_id(evt, ns_map),
+                        evt.findtext('ei:eventDescriptor/ei:eventID', namespaces=ns_map))
+                self.assertEqual(event.get_status(evt, ns_map),
+                        evt.findtext('ei:eventDescriptor/ei:eventStatus', namespaces=ns_map))
+                self.assertEqual(event.get_mod_number(evt, ns_map),
+                        int(evt.findtext('ei:eventDescriptor/ei:modificationNumber', namespaces=ns_map)))
+                self.assertEqual(event.get_market_context(evt, ns_map),
+                        evt.findtext('ei:eventDescriptor/ei:eiMarketContext/emix:marketContext', namespaces=ns_map))
+                self.assertEqual(event.get_ven_ids(evt, ns_map),
+                        [e.text for e in evt.iterfind('ei:eiTarget/ei:venID', namespaces=ns_map)])
+
+                signals = event.get_signals(evt, ns_map)
+                intervals = evt.findall('ei:eiEventSignals/ei:eiEventSignal/strm:intervals/ei:interval', namespaces=ns_map)
+                self.assertEqual(len(signals), len(intervals))
+                self.assertEqual(signals[0][0], intervals[0].findtext('xcal:duration/xcal:duration', namespaces=ns_map))
+
+            print('"%s" OK' % filename)
+
+        # A namespace map we haven't seen before gets its own compiled paths
+        ns_copy = dict(ns_map)
+        self.assertTrue(event.get_xpaths(ns_copy) is not event.get_xpaths(ns_map))
+        self.assertTrue(event.get_xpaths(ns_copy) is event.get_xpaths(ns_copy))
+
+        print('test_event_accessors() OK')
+
+
+    def test_parse_event(self):
+        print('in test_parse_event()')
+
+        # A single pass should come up with the same values as the accessor functions
+        ns_map = self.event_handler.ns_map
+        for filename in ['batch_a_2.xml', 'batch_c_3.xml', 'sample_oadrDistributeEvent_W_something.xml']:
+            xml_doc = etree.parse(os.path.join(SAMPLE_DIR, filename)).getroot()
+            for evt in xml_doc.iterfind('oadr:oadrEvent/ei:eiEvent', namespaces=ns_map):
+                record = event.parse_event(evt, ns_map)
+                self.assertEqual(record.event_id, event.get_event_id(evt, ns_map))
+                self.assertEqual(record.mod_number, event.get_mod_number(evt, ns_map))
+                self.assertEqual(record.status, event.get_status(evt, ns_map))
+                self.assertEqual(record.market_context, event.get_market_context(evt, ns_map))
+                self.assertEqual(record.current_value, event.get_current_signal_value(evt, ns_map))
+                self.assertEqual(record.dtstart, event.get_active_period_start(evt, ns_map))
+                self.assertEqual((record.start_before, record.start_after),
+                        event.get_start_before_after(evt, ns_map))
+                self.assertEqual(record.party_ids, frozenset(event.get_party_ids(evt, ns_map)))
+                self.assertEqual(record.group_ids, frozenset(event.get_group_ids(evt, ns_map)))
+                self.assertEqual(record.resource_ids, frozenset(event.get_resource_ids(evt, ns_map)))
+                self.assertEqual(record.ven_ids, frozenset(event.get_ven_ids(evt, ns_map)))
+                self.assertEqual(record.signals, event.get_signals(evt, ns_map))
+
+            print('"%s" OK' % filename)
+
+        print('test_parse_event() OK')
+
+
     def test_handle_payload(self):
         print('in test_handle_payload()')
 
@@ -227,6 +294,257 @@ class EventHandlerTest(unittest.TestCase):
         print('test_batch_a() OK')
 
 
+    # Same as test_batch_a(), but reading the payloads with handle_payload_stream()
+    def test_handle_payload_stream(self):
+        print('in test_handle_payload_stream()')
+
+        updated = {}
+        def callback(updated_events, removed_events):
+            updated.update(updated_events)
+        self.event_handler.event_callback = callback
+
+        files = ['batch_a_1.xml', 'batch_a_2.xml', 'batch_a_3.xml', 'batch_a_4.xml']
+        e_id = 'e_1'
+        mod_nums = [0, 1, 2, 4]
+
+        for i, filename in enumerate(files):
+            with open(os.path.join(SAMPLE_DIR, filename)) as xml_file:
+                payload = self.event_handler.handle_payload_stream(xml_file)
+            self.event_handler.dispatcher.join()
+
+            evt = self.event_handler.get_event(e_id)
+            self.assertEqual(event.get_mod_number(evt), mod_nums[i])
+
+            # The callback should still get the whole event, not a cleared one
+            self.assertEqual(event.get_mod_number(updated[e_id]), mod_nums[i])
+            self.assertTrue(event.get_signals(updated[e_id]))
+
+            self.assertTrue(payload is not None)
+            self.assertTrue(self.oadr_schema.validate(payload), msg='Return payload failed for %s'%(filename))
+            print('"%s" OK' % filename)
+
+        # A VTN we don't know about gets an error
+        self.event_handler.vtn_ids = ['vtn_1']
+        with open(os.path.join(SAMPLE_DIR, 'batch_a_1.xml')) as xml_file:
+            payload = self.event_handler.handle_payload_stream(xml_file)
+        err_code = payload.findtext('pyld:eiCreatedEvent/ei:eiResponse/ei:responseCode', namespaces=self.event_handler.ns_map)
+        self.assertEqual(err_code, '400')
+
+        print('test_handle_payload_stream() OK')
+
+
+    def test_event_callback(self):
+        print('in test_event_callback()')
+
+        handler = event.EventHandler(dispatcher=dispatch.Dispatcher(workers=1, max_queue=1),
+                **self.config)
+        gate = threading.Event()
+        calls = []
+        def callback(updated_events, removed_events):
+            gate.wait()
+            for evt in updated_events.values():
+                evt.find('.//ei:modificationNumber', namespaces=event.NS_A).text = '99'
+            calls.append(sorted(updated_events))
+        handler.event_callback = callback
+
+        # The first callback is running and the queue is full, but none are dropped
+        for filename in ('batch_a_1.xml', 'batch_a_2.xml', 'batch_a_3.xml'):
+            with open(os.path.join(SAMPLE_DIR, filename)) as xml_file:
+                handler.handle_payload(etree.XML(xml_file.read()))
+        gate.set()
+        self.assertTrue(handler.dispatcher.join(5))
+        self.assertEqual([['e_1']] * 3, calls)
+
+        # The callback changed its own copies, not the cached events
+        self.assertEqual(2, handler.get_event_record('e_1').mod_number)
+        self.assertEqual(2, event.get_mod_number(handler.get_event('e_1')))
+
+        handler.update_all_events({}, '')
+        handler.dispatcher.close()
+        handler.close()
+
+        print('test_event_callback() OK')
+
+
+    # Unchanged events should be skipped without touching the database
+    def test_event_index(self):
+        print('in test_event_index()')
+
+        with open(os.path.join(SAMPLE_DIR, 'batch_a_2.xml')) as xml_file:
+            xml_doc = etree.XML(xml_file.read())
+
+        self.event_handler.handle_payload(xml_doc)
+        self.assertEqual(self.event_handler._event_index, {'e_1': ('TH_VTN', 1)})
+        self.assertEqual(self.event_handler.db.get_event_index(), {'e_1': ('TH_VTN', 1)})
+
+        # A new handler picks up the index from the database
+        self.assertEqual(event.EventHandler(**self.config)._event_index, {'e_1': ('TH_VTN', 1)})
+
+        def no_reads(*args):
+            raise AssertionError('Read from the database for an unchanged event')
+        self.event_handler.db.get_event = no_reads
+        self.event_handler.db.get_active_events = no_reads
+
+        payload = self.event_handler.handle_payload(xml_doc)
+        self.assertTrue(self.oadr_schema.validate(payload))     # response is required 'always'
+
+        del self.event_handler.db.get_event
+        del self.event_handler.db.get_active_events
+
+        self.event_handler.remove_events(['e_1'])
+        self.assertEqual(self.event_handler._event_index, {})
+        self.assertEqual(self.event_handler.db.get_event_index(), {})
+
+        print('test_event_index() OK')
+
+
+    # A payload that fails part way through shouldn't change the index
+    def test_event_index_failed_payload(self):
+        print('in test_event_index_failed_payload()')
+
+        with open(os.path.join(SAMPLE_DIR, 'batch_a_1.xml')) as xml_file:
+            xml_doc = etree.XML(xml_file.read())
+
+        # The database can't take the payload's changes
+        def broken(records, event_ids):
+            raise sqlite3.OperationalError('disk I/O error')
+        self.event_handler.db.commit_batch = broken
+
+        self.assertRaises(sqlite3.OperationalError, self.event_handler.handle_payload, xml_doc)
+        del self.event_handler.db.commit_batch
+        self.assertEqual(self.event_handler._event_index, {})
+        self.assertEqual(self.event_handler.db.get_event_index(), {})
+
+        # Sending the good payload again stores e_1
+        self.event_handler.handle_payload(xml_doc)
+        self.assertEqual(self.event_handler._event_index, {'e_1': ('TH_VTN', 0)})
+        self.assertTrue(self.event_handler.get_event('e_1') is not None)
+
+        print('test_event_index_failed_payload() OK')
+
+
+    def test_bad_event(self):
+        print('in test_bad_event()')
+
+        with open(os.path.join(SAMPLE_DIR, 'batch_a_1.xml')) as xml_file:
+            xml_doc = etree.XML(xml_file.read())
+
+        # Put a second event with a malformed dtstart after e_1
+        ns_map = self.event_handler.ns_map
+        bad_evt = etree.fromstring(etree.tostring(
+                xml_doc.find('oadr:oadrEvent', namespaces=ns_map)))
+        bad_evt.find('.//ei:eventID', namespaces=ns_map).text = 'e_bad'
+        bad_evt.find('.//xcal:dtstart/xcal:date-time', namespaces=ns_map).text = 'yesterday'
+        xml_doc.append(bad_evt)
+
+        # e_1 is still stored & replied to; e_bad gets an error
+        reply = self.event_handler.handle_payload(xml_doc)
+        self.assertEqual(self.event_handler._event_index, {'e_1': ('TH_VTN', 0)})
+        responses = dict((r.findtext('.//ei:eventID', namespaces=ns_map),
+                          (r.findtext('ei:responseCode', namespaces=ns_map),
+                           r.findtext('ei:optType', namespaces=ns_map)))
+                for r in reply.iterfind('.//ei:eventResponse', namespaces=ns_map))
+        self.assertEqual({'e_1': ('200', 'optIn'), 'e_bad': ('400', 'optOut')}, responses)
+
+        # A bad update of an event leaves the stored one alone
+        xml_doc.remove(bad_evt)
+        bad_evt.find('.//ei:eventID', namespaces=ns_map).text = 'e_1'
+        bad_evt.find('.//ei:modificationNumber', namespaces=ns_map).text = '1'
+        xml_doc.remove(xml_doc.find('oadr:oadrEvent', namespaces=ns_map))
+        xml_doc.append(bad_evt)
+        self.event_handler.handle_payload(xml_doc)
+        self.assertEqual(self.event_handler._event_index, {'e_1': ('TH_VTN', 0)})
+
+        print('test_bad_event() OK')
+
+
+    def test_event_cache(self):
+        print('in test_event_cache()')
+
+        with open(os.path.join(SAMPLE_DIR, 'batch_a_2.xml')) as xml_file:
+            raw_xml = xml_file.read()
+        self.event_handler.handle_payload(etree.XML(raw_xml))
+
+        # Once loaded, reads don't go to the database
+        handler = event.EventHandler(**self.config)
+        self.assertEqual(None, handler._event_cache)
+        self.assertEqual(['e_1'], [r.event_id for r in handler.get_active_records()])
+
+        def no_reads(*args):
+            raise AssertionError('Read from the database with the event cache loaded')
+        handler.db.get_event = no_reads
+        handler.db.get_active_events = no_reads
+
+        self.assertEqual(1, handler.get_event_record('e_1').mod_number)
+        self.assertEqual('e_1', event.get_event_id(handler.get_event('e_1')))
+        self.assertEqual([], handler.get_active_records(within=0, now=dt.datetime(2013,6,6)))
+        self.assertEqual(['e_1'], handler.get_expired_events())
+
+        # Written through on every change
+        evt = handler.get_event('e_1')
+        evt.find('ei:eventDescriptor/ei:modificationNumber', namespaces=event.NS_A).text = '2'
+        handler.update_event('e_1', evt, 'TH_VTN')
+        self.assertEqual(2, handler.get_event_record('e_1').mod_number)
+
+        handler.remove_events(['e_1'])
+        self.assertEqual(None, handler.get_event_record('e_1'))
+        self.assertEqual([], list(handler.get_active_events()))
+
+        handler.update_all_events({'e_1': evt}, 'TH_VTN')
+        self.assertEqual(['e_1'], [r.event_id for r in handler.get_active_records()])
+
+        # The streamed events are cached without their trees
+        self.event_handler.update_all_events({}, '')
+        self.event_handler.get_active_records()
+        with open(os.path.join(SAMPLE_DIR, 'batch_a_2.xml')) as xml_file:
+            self.event_handler.handle_payload_stream(xml_file)
+        self.assertEqual(None, self.event_handler._event_cache['e_1'].element)
+        self.assertEqual('e_1', event.get_event_id(self.event_handler.get_event('e_1')))
+        handler.close()
+
+        print('test_event_cache() OK')
+
+
+    # The schedule columns should be filled in when events are stored
+    def test_event_columns(self):
+        print('in test_event_columns()')
+
+        with open(os.path.join(SAMPLE_DIR, 'batch_a_2.xml')) as xml_file:
+            self.event_handler.handle_payload(etree.XML(xml_file.read()))
+
+        start = schedule.dttm_to_timestamp(dt.datetime(2013,6,6,19,45,44))
+        c = self.event_handler.db._connect().cursor()
+        c.execute("SELECT status, dtstart, end_time, market_context FROM event WHERE event_id='e_1'")
+        self.assertEqual((u'active', start, start + 3*60, u'http://MarketContext1'), c.fetchone())
+        c.close()
+
+        # The sample event ended long ago
+        self.assertEqual([], list(self.event_handler.get_active_events(within=60)))
+        self.assertEqual(['e_1'], self.event_handler.get_expired_events())
+        self.assertEqual(1, len(list(self.event_handler.get_active_events())))
+
+        # Databases from before the columns existed get them filled in
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            old_path = os.path.join(tmp_dir, 'old.db')
+            raw_xml = self.event_handler.db.get_event('e_1')
+            conn = sqlite3.connect(old_path)
+            conn.execute('''CREATE TABLE event (id INTEGER PRIMARY KEY, vtn_id VARCHAR NOT NULL,
+                    event_id VARCHAR NOT NULL, mod_num INT NOT NULL DEFAULT 0, raw_xml TEXT NOT NULL)''')
+            conn.execute("INSERT INTO event(vtn_id, event_id, mod_num, raw_xml) VALUES('TH_VTN', 'e_1', 1, ?)",
+                    (raw_xml,))
+            conn.commit()
+            conn.close()
+
+            handler = event.EventHandler(db_path=old_path, **self.config)
+            self.assertEqual(['e_1'], handler.get_expired_events())
+            handler.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        print('test_event_columns() OK')
+
+
     # Test Batch B from the sample XML files; send an event, send a 2nd with a higher mod num,
     # then send one with a lower mod.
     # Similar in structure to test_batch_a()
@@ -0,0 +1,356 @@
+# Benchmarks for polling a VTN over HTTPS
+
+# NOTE: Make sure to run this file from the root directory of the project
+import sys,os
+sys.path.insert( 0, os.getcwd() )
+xml_dir = os.path.join( os.path.dirname(__file__), 'xml_files')
+
+import BaseHTTPServer
+import shutil
+import SocketServer
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import urllib2
+import zlib
+from lxml import etree
+from oadr2 import event, poll
+
+# Some constants
+SAMPLE_FILE = os.path.join(xml_dir, '2.0a_spec/batch_a_2.xml')
+REQUEST_FILE = os.path.join(xml_dir, '2.0a_spec/sample_oadrRequestEvent.xml')
+POLLS = 200
+ENGINE_TARGETS = 2000       # poll targets for the PollEngine benchmark
+ENGINE_INTERVAL = 5         # each polled every X seconds
+ENGINE_SECONDS = 10
+SAMPLE_FILE_B = os.path.join(xml_dir, '2.0b_spec/batch_a_2.xml')
+RESPONSE_FILE_B = os.path.join(xml_dir, '2.0b_spec/Sample_oadrResponse.xml')
+IDLE_EVENTS = 50            # events the VTN has out for the oadrPoll benchmark
+LINK_RATE = 128 * 1024      # bytes/second of the throttled link for the compression benchmark
+LINK_CHUNK = 4096
+LINK_POLLS = 5
+
+
+
+class StandInVTN(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    A local HTTPS (HTTP/1.1) server that answers every POST with the sample
+    distribution, and wants a client certificate.  Plain HTTP without a
+    certificate.
+    Counts the payload bytes going each way.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, cert=None, key=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        with open(SAMPLE_FILE) as xml_file:
+            self.body = xml_file.read()
+        self.bytes = 0
+
+        if cert is not None:
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            context.load_cert_chain(cert, key)
+            context.load_verify_locations(cert)
+            context.verify_mode = ssl.CERT_REQUIRED
+            self.socket = context.wrap_socket(self.socket, server_side=True)
+
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def handle_error(self, request, client_address):
+        pass    # i.e. the pooled connection being dropped at the end
+
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1       # the whole response in one write
+
+    def do_POST(self):
+        body = self.server.body
+        self.server.bytes += int(self.headers['content-length']) + len(body)
+        self.rfile.read(int(self.headers['content-length']))
+        self.send_response(200)
+        self.send_header('content-type', poll.CONTENT_TYPE)
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, *args):
+        pass
+
+
+
+def make_cert(tmp_dir):
+    '''
+    Make a self-signed certificate, used by both ends.
+
+    Returns: (cert path, key path)
+    '''
+
+    cert = os.path.join(tmp_dir, 'cert.pem')
+    key = os.path.join(tmp_dir, 'key.pem')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                '-keyout', key, '-out', cert, '-days', '1', '-subj', '/CN=127.0.0.1'],
+                stdout=devnull, stderr=devnull)
+    return cert, key
+
+
+def per_request(context, uri, body):
+    '''
+    A new connection (and TLS handshake) for every request, like the
+    urllib2 opener that was used before.
+    '''
+
+    opener = urllib2.build_opener(urllib2.HTTPSHandler(context=context))
+    def send():
+        req = urllib2.Request(uri, body, dict(poll.DEFAULT_HEADERS))
+        resp = opener.open(req, None, poll.REQUEST_TIMEOUT)
+        resp.read()
+        resp.close()
+    return send
+
+
+def pooled(context, uri, body):
+    '''
+    Persistent connections via `poll.HTTPTransport`
+    '''
+
+    transport = poll.HTTPTransport(context)
+    def send():
+        transport.request(uri, body, poll.DEFAULT_HEADERS).read()
+    return send
+
+
+def timed(send):
+    '''
+    Returns: (milliseconds per poll, CPU milliseconds per poll)
+
+    The CPU time is the whole process; the stand-in VTN's side of the
+    handshakes included.
+    '''
+
+    send()      # warm up
+    start, start_cpu = time.time(), sum(os.times()[:2])
+    for i in xrange(POLLS):
+        send()
+    end, end_cpu = time.time(), sum(os.times()[:2])
+    return (end - start) / POLLS * 1000, (end_cpu - start_cpu) / POLLS * 1000
+
+
+class EngineTarget(object):
+    '''
+    A poll target for the PollEngine benchmark; polls the stand-in VTN over
+    a transport shared by all of them.
+    '''
+
+    def __init__(self, transport, uri, body):
+        self.transport = transport
+        self.uri = uri
+        self.body = body
+        self.vtn_poll_interval = ENGINE_INTERVAL
+
+
+    def poll_once(self):
+        self.transport.request(self.uri, self.body, poll.DEFAULT_HEADERS).read()
+
+
+def bench_engine(body):
+    '''
+    Poll ENGINE_TARGETS targets every ENGINE_INTERVAL seconds on one
+    PollEngine; a poll thread each would be thousands of threads.
+    '''
+
+    server = StandInVTN()
+    uri = 'http://127.0.0.1:%d/OpenADR2/Simple/EiEvent' % server.server_address[1]
+    transport = poll.HTTPTransport(max_idle=poll.POLL_WORKERS)
+
+    engine = poll.PollEngine()
+    start_cpu = sum(os.times()[:2])
+    for i in xrange(ENGINE_TARGETS):
+        engine.add(EngineTarget(transport, uri, body), delay=ENGINE_INTERVAL * float(i) / ENGINE_TARGETS)
+    time.sleep(ENGINE_SECONDS)
+    stats = engine.get_stats()
+    cpu = sum(os.times()[:2]) - start_cpu
+    engine.close()
+    transport.close()
+    server.shutdown()
+
+    print('%d targets every %ds, %d poll threads + 1 scheduler' % (
+            ENGINE_TARGETS, ENGINE_INTERVAL, len(engine.workers)))
+    print('%14s %14s %14s %14s' % ('polls/s', 'expected/s', 'max lag (ms)', 'CPU (%)'))
+    print('%14.0f %14.0f %14.1f %14.0f' % (stats['polls'] / float(ENGINE_SECONDS),
+            ENGINE_TARGETS / float(ENGINE_INTERVAL), stats['max_lag'] * 1000,
+            cpu / ENGINE_SECONDS * 100))
+
+
+def build_distribution(count):
+    '''
+    Build a 2.0b oadrDistributeEvent of `count` copies of the sample event.
+
+    Returns: The payload, an XML string
+    '''
+
+    payload = etree.parse(SAMPLE_FILE_B).getroot()
+    sample = payload.find('oadr:oadrEvent', namespaces=event.NS_B)
+    payload.remove(sample)
+    for i in xrange(count):
+        evt = etree.fromstring(etree.tostring(sample))
+        evt.find('ei:eiEvent/ei:eventDescriptor/ei:eventID', namespaces=event.NS_B).text = 'e_%d' % i
+        payload.append(evt)
+    return etree.tostring(payload)
+
+
+def bench_oadr_poll(tmp_dir):
+    '''
+    Idle polls (nothing changed at the VTN) with IDLE_EVENTS events out:
+    a full oadrRequestEvent every time vs. an oadrPoll answered by an
+    oadrResponse.
+    '''
+
+    server = StandInVTN()
+    distribution = build_distribution(IDLE_EVENTS)
+    with open(RESPONSE_FILE_B) as xml_file:
+        response = xml_file.read()
+
+    print('%d idle polls, %d events out' % (POLLS, IDLE_EVENTS))
+    print('%14s %16s %16s' % ('', 'bytes/poll', 'CPU/poll (ms)'))
+    for name, use_oadr_poll in (('oadrRequest', False), ('oadrPoll', True)):
+        client = poll.OpenADR2({'ven_id': 'ven_py', 'vtn_ids': 'TH_VTN',
+                                'oadr_profile_level': event.OADR_PROFILE_20B,
+                                'db_path': os.path.join(tmp_dir, name + '.db')},
+                               'http://127.0.0.1:%d/' % server.server_address[1],
+                               control_opts={'start_thread': False},
+                               start_thread=False,
+                               use_oadr_poll=use_oadr_poll)
+
+        # First poll syncs the events
+        server.body = distribution
+        client.query_vtn()
+        client.reply_sender.join()
+        if use_oadr_poll:
+            server.body = response
+
+        server.bytes = 0
+        start_cpu = sum(os.times()[:2])
+        for i in xrange(POLLS):
+            client.query_vtn()
+        client.reply_sender.join()
+        cpu = sum(os.times()[:2]) - start_cpu
+        print('%14s %16.0f %16.3f' % (name, server.bytes / float(POLLS), cpu / POLLS * 1000))
+        client.exit()
+
+    server.shutdown()
+
+
+class ThrottledHandler(StandInHandler):
+    '''
+    Answers an oadrRequestEvent with the distribution (an empty body for
+    anything else) over a link of LINK_RATE bytes/second, gzipped if the
+    client takes it; counts the bytes on the wire (headers included) both
+    ways.  (Only the responses are throttled.)
+    '''
+
+    def do_POST(self):
+        request = self.rfile.read(int(self.headers['content-length']))
+        payload = request
+        if self.headers.get('content-encoding') == 'gzip':
+            payload = zlib.decompress(request, 16 + zlib.MAX_WBITS)
+        body = self.server.body if 'oadrRequestEvent' in payload else ''
+        headers = 'content-type: %s\r\n' % poll.CONTENT_TYPE
+        if 'gzip' in self.headers.get('accept-encoding', ''):
+            body = poll.gzip_compress(body)
+            headers += 'content-encoding: gzip\r\n'
+        response = 'HTTP/1.1 200 OK\r\n%scontent-length: %d\r\n\r\n%s' % (headers, len(body), body)
+        self.server.bytes += len(self.raw_requestline) + len(str(self.headers)) + len(request) \
+                + len(response)
+
+        for i in xrange(0, len(response), LINK_CHUNK):
+            time.sleep(LINK_CHUNK / float(LINK_RATE))
+            self.wfile.write(response[i:i + LINK_CHUNK])
+            self.wfile.flush()
+
+
+def bench_compression(tmp_dir):
+    '''
+    Full distributions of IDLE_EVENTS events over a throttled link, with and
+    without compression; time from the request going out to the payload
+    being handled.  The bytes include the oadrCreatedEvent reply.
+    '''
+
+    server = StandInVTN()
+    server.RequestHandlerClass = ThrottledHandler
+    server.body = build_distribution(IDLE_EVENTS)
+
+    print('%d polls of %d events (%d bytes) at %d KB/s' % (LINK_POLLS, IDLE_EVENTS,
+            len(server.body), LINK_RATE / 1024))
+    print('%18s %16s %16s' % ('', 'bytes/poll', 'handled in (ms)'))
+    for name, compress, stream_payloads, compress_replies in (
+            ('identity', False, False, False),
+            ('gzip', True, False, False),
+            ('gzip, streamed', True, True, False),
+            ('gzip replies too', True, True, True)):
+        client = poll.OpenADR2({'ven_id': 'ven_py', 'vtn_ids': 'TH_VTN',
+                                'oadr_profile_level': event.OADR_PROFILE_20B,
+                                'db_path': os.path.join(tmp_dir, 'compress.db')},
+                               'http://127.0.0.1:%d/' % server.server_address[1],
+                               control_opts={'start_thread': False},
+                               start_thread=False,
+                               stream_payloads=stream_payloads,
+                               compress=compress,
+                               compress_replies=compress_replies)
+
+        server.bytes = 0
+        elapsed = 0
+        for i in xrange(LINK_POLLS):
+            client.event_handler.remove_events(client.event_handler._event_index.keys())
+            start = time.time()
+            client.query_vtn()
+            elapsed += time.time() - start
+            client.reply_sender.join()
+        print('%18s %16.0f %16.1f' % (name, server.bytes / float(LINK_POLLS),
+                elapsed / LINK_POLLS * 1000))
+        client.exit()
+
+    server.shutdown()
+
+
+def main():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        cert, key = make_cert(tmp_dir)
+        server = StandInVTN(cert, key)
+        uri = 'https://127.0.0.1:%d/OpenADR2/Simple/EiEvent' % server.server_address[1]
+        with open(REQUEST_FILE) as xml_file:
+            body = xml_file.read()
+        context = poll.build_ssl_context(key, cert, cert)
+
+        print('%d polls' % POLLS)
+        print('%14s %16s %16s' % ('', 'per poll (ms)', 'CPU/poll (ms)'))
+        for name, client in (('per-request', per_request), ('keep-alive', pooled)):
+            latency, cpu = timed(client(context, uri, body))
+            print('%14s %16.2f %16.2f' % (name, latency, cpu))
+
+        server.shutdown()
+
+        print('')
+        bench_engine(body)
+
+        print('')
+        bench_oadr_poll(tmp_dir)
+
+        print('')
+        bench_compression(tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
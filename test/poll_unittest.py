@@ -0,0 +1,757 @@
+# Some Unit-Tests for the HTTP poll client
+
+# NOTE: Make sure to run this file from the root directory of the project
+import sys,os
+sys.path.insert( 0, os.getcwd() )
+xml_dir = os.path.join( os.path.dirname(__file__), 'xml_files')
+
+import BaseHTTPServer
+import SocketServer
+import datetime as dt
+import errno
+import httplib
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import urllib2
+import zlib
+from oadr2 import database, event, poll, schedule
+from lxml import etree
+import unittest
+
+# Some constants
+SAMPLE_FILE = os.path.join(xml_dir, '2.0a_spec/batch_a_2.xml')
+SAMPLE_FILE_B = os.path.join(xml_dir, '2.0b_spec/batch_a_2.xml')
+RESPONSE_FILE_B = os.path.join(xml_dir, '2.0b_spec/Sample_oadrResponse.xml')
+VTN_ID = 'TH_VTN'
+
+
+
+class StandInVTN(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    A local HTTP/1.1 server that answers every POST with `self.body`, and
+    keeps track of the connections & requests it gets.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.body = '<ok/>'
+        self.status = 200
+        self.statuses = []           # statuses for the next few requests
+        self.drop_after = False      # close the connection after each response
+        self.encoding = None         # compress responses to clients that take it:
+                                     # 'gzip', 'deflate' or 'raw deflate'
+        self.refuse_compressed = False   # 415 for compressed requests
+        self.hang_up = 0             # requests to hang up on, without a response
+        self.connections = set()
+        self.requests = []
+        self.request_headers = []
+
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def base_uri(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+    def handle_error(self, request, client_address):
+        pass    # i.e. the client closing a connection it didn't read all of
+
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1       # the whole response in one write
+
+    def do_POST(self):
+        self.server.connections.add(self.client_address)
+        self.server.requests.append((self.path, self.rfile.read(int(self.headers['content-length']))))
+        self.server.request_headers.append(self.headers)
+
+        if self.server.hang_up:
+            self.server.hang_up -= 1
+            self.close_connection = 1
+            return
+
+        status = self.server.statuses.pop(0) if self.server.statuses else self.server.status
+        if self.server.refuse_compressed and self.headers.get('content-encoding'):
+            status = 415
+
+        body = self.server.body
+        encoding = self.server.encoding
+        if encoding and encoding.split()[-1] in self.headers.get('accept-encoding', ''):
+            wbits = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}.get(encoding, -zlib.MAX_WBITS)
+            compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+            body = compressor.compress(body) + compressor.flush()
+        else:
+            encoding = None
+
+        self.send_response(status)
+        self.send_header('content-type', poll.CONTENT_TYPE)
+        if encoding:
+            self.send_header('content-encoding', encoding.split()[-1])
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        # Like a server timing out an idle connection, without saying so
+        self.close_connection = int(self.server.drop_after)
+
+
+    def log_message(self, *args):
+        pass
+
+
+
+class HTTPTransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInVTN()
+        self.transport = poll.HTTPTransport()
+        self.uri = self.server.base_uri() + 'EiEvent'
+
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.stop()
+
+
+    def test_keepalive(self):
+        for i in xrange(5):
+            resp = self.transport.request(self.uri, '<request_%d/>' % i, poll.DEFAULT_HEADERS)
+            self.assertEqual(200, resp.getcode())
+            self.assertEqual(poll.CONTENT_TYPE, resp.headers.gettype())
+            self.assertEqual('<ok/>', resp.read())
+
+        self.assertEqual(1, self.transport.connects)
+        self.assertEqual(1, len(self.server.connections))
+        self.assertEqual(['<request_%d/>' % i for i in xrange(5)], [r[1] for r in self.server.requests])
+
+        # Not read to the end, so the connection can't be used again
+        self.transport.request(self.uri, '<request/>', poll.DEFAULT_HEADERS).close()
+        self.transport.request(self.uri, '<request/>', poll.DEFAULT_HEADERS).read()
+        self.assertEqual(2, self.transport.connects)
+
+
+    def test_reconnect(self):
+        self.server.drop_after = True
+        for i in xrange(3):
+            self.assertEqual('<ok/>', self.transport.request(self.uri, '<request/>').read())
+            time.sleep(0.05)    # for the server to hang up
+        self.assertEqual(3, len(self.server.requests))
+        self.assertEqual(3, len(self.server.connections))
+
+        # Closed without a response, so a POST is sent once more on a new
+        # connection
+        self.server.drop_after = False
+        self.transport.request(self.uri, '<request/>').read()
+        self.server.hang_up = 1
+        del self.server.requests[:]
+        connects = self.transport.connects
+        self.assertEqual('<ok/>', self.transport.request(self.uri, '<request/>').read())
+        self.assertEqual(2, len(self.server.requests))
+        self.assertEqual(connects + 1, self.transport.connects)
+
+        # ...but only once
+        self.server.hang_up = 2
+        del self.server.requests[:]
+        self.assertRaises(urllib2.URLError, self.transport.request, self.uri, '<request/>')
+        self.assertEqual(2, len(self.server.requests))
+
+        # Nor is one that failed after some of the response came back
+        self.assertFalse(poll._nothing_received(httplib.BadStatusLine('HTTP/1.1 2')))
+        self.assertFalse(poll._nothing_received(socket.timeout('timed out')))
+        self.assertTrue(poll._nothing_received(socket.error(errno.ECONNRESET, 'reset')))
+
+
+    def test_compression(self):
+        with open(SAMPLE_FILE) as xml_file:
+            self.server.body = xml_file.read()
+
+        for encoding in ('gzip', 'deflate', 'raw deflate'):
+            self.server.encoding = encoding
+            resp = self.transport.request(self.uri, '<request/>', poll.DEFAULT_HEADERS)
+            self.assertEqual(encoding.split()[-1], resp.encoding)
+            self.assertEqual(self.server.body, resp.read())
+
+            # A bit at a time, or a line at a time
+            resp = self.transport.request(self.uri, '<request/>', poll.DEFAULT_HEADERS)
+            self.assertEqual(self.server.body, ''.join(iter(lambda: resp.read(100), '')))
+            resp = self.transport.request(self.uri, '<request/>', poll.DEFAULT_HEADERS)
+            self.assertEqual(self.server.body, ''.join(iter(resp.readline, '')))
+
+            resp = self.transport.request(self.uri, '<request/>', poll.DEFAULT_HEADERS)
+            self.assertEqual('oadrDistributeEvent', etree.QName(poll.read_payload(resp)).localname)
+
+        # All over the one connection
+        self.assertEqual(1, self.transport.connects)
+        self.assertTrue(all(headers['accept-encoding'] == poll.ACCEPT_ENCODING
+                            for headers in self.server.request_headers))
+
+        # Without asking
+        self.transport.compress = False
+        resp = self.transport.request(self.uri, '<request/>', poll.DEFAULT_HEADERS)
+        self.assertEqual(None, resp.encoding)
+        self.assertEqual(self.server.body, resp.read())
+
+
+    def test_compressed_requests(self):
+        self.transport.compress_requests = True
+        body = '<request>%s</request>' % ('x' * poll.MIN_COMPRESS_SIZE)
+
+        # Not until the server has compressed a response
+        self.transport.request(self.uri, body).read()
+        self.server.encoding = 'gzip'
+        self.transport.request(self.uri, body).read()
+        self.transport.request(self.uri, '<small/>').read()
+        self.transport.request(self.uri, body).read()
+        self.assertEqual([body, body, '<small/>'], [r[1] for r in self.server.requests[:3]])
+        self.assertEqual('gzip', self.server.request_headers[3]['content-encoding'])
+        self.assertEqual(body, zlib.decompress(self.server.requests[3][1], 16 + zlib.MAX_WBITS))
+
+        # The server can't take them after all
+        self.server.refuse_compressed = True
+        del self.server.requests[:]
+        self.assertEqual('<ok/>', self.transport.request(self.uri, body).read())
+        self.transport.request(self.uri, body).read()
+        self.assertEqual(3, len(self.server.requests))
+        self.assertEqual([body, body], [r[1] for r in self.server.requests[1:]])
+
+
+    def test_errors(self):
+        self.server.status = 500
+        self.server.body = '<error/>'
+        try:
+            self.transport.request(self.uri, '<request/>')
+            self.fail('No HTTPError')
+        except urllib2.HTTPError as ex:
+            self.assertEqual(500, ex.code)
+            self.assertEqual('<error/>', ex.read())
+
+        # Nothing listening
+        uri = self.server.base_uri()
+        self.server.stop()
+        self.transport.close()
+        self.assertRaises(urllib2.URLError, self.transport.request, uri, '<request/>')
+        self.server = StandInVTN()
+
+
+
+class ReplySenderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.server = StandInVTN()
+        self.uri = self.server.base_uri() + 'EiEvent'
+        self.transport = poll.HTTPTransport()
+        self.db = database.DBHandler(os.path.join(self.tmp_dir, 'test.db'))
+        self.sender = None
+
+
+    def tearDown(self):
+        if self.sender is not None:
+            self.sender.close()
+        self.transport.close()
+        self.server.stop()
+        self.db.close()
+        shutil.rmtree(self.tmp_dir)
+
+
+    def test_retry(self):
+        self.sender = poll.ReplySender(self.transport, retry_interval=0.02, max_attempts=3)
+
+        # Fails twice, then goes through
+        self.server.statuses = [503, 500]
+        self.assertTrue(self.sender.send('<reply_1/>', self.uri))
+        self.assertTrue(self.sender.join(5))
+        self.assertEqual(['<reply_1/>'] * 3, [r[1] for r in self.server.requests])
+
+        # A 4xx isn't tried again, and 5xx only so many times
+        self.server.statuses = [400, 500, 500, 500]
+        self.sender.send('<reply_2/>', self.uri)
+        self.sender.send('<reply_3/>', self.uri)
+        self.assertTrue(self.sender.join(5))
+        self.assertEqual(1, [r[1] for r in self.server.requests].count('<reply_2/>'))
+        self.assertEqual(3, [r[1] for r in self.server.requests].count('<reply_3/>'))
+
+        stats = self.sender.get_stats()
+        self.assertEqual((1, 4, 2, 0), (stats['sent'], stats['retries'], stats['failed'], stats['queued']))
+
+
+    def test_spool(self):
+        # The VTN is down, so the reply stays in the spool
+        uri = self.uri
+        self.server.stop()
+        self.sender = poll.ReplySender(self.transport, spool=self.db, retry_interval=10)
+        self.sender.send('<reply/>', uri)
+        self.assertFalse(self.sender.join(0.2))
+        self.sender.close()
+        self.assertEqual([('<reply/>', 1)], [(r[2], r[3]) for r in self.db.get_replies()])
+
+        # ... until it's back up
+        self.server = StandInVTN()
+        uri = self.server.base_uri() + 'EiEvent'
+        self.db.update_event('e_1', 0, '<one/>', 'vtn_1')
+        conn = self.db._connect()
+        conn.execute('UPDATE reply SET uri=?', (uri,))
+        conn.commit()
+
+        self.sender = poll.ReplySender(self.transport, spool=self.db)
+        self.assertTrue(self.sender.join(5))
+        self.assertEqual(['<reply/>'], [r[1] for r in self.server.requests])
+        self.assertEqual([], self.db.get_replies())
+
+
+    def test_spool_error(self):
+        self.sender = poll.ReplySender(self.transport, spool=self.db)
+        def broken(reply_id):
+            raise IOError('disk full')
+        self.db.remove_reply = broken
+
+        # The sender keeps going after the spool fails
+        self.sender.send('<reply_1/>', self.uri)
+        self.assertTrue(self.sender.join(5))
+        self.assertTrue(self.sender.send_thread.is_alive())
+        del self.db.remove_reply
+
+        self.sender.send('<reply_2/>', self.uri)
+        self.assertTrue(self.sender.join(5))
+        self.assertEqual(['<reply_1/>', '<reply_2/>'], [r[1] for r in self.server.requests])
+
+
+    def test_queue_full(self):
+        self.server.stop()
+        self.sender = poll.ReplySender(self.transport, max_queue=2, retry_interval=10)
+        results = [self.sender.send('<reply_%d/>' % i, self.uri) for i in xrange(4)]
+        self.assertEqual([True, True, False, False], results)
+        self.assertEqual(2, self.sender.get_stats()['dropped'])
+        self.server = StandInVTN()
+
+        self.sender.close()
+        self.assertFalse(self.sender.send('<reply_closed/>', self.uri))
+        self.assertEqual(3, self.sender.get_stats()['dropped'])
+
+
+
+class FakeTarget(object):
+    '''
+    Stands in for an OpenADR2 object; keeps track of its polls.
+    '''
+
+    def __init__(self, engine_test, interval):
+        self.engine_test = engine_test
+        self.vtn_poll_interval = interval
+        self.polls = 0
+        self.running = False
+
+
+    def poll_once(self):
+        self.engine_test.started(self)
+        self.polls += 1
+        time.sleep(0.01)
+        self.running = False
+        self.engine_test.finished()
+
+
+
+class PollEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = poll.PollEngine(workers=3)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.most_running = 0
+        self.overlapped = False
+
+
+    def tearDown(self):
+        self.engine.close()
+
+
+    def started(self, target):
+        with self.lock:
+            self.overlapped |= target.running
+            target.running = True
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+
+
+    def finished(self):
+        with self.lock:
+            self.running -= 1
+
+
+    def test_engine(self):
+        targets = [FakeTarget(self, 0.05) for i in xrange(20)]
+        for target in targets:
+            self.engine.add(target)
+        slow = FakeTarget(self, 10)
+        self.engine.add(slow, delay=0.1)
+        fast = FakeTarget(self, 10)
+        self.engine.add(fast, interval=0.02)
+
+        time.sleep(0.6)
+        self.engine.remove(targets[0])
+        removed_polls = targets[0].polls
+        time.sleep(0.2)
+
+        # Every target got polled a few times, but only 3 at once & never
+        # the same one twice at once
+        self.assertTrue(all(t.polls >= 3 for t in targets[1:]), [t.polls for t in targets])
+        self.assertEqual(1, slow.polls)
+        self.assertTrue(fast.polls > targets[1].polls)
+        self.assertEqual(3, self.most_running)
+        self.assertFalse(self.overlapped)
+
+        self.assertTrue(targets[0].polls <= removed_polls + 1)
+        self.engine.close()
+        self.assertFalse(any(t.is_alive() for t in self.engine.workers))
+
+        stats = self.engine.get_stats()
+        self.assertEqual(21, stats['targets'])
+        self.assertEqual(0, stats['errors'])
+        self.assertEqual(sum(t.polls for t in targets + [slow, fast]), stats['polls'])
+
+
+    def test_wake(self):
+        target = object()
+        calls = []
+        def update():
+            calls.append(time.time())
+            time.sleep(0.05)
+            return None     # nothing to wait for
+        self.engine.add(target, func=update)
+
+        # Not run again until it's woken
+        time.sleep(0.1)
+        self.assertEqual(1, len(calls))
+        self.engine.wake(target)
+        time.sleep(0.1)
+        self.assertEqual(2, len(calls))
+
+        # Woken while it's running, it runs once more right after
+        self.engine.wake(target)
+        time.sleep(0.01)
+        self.engine.wake(target)
+        self.engine.wake(target)
+        time.sleep(0.2)
+        self.assertEqual(4, len(calls))
+        self.assertFalse(any(b - a < 0.05 for a, b in zip(calls, calls[1:])))
+
+        # Woken before it's due
+        self.engine.add(target, interval=10, delay=10, func=update)
+        self.engine.wake(target)
+        time.sleep(0.1)
+        self.assertEqual(5, len(calls))
+
+
+
+class OpenADR2Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.server = StandInVTN()
+        with open(SAMPLE_FILE) as xml_file:
+            self.server.body = xml_file.read()
+
+        self.poller = poll.OpenADR2({'ven_id': 'ven_py', 'vtn_ids': VTN_ID,
+                                     'db_path': os.path.join(self.tmp_dir, 'test.db')},
+                                    self.server.base_uri(),
+                                    control_opts={'start_thread': False},
+                                    start_thread=False)
+
+
+    def tearDown(self):
+        self.poller.exit()
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+
+    def test_query_vtn(self):
+        self.poller.query_vtn()
+        self.assertTrue(self.poller.reply_sender.join(5))
+        self.poller.query_vtn()
+        self.assertTrue(self.poller.reply_sender.join(5))
+
+        # The request & reply of both polls over one connection
+        self.assertEqual(4, len(self.server.requests))
+        self.assertEqual(1, len(self.server.connections))
+        self.assertTrue(all(path == '/OpenADR2/Simple/EiEvent' for path, body in self.server.requests))
+        self.assertTrue('oadrRequestEvent' in self.server.requests[0][1])
+        self.assertTrue('oadrCreatedEvent' in self.server.requests[1][1])
+        self.assertEqual(['e_1'], self.poller.event_handler._event_index.keys())
+
+        # Compressed, and handled as it is decompressed
+        self.server.encoding = 'gzip'
+        for stream_payloads in (False, True):
+            self.poller.stream_payloads = stream_payloads
+            self.poller.event_handler.remove_events(['e_1'])
+            self.poller.query_vtn()
+            self.assertTrue(self.poller.reply_sender.join(5))
+            self.assertEqual(['e_1'], self.poller.event_handler._event_index.keys())
+
+
+    def test_cancelled_events(self):
+        wakeups = self.poller.event_controller._control_loop_signal
+        self.poller.query_vtn()
+        self.assertTrue(self.poller.reply_sender.join(5))
+        self.assertTrue(wakeups.is_set())
+        wakeups.clear()
+
+        # No events at all; nothing to reply to, but e_1 was cancelled
+        distribution = etree.parse(SAMPLE_FILE).getroot()
+        for evt in distribution.findall('oadr:oadrEvent', namespaces=event.NS_A):
+            distribution.remove(evt)
+        self.server.body = etree.tostring(distribution)
+        self.poller.query_vtn()
+        self.assertEqual({}, self.poller.event_handler._event_index)
+        self.assertTrue(wakeups.is_set())
+        wakeups.clear()
+
+        # Nothing changed this time
+        self.poller.query_vtn()
+        self.assertFalse(wakeups.is_set())
+
+
+    def test_poll_interval(self):
+        self.poller.vtn_poll_interval = 300
+        self.poller.min_poll_interval = 10
+        self.poller.max_poll_interval = 3600
+        start = dt.datetime(2013,6,6,19,45,44)
+        handler = self.poller.event_handler
+
+        # Nothing going on
+        self.assertEqual(3600, self.poller.next_poll_interval(start))
+
+        # e_1 starts at `start` & runs for 3 minutes
+        evt = etree.parse(SAMPLE_FILE).getroot().find('oadr:oadrEvent/ei:eiEvent', namespaces=event.NS_A)
+        handler.update_event('e_1', evt, VTN_ID)
+        self.assertEqual(3600, self.poller.next_poll_interval(start - dt.timedelta(days=1)))
+        self.assertEqual(100, self.poller.next_poll_interval(start - dt.timedelta(seconds=400)))
+        self.assertEqual(10, self.poller.next_poll_interval(start - dt.timedelta(seconds=20)))
+        self.assertEqual(300, self.poller.next_poll_interval(start + dt.timedelta(minutes=1)))
+        self.assertEqual(3600, self.poller.next_poll_interval(start + dt.timedelta(minutes=5)))
+
+        # Another one that can start up to an hour early
+        record = event.EventRecord(event_id='e_2', mod_number=0, dtstart=start + dt.timedelta(days=1),
+                start_before='PT1H', signals=[])
+        handler._update_cache({'e_2': event.CachedEvent(record, None,
+                schedule.dttm_to_timestamp(record.dtstart), None)})
+        self.assertEqual(start + dt.timedelta(hours=23), dt.datetime.utcfromtimestamp(
+                handler.get_next_start(start + dt.timedelta(minutes=5))))
+        self.assertEqual(900, self.poller.next_poll_interval(start + dt.timedelta(hours=22)))
+        self.assertEqual(10, self.poller.next_poll_interval(start + dt.timedelta(hours=23, minutes=30)))
+
+        # Back off on errors
+        for errors, low, high in ((1, 300, 600), (2, 600, 1200), (3, 1200, 2400), (20, 1800, 3600)):
+            self.poller.poll_errors = errors
+            for i in xrange(20):
+                self.assertTrue(low <= self.poller.next_poll_interval(start) <= high)
+
+        # The VTN went away
+        self.server.stop()
+        self.poller.transport.close()
+        self.poller.poll_errors = 0
+        self.assertTrue(300 <= self.poller.poll_once() <= 600)
+        self.assertEqual(1, self.poller.poll_errors)
+        self.server = StandInVTN()
+
+        # With the defaults, it's always the same...
+        self.poller.poll_errors = 0
+        self.poller.min_poll_interval = self.poller.max_poll_interval = 300
+        self.assertEqual(300, self.poller.next_poll_interval(start - dt.timedelta(seconds=20)))
+
+        # ...but errors still back off, up to MAX_BACKOFF_INTERVAL
+        for errors, low, high in ((1, 300, 600), (3, 1200, 2400), (5, 1800, 3600), (20, 1800, 3600)):
+            self.poller.poll_errors = errors
+            for i in xrange(20):
+                self.assertTrue(low <= self.poller.next_poll_interval(start) <= high)
+
+
+    def test_oadr_poll(self):
+        self.assertFalse(self.poller.use_oadr_poll)
+        self.poller.exit()
+        self.poller = poll.OpenADR2({'ven_id': 'ven_py', 'vtn_ids': VTN_ID,
+                                     'oadr_profile_level': event.OADR_PROFILE_20B,
+                                     'db_path': os.path.join(self.tmp_dir, 'test_b.db')},
+                                    self.server.base_uri(),
+                                    control_opts={'start_thread': False},
+                                    start_thread=False,
+                                    use_oadr_poll=True)
+        self.assertTrue(self.poller.use_oadr_poll)
+        with open(SAMPLE_FILE_B) as xml_file:
+            distribution = xml_file.read()
+        with open(RESPONSE_FILE_B) as xml_file:
+            response = xml_file.read()
+        paths = lambda: [path.rsplit('/', 1)[1] for path, body in self.server.requests]
+
+        # The events are requested until they have been handled
+        self.server.body = '<broken'
+        self.poller.query_vtn()
+        self.poller.query_vtn()
+        self.assertEqual(['EiEvent', 'EiEvent'], paths())
+        self.assertFalse(self.poller._synced)
+        del self.server.requests[:]
+
+        self.server.body = distribution
+        self.poller.query_vtn()
+        self.assertTrue(self.poller.reply_sender.join(5))
+        self.assertEqual(['EiEvent', 'EiEvent'], paths())
+        self.assertTrue('oadrRequestEvent' in self.server.requests[0][1])
+        self.assertEqual(['e_1'], self.poller.event_handler._event_index.keys())
+
+        # Nothing new, so nothing else is done
+        self.server.body = response
+        del self.server.requests[:]
+        self.poller.event_handler.handle_payload = None
+        self.poller.query_vtn()
+        self.assertEqual(['OadrPoll'], paths())
+        self.assertTrue('oadrPoll' in self.server.requests[0][1])
+        del self.poller.event_handler.handle_payload
+
+        # The VTN sends the distribution back right away
+        self.server.body = distribution
+        del self.server.requests[:]
+        self.poller.query_vtn()
+        self.assertTrue(self.poller.reply_sender.join(5))
+        self.assertEqual(['OadrPoll', 'EiEvent'], paths())
+        self.assertTrue('oadrCreatedEvent' in self.server.requests[1][1])
+
+        # Something we don't know about; check the events to be safe
+        self.server.body = '<oadr:oadrRequestReregistration xmlns:oadr="%s"/>' % event.OADR_XMLNS_B
+        del self.server.requests[:]
+        self.poller.query_vtn()
+        self.assertTrue(self.poller.reply_sender.join(5))
+        self.assertEqual(['OadrPoll', 'EiEvent'], paths()[:2])
+        self.assertTrue('oadrRequestEvent' in self.server.requests[1][1])
+
+
+    def test_engine(self):
+        self.poller.exit()
+        engine = poll.PollEngine(workers=1)
+        self.poller = poll.OpenADR2({'ven_id': 'ven_py', 'vtn_ids': VTN_ID,
+                                     'db_path': os.path.join(self.tmp_dir, 'engine.db')},
+                                    self.server.base_uri(),
+                                    control_opts={'start_thread': False},
+                                    engine=engine)
+        self.assertFalse(self.poller.poll_thread.is_alive())
+
+        for i in xrange(50):
+            if self.server.requests: break
+            time.sleep(0.05)
+        self.poller.exit()
+        self.assertEqual(0, engine.get_stats()['targets'])
+        engine.close()
+
+        self.assertTrue('oadrRequestEvent' in self.server.requests[0][1])
+
+
+    def test_engine_targets(self):
+        self.poller.exit()
+        engine = poll.PollEngine(workers=1)
+        distribution = etree.parse(SAMPLE_FILE).getroot()
+        start = dt.datetime.utcnow().replace(microsecond=0) + dt.timedelta(days=1)
+        distribution.find('.//xcal:dtstart/xcal:date-time', namespaces=event.NS_A).text = \
+                schedule.dttm_to_str(start, include_msec=False)
+        self.server.body = etree.tostring(distribution)
+
+        # A reply left over from before a restart
+        db_paths = [os.path.join(self.tmp_dir, 'engine%d.db' % i) for i in xrange(2)]
+        db = database.DBHandler(db_paths[0])
+        db.add_reply(self.server.base_uri() + 'spooled', '<spooled/>')
+        db.close()
+
+        pollers = [poll.OpenADR2({'ven_id': 'ven_py', 'vtn_ids': VTN_ID, 'db_path': db_path},
+                                 self.server.base_uri(),
+                                 vtn_poll_interval=3600,
+                                 spool_replies=True,
+                                 engine=engine)
+                   for db_path in db_paths]
+        self.poller = pollers[0]
+
+        # Each target needs a database of its own
+        self.assertRaises(ValueError, poll.OpenADR2,
+                {'ven_id': 'ven_py', 'vtn_ids': VTN_ID, 'db_path': db_paths[1]},
+                self.server.base_uri(), engine=engine)
+        self.assertEqual(4, engine.get_stats()['targets'])
+
+        for i in xrange(100):
+            if all(p.event_handler._event_index for p in pollers): break
+            time.sleep(0.05)
+        self.assertTrue(engine.reply_sender.join(5))
+        self.assertEqual([['e_1'], ['e_1']], [p.event_handler._event_index.keys() for p in pollers])
+        self.assertEqual(1, len([path for path, body in self.server.requests if path == '/spooled']))
+
+        # e_1 is cancelled for one target, but not the other
+        for evt in distribution.findall('oadr:oadrEvent', namespaces=event.NS_A):
+            distribution.remove(evt)
+        self.server.body = etree.tostring(distribution)
+        pollers[0].query_vtn()
+        self.assertEqual({}, pollers[0].event_handler._event_index)
+        self.assertEqual(['e_1'], pollers[1].event_handler.db.get_event_index().keys())
+
+        pollers[1].exit()
+        engine.close()
+
+
+    def test_engine_threads(self):
+        self.poller.exit()
+        engine = poll.PollEngine(workers=2)
+        count_threads = lambda: len([t for t in threading.enumerate() if t.name.startswith('oadr2')])
+        threads = count_threads()
+
+        pollers = [poll.OpenADR2({'ven_id': 'ven_py', 'vtn_ids': VTN_ID,
+                                  'db_path': os.path.join(self.tmp_dir, 'engine%d.db' % i)},
+                                 self.server.base_uri(),
+                                 vtn_poll_interval=10,
+                                 engine=engine)
+                   for i in xrange(20)]
+
+        # The event controllers, callbacks & replies all run on the engine
+        self.assertEqual(threads, count_threads())
+        self.assertEqual(40, engine.get_stats()['targets'])
+        self.assertTrue(all(p.reply_sender is engine.reply_sender for p in pollers))
+
+        for i in xrange(100):
+            if len(self.server.requests) >= 40: break
+            time.sleep(0.05)
+        self.assertTrue(engine.reply_sender.join(5))
+        self.assertEqual(40, len(self.server.requests))
+
+        # The new event woke each controller (well before its first update
+        # is due), which removed it since it has ended
+        for i in xrange(100):
+            if not any(p.event_handler._event_index for p in pollers): break
+            time.sleep(0.05)
+        self.assertFalse(any(p.event_handler._event_index for p in pollers))
+        self.assertTrue(engine.get_stats()['polls'] >= 40)
+
+        # ...and the workers didn't hang on to a connection to every database;
+        # only ours is left, once the last control updates have finished
+        open_connections = lambda: [len(p.event_handler.db._connections) for p in pollers]
+        for i in xrange(100):
+            if open_connections() == [1] * 20: break
+            time.sleep(0.05)
+        self.assertEqual([1] * 20, open_connections())
+        self.assertEqual(threads, count_threads())
+
+        for poller in pollers:
+            poller.exit()
+        self.assertEqual(0, engine.get_stats()['targets'])
+        engine.close()
+
+
+
+if __name__ == '__main__':
+    unittest.main()
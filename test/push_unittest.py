@@ -0,0 +1,120 @@
+# Some Unit-Tests for the HTTP push receiver
+# NOTE: Make sure to run this file from the root directory of the project
+import sys,os
+sys.path.insert( 0, os.getcwd() )
+xml_dir = os.path.join( os.path.dirname(__file__), 'xml_files')
+
+import httplib
+import shutil
+import socket
+import tempfile
+import time
+from lxml import etree
+from oadr2 import event, poll, push
+import unittest
+
+# Some constants
+SAMPLE_FILE = os.path.join(xml_dir, '2.0a_spec/batch_a_2.xml')
+VTN_ID = 'TH_VTN'
+
+
+
+class PushTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.receiver = push.OpenADR2({'ven_id': 'ven_py', 'vtn_ids': VTN_ID,
+                                       'db_path': os.path.join(self.tmp_dir, 'test.db')},
+                                      control_opts={'start_thread': False},
+                                      listen_host='127.0.0.1', listen_port=0,
+                                      max_connections=2, max_request_size=64 * 1024)
+        self.port = self.receiver.listen_address[1]
+        with open(SAMPLE_FILE) as xml_file:
+            self.payload = xml_file.read()
+
+
+    def tearDown(self):
+        self.receiver.exit()
+        shutil.rmtree(self.tmp_dir)
+
+
+    def post(self, body, path=push.EVENT_PATH, conn=None):
+        '''
+        Stands in for the VTN; POST a payload.
+
+        Returns: (status, response body)
+        '''
+
+        if conn is not None:
+            conn.request('POST', path, body, poll.DEFAULT_HEADERS)
+            resp = conn.getresponse()
+            return resp.status, resp.read()
+
+        conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        try:
+            return self.post(body, path, conn)
+        finally:
+            conn.close()
+
+            # Wait for its thread, so the next one isn't turned away
+            for i in xrange(100):
+                if not self.receiver.server.active: break
+                time.sleep(0.01)
+
+
+    def test_distribute_event(self):
+        conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        status, body = self.post(self.payload, conn=conn)
+        self.assertEqual(200, status)
+
+        reply = etree.fromstring(body)
+        self.assertEqual('{%s}oadrCreatedEvent' % event.OADR_XMLNS_A, reply.tag)
+        self.assertEqual('200', reply.findtext('pyld:eiCreatedEvent/ei:eiResponse/ei:responseCode',
+                namespaces=event.NS_A))
+        self.assertEqual(['e_1'], self.receiver.event_handler._event_index.keys())
+
+        # Again, on the same connection
+        status, body = self.post(self.payload, conn=conn)
+        self.assertEqual(200, status)
+        conn.close()
+
+
+    def test_bad_requests(self):
+        self.assertEqual(404, self.post(self.payload, path='/somewhere/else')[0])
+        self.assertEqual(400, self.post('<not xml')[0])
+        self.assertEqual(413, self.post('x' * (64 * 1024 + 1))[0])
+        self.assertEqual({}, self.receiver.event_handler._event_index)
+
+        # Anything but an oadrDistributeEvent doesn't cancel the events
+        self.assertEqual(200, self.post(self.payload)[0])
+        self.assertEqual(400, self.post('<oadr:oadrRequestEvent xmlns:oadr="%s"/>' % event.OADR_XMLNS_A)[0])
+        self.assertEqual(400, self.post('<anything/>')[0])
+        self.assertEqual(['e_1'], self.receiver.event_handler._event_index.keys())
+
+
+    def test_db_connections(self):
+        # Each connection's thread closes its database connection when it's done
+        db = self.receiver.event_handler.db
+        before = len(db._connections)
+        for i in xrange(10):
+            self.assertEqual(200, self.post(self.payload)[0])
+        self.assertEqual(before, len(db._connections))
+
+
+    def test_connection_limit(self):
+        # Two connections that haven't sent anything yet use up the limit
+        idle = [socket.create_connection(('127.0.0.1', self.port)) for i in xrange(2)]
+        time.sleep(0.1)
+        self.assertEqual(503, self.post(self.payload)[0])
+        self.assertEqual({}, self.receiver.event_handler._event_index)
+
+        # Once they go away, there's room again
+        for sock in idle:
+            sock.close()
+        time.sleep(0.1)
+        self.assertEqual(200, self.post(self.payload)[0])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+# Micro-benchmarks for the schedule module
+
+# NOTE: Make sure to run this file from the root directory of the project
+import sys,os
+sys.path.insert( 0, os.getcwd() )
+
+import datetime as dt
+import random
+import time
+import timeit
+from dateutil.relativedelta import relativedelta
+from oadr2 import schedule
+
+# Some constants
+START = dt.datetime(2013,5,12,8,30,50)
+INTERVAL_COUNTS = (10, 1000, 5000)
+ROUNDS = 100
+TIMESTAMP_COUNT = 1000000
+
+
+
+def legacy_choose_interval(start, interval_list, now):
+    '''
+    `choose_interval()` the way it used to work; all of the boundaries worked
+    out on every call, then a linear scan.
+    '''
+
+    interval_start_list = schedule.durations_to_dates(start, interval_list)
+    current_interval_end = None
+
+    for i in range(len(interval_start_list)):
+        new_interval_end = interval_start_list[i]
+        if new_interval_end > now:
+            return i - 1
+        if new_interval_end == current_interval_end:
+            return i - 1
+        current_interval_end = new_interval_end
+
+    return None
+
+
+def bench_choose_interval():
+    '''
+    Time finding the current interval of an event with 1 minute intervals,
+    at the middle of the event.
+    '''
+
+    print('%10s %16s %18s %10s' % ('intervals', 'legacy (us)', 'get_timeline (us)', 'speedup'))
+    for count in INTERVAL_COUNTS:
+        intervals = ['PT1M'] * count
+        now = START + dt.timedelta(minutes=count // 2, seconds=30)
+
+        before = timeit.timeit(lambda: legacy_choose_interval(START, intervals, now),
+                number=ROUNDS) / ROUNDS * 1e6
+
+        key = ('e_%d' % count, 0)
+        schedule.get_timeline(key, START, intervals)    # worked out once per event
+        after = timeit.timeit(lambda: schedule.get_timeline(key, START, intervals).choose_interval(now),
+                number=ROUNDS) / ROUNDS * 1e6
+
+        print('%10d %16.1f %18.1f %9.0fx' % (count, before, after, before / after))
+
+
+def legacy_durations_to_dates(start, dur_list):
+    '''
+    `durations_to_dates()` the way it used to work; every duration parsed
+    with the regex and turned into a new relativedelta.
+    '''
+
+    new_dttm = start
+    new_list = [start,]
+
+    for dur_str in dur_list:
+        groups = schedule.DURATION_REX.match(dur_str).groups()
+        vals = tuple(int(i) if i is not None else 0 for i in groups[1:])
+        delta = relativedelta(years=vals[0], months=vals[1], days=vals[2],
+                hours=vals[3], minutes=vals[4], seconds=vals[5])
+        new_dttm = new_dttm + delta if (groups[0] or '+') == '+' else new_dttm - delta
+        new_list.append( new_dttm )
+
+    return new_list
+
+
+def bench_durations():
+    '''
+    Time working out the boundaries of an event with 1 minute intervals.
+    '''
+
+    print('%10s %16s %16s %10s' % ('intervals', 'legacy (us)', 'cached (us)', 'speedup'))
+    for count in INTERVAL_COUNTS:
+        intervals = ['PT1M', 'PT15M', 'PT1H', 'PT0S'] * (count // 4) or ['PT1M'] * count
+
+        before = timeit.timeit(lambda: legacy_durations_to_dates(START, intervals),
+                number=ROUNDS) / ROUNDS * 1e6
+        after = timeit.timeit(lambda: schedule.durations_to_dates(START, intervals),
+                number=ROUNDS) / ROUNDS * 1e6
+        assert legacy_durations_to_dates(START, intervals) == schedule.durations_to_dates(START, intervals)
+
+        print('%10d %16.1f %16.1f %9.1fx' % (count, before, after, before / after))
+
+    cache = schedule.duration_cache
+    print('duration cache: %d hits, %d misses, %d evictions' % (
+            cache.hits, cache.misses, cache.evictions))
+
+
+def legacy_str_to_datetime(dt_str):
+    fmt = '%Y-%m-%dT%H:%M:%S.%fZ' if '.' in dt_str \
+            else '%Y-%m-%dT%H:%M:%SZ'
+    return dt.datetime.strptime(dt_str,fmt)
+
+
+def legacy_dttm_to_str(dttm, include_msec=True):
+    fmt = '%Y-%m-%dT%H:%M:%S.%fZ' if include_msec \
+            else '%Y-%m-%dT%H:%M:%SZ'
+    return dttm.strftime(fmt)
+
+
+def bench_timestamps(count=TIMESTAMP_COUNT):
+    '''
+    Parse & format `count` random timestamps with the old (strptime/strftime)
+    and new functions, and check that they agree.
+    '''
+
+    rand = random.Random(1)
+    dttms = []
+    for i in xrange(count):
+        dttm = START + dt.timedelta(seconds=rand.randint(0, 10 * 365 * 86400))
+        if i % 2:
+            dttm = dttm.replace(microsecond=rand.randint(0, 999999))
+        dttms.append(dttm)
+    strings = [legacy_dttm_to_str(d, include_msec=bool(d.microsecond)) for d in dttms]
+
+    def timed(func, values):
+        start = time.time()
+        result = map(func, values)
+        return result, time.time() - start
+
+    print('%d timestamps' % count)
+    print('%10s %14s %14s %10s' % ('', 'legacy (s)', 'fast (s)', 'speedup'))
+
+    before, before_secs = timed(legacy_str_to_datetime, strings)
+    after, after_secs = timed(schedule.str_to_datetime, strings)
+    assert before == after, 'str_to_datetime() results differ'
+    print('%10s %14.2f %14.2f %9.1fx' % ('parse', before_secs, after_secs, before_secs / after_secs))
+
+    before, before_secs = timed(legacy_dttm_to_str, dttms)
+    after, after_secs = timed(schedule.dttm_to_str, dttms)
+    assert before == after, 'dttm_to_str() results differ'
+    print('%10s %14.2f %14.2f %9.1fx' % ('format', before_secs, after_secs, before_secs / after_secs))
+
+
+def main():
+    bench_choose_interval()
+    print('')
+    bench_durations()
+    print('')
+    bench_timestamps()
+
+
+if __name__ == '__main__':
+    main()
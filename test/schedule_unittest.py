@@ -55,18 +55,93 @@ class ScheduleTest(unittest.TestCase):
                 schedule.duration_to_delta('P12D') )
 
 
+    def test_duration_cache(self):
+
+        cache = schedule.LRUCache(4)
+        for key in ('a', 'b', 'c', 'd', 'a', 'e'):
+            self.assertEqual(key * 2, cache.get(key, lambda k: k * 2))
+        self.assertEqual((1, 5, 1), (cache.hits, cache.misses, cache.evictions))
+
+        # 'b' was the least recently used
+        self.assertEqual(4, len(cache))
+        self.assertEqual(['a', 'c', 'd', 'e'], sorted(cache._entries))
+
+        # Parsed durations are shared, and unchanged
+        misses = schedule.duration_cache.misses
+        parsed = schedule.parse_duration('PT17M')
+        self.assertTrue(parsed is schedule.parse_duration('PT17M'))
+        self.assertEqual(misses + 1, schedule.duration_cache.misses)
+        self.assertEqual(('+',0,0,0,0,17,0), parsed)
+        self.assertEqual((relativedelta(minutes=17),'+'), schedule.duration_to_delta('PT17M'))
+
+        # Changing a delta doesn't change the next one
+        delta = schedule.duration_to_delta('PT17M')[0]
+        delta.minutes = 5
+        self.assertEqual(relativedelta(minutes=17), schedule.duration_to_delta('PT17M')[0])
+        offset = schedule.duration_to_offset('P1M')[0]
+        offset.months = 2
+        self.assertEqual(relativedelta(months=1), schedule.duration_to_offset('P1M')[0])
+
+        # Fixed lengths come back as a timedelta
+        self.assertEqual((dt.timedelta(days=1, hours=2, seconds=3), '+'),
+                schedule.duration_to_offset('P1DT2H3S'))
+        self.assertEqual((relativedelta(months=1), '-'), schedule.duration_to_offset('-P1M'))
+
+        self.assertEqual(
+                [dt.datetime(2013,1,31), dt.datetime(2013,2,28), dt.datetime(2013,2,28,1,30),
+                 dt.datetime(2013,2,28,1,25)],
+                schedule.durations_to_dates(dt.datetime(2013,1,31), ('P1M','PT90M','-PT5M')) )
+
+
     def test_str_to_dttm(self):
 
         self.assertEqual(
                 dt.datetime(2013,5,12,8,33,50),
                 schedule.str_to_datetime('2013-05-12T08:33:50Z') )
 
+        self.assertEqual(
+                dt.datetime(2013,5,12,8,33,50,250000),
+                schedule.str_to_datetime('2013-05-12T08:33:50.25Z') )
+
+        self.assertEqual(
+                dt.datetime(2013,5,12,8,33,50,123456),
+                schedule.str_to_datetime('2013-05-12T08:33:50.123456Z') )
+
+        # Offsets are converted to UTC
+        self.assertEqual(
+                dt.datetime(2013,5,12,8,33,50),
+                schedule.str_to_datetime('2013-05-12T10:33:50+02:00') )
+
+        self.assertEqual(
+                dt.datetime(2013,5,13,1,3,50,500000),
+                schedule.str_to_datetime('2013-05-12T20:33:50.5-04:30') )
+
+        # Same as strptime
+        for dt_str in ('2013-05-12T08:33:50Z', '1999-12-31T23:59:59.999999Z',
+                       '2013-02-28T00:00:00.1Z', '2013-5-2T8:03:05Z'):
+            fmt = '%Y-%m-%dT%H:%M:%S.%fZ' if '.' in dt_str else '%Y-%m-%dT%H:%M:%SZ'
+            self.assertEqual(dt.datetime.strptime(dt_str, fmt), schedule.str_to_datetime(dt_str))
+
+        for dt_str in ('2013-05-12T08:33:50', '2013-05-12T08:33:50.1234567Z',
+                       '2013-02-30T08:33:50Z', '2013-05-12 08:33:50Z', ''):
+            self.assertRaises(ValueError, schedule.str_to_datetime, dt_str)
+
 
     def test_dttm_to_str(self):
 
         self.assertEqual( '2013-05-12T08:33:50Z',
                 schedule.dttm_to_str(dt.datetime(2013,5,12,8,33,50), include_msec=False) )
 
+        self.assertEqual( '2013-05-12T08:33:50.000000Z',
+                schedule.dttm_to_str(dt.datetime(2013,5,12,8,33,50)) )
+
+        self.assertEqual( '2013-05-02T08:03:05.012345Z',
+                schedule.dttm_to_str(dt.datetime(2013,5,2,8,3,5,12345)) )
+
+        dttm = dt.datetime(2013,5,2,8,3,5,12345)
+        self.assertEqual( dttm.strftime('%Y-%m-%dT%H:%M:%S.%fZ'), schedule.dttm_to_str(dttm) )
+        self.assertEqual( dttm, schedule.str_to_datetime(schedule.dttm_to_str(dttm)) )
+
 
     def test_random_offset(self):
 
@@ -130,6 +205,104 @@ class ScheduleTest(unittest.TestCase):
             dt.datetime(2013,5,12,20,36,20) ) )
 
 
+    def test_next_transition(self):
+
+        start = dt.datetime(2013,5,12,8,30,50)
+        intervals = ('PT5M','PT30S','PT12H')
+
+        # before event start
+        self.assertEqual(start, schedule.next_transition(start, intervals,
+            dt.datetime(2013,5,12,8,22,0) ) )
+
+        # first & second intervals
+        self.assertEqual(dt.datetime(2013,5,12,8,35,50),
+            schedule.next_transition(start, intervals, start ) )
+
+        self.assertEqual(dt.datetime(2013,5,12,8,36,20),
+            schedule.next_transition(start, intervals,
+                dt.datetime(2013,5,12,8,35,50) ) )
+
+        # third interval is when the event ends
+        self.assertEqual(dt.datetime(2013,5,12,20,36,20),
+            schedule.next_transition(start, intervals,
+                dt.datetime(2013,5,12,8,36,20) ) )
+
+        # after the last interval
+        self.assertEqual(None, schedule.next_transition(start, intervals,
+            dt.datetime(2013,5,12,20,36,20) ) )
+
+        # a 0 duration interval never ends
+        intervals = ('PT5M','PT0M')
+        self.assertEqual(dt.datetime(2013,5,12,8,35,50),
+            schedule.next_transition(start, intervals, start ) )
+
+        self.assertEqual(None, schedule.next_transition(start, intervals,
+            dt.datetime(2013,5,12,8,35,50) ) )
+
+
+
+    def test_timeline(self):
+
+        start = dt.datetime(2013,5,12,8,30,50)
+        interval_lists = (
+            ('PT5M','PT30S','PT12H'),
+            ['PT1M'] * 500,
+            ('PT5M','PT0M','PT1M'),         # unending
+            ('PT0M',),
+            ('PT5M','-PT2M','PT1M'),        # not in order
+            (),
+        )
+
+        for intervals in interval_lists:
+            timeline = schedule.Timeline(start, intervals)
+            boundaries = schedule.durations_to_dates(start, intervals)
+
+            # Same answers as a plain walk through the boundaries
+            for now in boundaries + [b + dt.timedelta(seconds=s)
+                    for b in boundaries for s in (-1, 1)]:
+                expected = None
+                current_interval_end = None
+                for i, new_interval_end in enumerate(boundaries):
+                    if new_interval_end > now or new_interval_end == current_interval_end:
+                        expected = i - 1
+                        break
+                    current_interval_end = new_interval_end
+
+                self.assertEqual(expected, timeline.choose_interval(now),
+                        msg='%r at %s' % (intervals[:5], now))
+
+        timeline = schedule.Timeline(start, ('PT5M','PT0M','PT1M'))
+        self.assertEqual(None, timeline.get_end_time())
+        self.assertEqual(start + dt.timedelta(minutes=5), timeline.next_transition(start))
+        self.assertEqual(None, timeline.next_transition(start + dt.timedelta(minutes=6)))
+
+        timeline = schedule.Timeline(start, ('PT5M','PT30S'))
+        self.assertEqual(dt.datetime(2013,5,12,8,36,20), timeline.get_end_time())
+
+
+    def test_get_timeline(self):
+
+        start = dt.datetime(2013,5,12,8,30,50)
+        intervals = ['PT1M'] * 10
+
+        timeline = schedule.get_timeline(('e_1', 0), start, intervals)
+        self.assertTrue(timeline is schedule.get_timeline(('e_1', 0), start, list(intervals)))
+
+        # Worked out again if the event changed under the same key
+        later = schedule.get_timeline(('e_1', 0), start + dt.timedelta(hours=1), intervals)
+        self.assertFalse(timeline is later)
+        self.assertEqual(start + dt.timedelta(hours=1), later.start)
+
+        shorter = schedule.get_timeline(('e_1', 0), start + dt.timedelta(hours=1), intervals[:5])
+        self.assertEqual(4, shorter.choose_interval(start + dt.timedelta(hours=1, minutes=4)))
+        self.assertEqual(None, shorter.choose_interval(start + dt.timedelta(hours=1, minutes=5)))
+
+        # Same number of intervals, but longer ones
+        longer = schedule.get_timeline(('e_1', 0), start + dt.timedelta(hours=1), ['PT2M'] * 5)
+        self.assertFalse(shorter is longer)
+        self.assertEqual(2, longer.choose_interval(start + dt.timedelta(hours=1, minutes=5)))
+
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,99 @@
+# Micro-benchmarks for moving payloads between SleekXMPP & lxml (2.0a samples)
+
+# NOTE: Make sure to run this file from the root directory of the project
+import sys,os
+sys.path.insert( 0, os.getcwd() )
+xml_dir = os.path.join( os.path.dirname(__file__), 'xml_files')
+
+import glob
+import timeit
+from xml.etree import cElementTree as std_ElementTree
+from lxml import etree
+from sleekxmpp.stanza.iq import Iq
+from sleekxmpp.xmlstream import tostring
+from oadr2 import event, xmpp
+
+# Some constants
+SAMPLE_DIR = os.path.join(xml_dir, '2.0a_spec/')
+ROUNDS = 2000
+TO = 'vtn@example.com/oadr2'
+
+
+
+def load_payloads(pattern):
+    '''
+    Returns: A list of the sample files matching `pattern`, as (standard
+        library XML object, lxml object) tuples
+    '''
+
+    payloads = []
+    for filename in sorted(glob.glob(os.path.join(SAMPLE_DIR, pattern))):
+        with open(filename) as xml_file:
+            data = xml_file.read()
+        payloads.append((std_ElementTree.XML(data), etree.XML(data)))
+    return payloads
+
+
+def inbound_reparse(std_payload, lxml_payload):
+    '''
+    The way `OpenADR2Plugin._handle_iq` used to do it; serialize and parse again.
+    '''
+
+    etree.XML(std_ElementTree.tostring(std_payload))
+
+
+def inbound_copy(std_payload, lxml_payload):
+    xmpp.std_to_lxml(std_payload)
+
+
+def outbound_reparse(std_payload, lxml_payload):
+    '''
+    The way `OpenADR2.send_reply` used to do it; serialize, parse into a
+    standard library object, then SleekXMPP serializes the stanza (like
+    `XMLStream.send()` does).
+    '''
+
+    iq = Iq(None, sto=TO, stype='set')
+    iq['id'] = '1'
+    iq.set_payload(std_ElementTree.XML(etree.tostring(lxml_payload)))
+    tostring(iq.xml, xmlns='jabber:client', top_level=True)
+
+
+def outbound_direct(std_payload, lxml_payload):
+    xmpp.build_iq_set(lxml_payload, TO, '1')
+
+
+def bench(name, func, payloads, rounds=ROUNDS):
+    '''
+    Time `func(std_payload, lxml_payload)` over every payload, `rounds` times.
+
+    Returns: Cost per payload, in microseconds
+    '''
+
+    def run():
+        for std_payload, lxml_payload in payloads:
+            func(std_payload, lxml_payload)
+
+    total = timeit.timeit(run, number=rounds)
+    per_payload = total / (rounds * len(payloads)) * 1e6
+    print('%-28s %8.2f us/payload' % (name, per_payload))
+    return per_payload
+
+
+def main():
+    distributions = load_payloads('batch_*.xml') + load_payloads('sample_oadrDistributeEvent*.xml')
+    print('Inbound, %d sample distributions, %d rounds' % (len(distributions), ROUNDS))
+    before = bench('serialize & parse (before)', inbound_reparse, distributions)
+    after = bench('std_to_lxml (after)', inbound_copy, distributions)
+    print('Speedup: %.2fx' % (before / after))
+
+    replies = load_payloads('sample_oadrCreatedEvent*.xml')
+    print('')
+    print('Outbound, %d sample replies, %d rounds' % (len(replies), ROUNDS))
+    before = bench('serialize & parse (before)', outbound_reparse, replies)
+    after = bench('build_iq_set (after)', outbound_direct, replies)
+    print('Speedup: %.2fx' % (before / after))
+
+
+if __name__ == '__main__':
+    main()
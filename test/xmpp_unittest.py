@@ -0,0 +1,195 @@
+# Some Unit-Tests for the XMPP payload conversions
+
+# NOTE: Make sure to run this file from the root directory of the project
+import sys,os
+sys.path.insert( 0, os.getcwd() )
+xml_dir = os.path.join( os.path.dirname(__file__), 'xml_files')
+
+import glob
+import shutil
+import tempfile
+import threading
+from xml.etree import cElementTree as std_ElementTree
+from lxml import etree
+from sleekxmpp.stanza.iq import Iq
+from sleekxmpp.exceptions import XMPPError
+from oadr2 import event, xmpp
+import unittest
+
+# Some constants
+SAMPLE_DIR = os.path.join(xml_dir, '2.0a_spec/')
+VTN_ID = 'TH_VTN'
+
+
+
+
+def dump(element):
+    '''
+    Returns: A list of everything in an element (of either library), to compare
+    '''
+
+    return [(e.tag, sorted(e.attrib.items()), e.text, e.tail) for e in element.iter()
+            if isinstance(e.tag, basestring)]
+
+
+
+class ConversionTest(unittest.TestCase):
+
+    def test_std_to_lxml(self):
+        for path in sorted(glob.glob(os.path.join(SAMPLE_DIR, '*.xml'))):
+            with open(path) as xml_file:
+                data = xml_file.read()
+
+            payload = xmpp.std_to_lxml(std_ElementTree.XML(data))
+            self.assertEqual(dump(etree.XML(data)), dump(payload), path)
+
+        # The prefixes are declared once, on the root
+        self.assertTrue(set(payload.nsmap.items()) <= set(event.NS_A.items() + event.NS_B.items()))
+        self.assertEqual(1, etree.tostring(payload).count('xmlns:ei='))
+
+        # Whatever prefixes (or default namespace) the source used, only
+        # its own namespaces are declared
+        data = ('<distribute xmlns="urn:other"><ei:eventID xmlns:ei="%s">e_1</ei:eventID>'
+                '<x:thing xmlns:x="urn:another" x:attr="1"/></distribute>') % event.EI_XMLNS_A
+        payload = xmpp.std_to_lxml(std_ElementTree.XML(data))
+        self.assertEqual(dump(etree.XML(data)), dump(payload))
+        self.assertEqual(set(['urn:other', event.EI_XMLNS_A, 'urn:another']), set(payload.nsmap.values()))
+        self.assertEqual(event.EI_XMLNS_A, payload.nsmap['ei'])
+        self.assertEqual(3, etree.tostring(payload).count('xmlns'))
+
+        # 2.0b payloads get the 2.0b namespaces
+        payload = xmpp.std_to_lxml(std_ElementTree.XML(
+                '<oadr:oadrDistributeEvent xmlns:oadr="%s"/>' % event.OADR_XMLNS_B))
+        self.assertEqual({'oadr': event.OADR_XMLNS_B}, payload.nsmap)
+
+
+    def test_handle_payload(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            handler = event.EventHandler('ven_py', vtn_ids=VTN_ID,
+                    db_path=os.path.join(tmp_dir, 'test.db'))
+            with open(os.path.join(SAMPLE_DIR, 'batch_a_2.xml')) as xml_file:
+                payload = xmpp.std_to_lxml(std_ElementTree.XML(xml_file.read()))
+            reply = handler.handle_payload(payload)
+            self.assertEqual(['e_1'], handler._event_index.keys())
+            handler.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        # What SleekXMPP reads back is the reply
+        stanza = xmpp.build_iq_set(reply, u'vtn@example.com/r\xe9source', 'id&1')
+        iq = Iq(None, xml=std_ElementTree.XML(stanza.encode('utf-8')))
+        self.assertEqual('set', iq['type'])
+        self.assertEqual(u'vtn@example.com/r\xe9source', iq['to'].full)
+        self.assertEqual('id&1', iq['id'])
+        self.assertEqual(dump(reply), dump(iq.xml[0]))
+
+
+
+class FakeClient(object):
+    '''
+    Stands in for the sleekxmpp.ClientXMPP (which would connect to a
+    server); keeps track of the stanzas sent.
+    '''
+
+    def __init__(self):
+        self.sent = []
+        self.state = self
+        self.stop = threading.Event()
+
+    def current_state(self):
+        return 'disconnected' if self.stop.is_set() else 'connected'
+
+    def new_id(self):
+        return str(len(self.sent))
+
+    def send_raw(self, data):
+        self.sent.append(data)
+
+    def send_presence(self, **kwargs):
+        pass
+
+    def disconnect(self):
+        self.stop.set()
+
+
+
+class UnconnectedOpenADR2(xmpp.OpenADR2):
+    def _init_client(self, start_thread):
+        self.xmpp_client = FakeClient()
+
+
+
+class OpenADR2Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.handler = UnconnectedOpenADR2({'ven_id': 'ven_py', 'vtn_ids': VTN_ID,
+                                            'db_path': os.path.join(self.tmp_dir, 'test.db')},
+                                           'ven_py@localhost/python', 'asdf',
+                                           workers=1, max_queue=2)
+        self.client = self.handler.xmpp_client
+        self.plugin = xmpp.OpenADR2Plugin(None)
+        self.plugin.callback = self.handler._handle_oadr_payload
+        with open(os.path.join(SAMPLE_DIR, 'batch_a_2.xml')) as xml_file:
+            self.payload = std_ElementTree.XML(xml_file.read())
+
+
+    def tearDown(self):
+        self.handler.exit()
+        shutil.rmtree(self.tmp_dir)
+
+
+    def iq(self, from_):
+        '''
+        Returns: An Iq stanza w/ the sample distribution, like SleekXMPP would get
+        '''
+
+        iq_xml = std_ElementTree.Element('{jabber:client}iq',
+                {'type': 'set', 'from': from_, 'id': 'iq_1'})
+        iq_xml.append(self.payload)
+        return Iq(None, xml=iq_xml)
+
+
+    def test_workers(self):
+        # The event handler is held up, but the IQs are still taken right away
+        gate, started = threading.Event(), threading.Event()
+        handled = []
+        handle_payload = self.handler.event_handler.handle_payload
+        def slow_handle_payload(payload):
+            handled.append(payload)
+            started.set()
+            gate.wait(5)
+            return handle_payload(payload)
+        self.handler.event_handler.handle_payload = slow_handle_payload
+
+        self.plugin._handle_iq(self.iq('vtn@example.com/a'))
+        self.assertTrue(started.wait(5))
+        self.plugin._handle_iq(self.iq('vtn@example.com/b'))
+        self.plugin._handle_iq(self.iq('other_vtn@example.com/a'))
+        self.assertFalse(gate.is_set())
+
+        # Past `max_queue` waiting, they're turned away
+        try:
+            self.plugin._handle_iq(self.iq('vtn@example.com/a'))
+            self.fail('No XMPPError')
+        except XMPPError as ex:
+            self.assertEqual('resource-constraint', ex.condition)
+            self.assertEqual('wait', ex.etype)
+
+        gate.set()
+        self.assertTrue(self.handler.payload_dispatcher.join(5))
+        self.assertEqual(3, len(handled))
+        self.assertEqual(['e_1'], self.handler.event_handler._event_index.keys())
+
+        # Each one answered by the worker, in order for each VTN
+        tos = [Iq(None, xml=std_ElementTree.XML(stanza.encode('utf-8')))['to'].full
+               for stanza in self.client.sent]
+        self.assertEqual(3, len(tos))
+        self.assertEqual(['vtn@example.com/a', 'vtn@example.com/b'],
+                         [to for to in tos if to.startswith('vtn@')])
+
+
+
+if __name__ == '__main__':
+    unittest.main()